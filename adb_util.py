@@ -1,26 +1,52 @@
 import os
+import re
+import shlex
+import gzip
+import shutil
+import tarfile
+import threading
+import hashlib
 import zipfile
-import requests
 import subprocess
-from tqdm import tqdm
+import time
+import zlib
+import queue
 from pathlib import Path
-from tempfile import TemporaryDirectory
-from ppadb.client import Client as AdbClient
-from ppadb.device import Device
+from typing import TYPE_CHECKING
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from presets import APK_CONFIGS, HL_GOLD_HD_URL, ADB_ZIP, TQDM_AVAILABLE
+from download_util import fetch_artifacts
+from path_util import IS_WINDOWS, TreeIndex
+from metrics_util import phase, BuildCancelled
+from presets import APK_CONFIGS, ADB_ZIP, CACHE_DIR
 
+if TYPE_CHECKING:
+    # ppadb is only imported once a device is actually needed
+    from ppadb.client import Client as AdbClient
+    from ppadb.device import Device
 
-IS_WINDOWS = os.name == 'nt'
 
-def rewrite_path_for_os(path: Path) -> Path:
-    if IS_WINDOWS:
-        return Path(str(path).replace('/', '\\'))
+# How many devices to work on at the same time
+DEFAULT_DEVICE_JOBS = 4
+
+# How sync_folder sends files: 'sync' is one adb push per file, 'tar' streams them all as one tar into the device's tar
+TRANSFER_MODES = ('tar', 'sync')
+# Compression for the tar stream, 'auto' gzips it only if compressing a sample of the files shows it'll be quicker
+COMPRESSION_MODES = ('auto', 'gzip', 'none')
+# Roughly what adb gets through a Quest's USB cable, compressing only helps if it's faster than the link
+LINK_BYTES_PER_SECOND = 40 * 1024 ** 2
+COMPRESSION_SAMPLE_FILES = 64
+COMPRESSION_SAMPLE_BYTES = 256 * 1024
+# How many files to md5sum per shell call, so the command line stays a sensible length
+MD5_BATCH_FILES = 200
 
-    return Path(str(path).replace('\\', '/'))
+# Cached adb executable and client, shared by everything in this run
+_adb_lock = threading.Lock()
+_adb_exe = None
+_adb_client = None
 
 def find_quest_devices():
-    client = AdbClient()
+    client = get_adb_client()
     devices: list[Device] = client.devices()
 
     quest_devices = []
@@ -33,62 +59,86 @@ def find_quest_devices():
     return quest_devices
 
 
-def get_adb_exe() -> (Path, Path):
-    # Unzip the adb zip to a temporary directory and return the path to the adb executable and the temporary directory
-    temp_dir = TemporaryDirectory()
-    temp_dir_path = Path(temp_dir.name)
-    print('Extracting ADB zip to', temp_dir_path)
-    with zipfile.ZipFile(ADB_ZIP, 'r') as zip_ref:
-        zip_ref.extractall(temp_dir_path)
-
-    # Get the path to the adb executable
-    adb_exe = temp_dir_path / 'platform-tools' / 'adb.exe'
-    print('ADB executable:', adb_exe)
-    return adb_exe, temp_dir
-
-def delete_temp_dir(temp_dir: TemporaryDirectory):
-    # Delete the temporary directory
-    print('Deleting temporary directory', temp_dir.name)
-    temp_dir.cleanup()
-    print('Deleted temporary directory.')
-
-def download_with_progress(url, dest_path):
-    # with tqdm(unit='B', unit_scale=True, unit_divisor=1024, miniters=1, desc=dest_path) as t:
-    #     urllib.request.urlretrieve(url, dest_path, reporthook=reporthook(t))
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        with open(dest_path, 'wb') as f:
-            if TQDM_AVAILABLE:
-                pbar = tqdm(total=int(r.headers['Content-Length']))
-                for chunk in r.iter_content(chunk_size=8192):
-                    if chunk:  # filter out keep-alive new chunks
-                        f.write(chunk)
-                    pbar.update(len(chunk))
-                pbar.close()
-            else:
-                for chunk in r.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-
-def install_apk(apk_url, device: Device):
-    with TemporaryDirectory() as temp_dir:
-        # Get the filename from the URL
-        apk_filename = apk_url.split('/')[-1]
-        # Download the APK
-        apk_path = Path(temp_dir) / apk_filename
-
-        print('Downloading APK...')
-        download_with_progress(apk_url, apk_path)
-        print('\nDownloaded APK.')
-        # Install the APK
-        print('Installing APK...')
-        adb_exe, temp_dir = get_adb_exe()
-        subprocess.run([str(adb_exe), '-s', device.serial, 'install', '-r', str(apk_path)])
-        # device.install(apk_path, reinstall=True)
-        delete_temp_dir(temp_dir)
-        print('Installed APK.')
-
-def make_folder(device: Device, folder: Path):
+def run_on_devices(devices: list, fcn: callable, desc: str, max_workers: int = DEFAULT_DEVICE_JOBS) -> dict:
+    # Run fcn(device) on every device at the same time, a failure on one headset doesn't stop the others.
+    # Returns {serial: None if it worked, otherwise the exception}
+    results = {}
+    if not devices:
+        return results
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(devices)))) as executor:
+        futures = {}
+        for device in devices:
+            print(f'[{device.serial}] Starting: {desc}')
+            futures[executor.submit(fcn, device)] = device
+        for future in as_completed(futures):
+            serial = futures[future].serial
+            try:
+                future.result()
+                print(f'[{serial}] Done: {desc}')
+                results[serial] = None
+            except Exception as e:
+                print(f'[{serial}] Failed: {desc}: {e}')
+                results[serial] = e
+
+    failed = [serial for serial, error in results.items() if error is not None]
+    print(f'{desc}: {len(devices) - len(failed)}/{len(devices)} device(s) succeeded.')
+    for serial in failed:
+        print(f'  {serial}: {results[serial]}')
+    return results
+
+def get_adb_exe() -> Path:
+    # Extract the adb zip into a cache folder named after the zip's hash the first time it's needed, then keep reusing it.
+    # The adb server is started once per run so every later adb call talks to the same warm server.
+    global _adb_exe
+    with _adb_lock:
+        if _adb_exe is not None and _adb_exe.exists():
+            return _adb_exe
+
+        zip_hash = hashlib.sha256(ADB_ZIP.read_bytes()).hexdigest()[:16]
+        cache_dir = CACHE_DIR / 'platform-tools' / zip_hash
+        adb_exe = cache_dir / 'platform-tools' / ('adb.exe' if IS_WINDOWS else 'adb')
+        if not adb_exe.exists():
+            print('Extracting ADB zip to', cache_dir)
+            # Extract next to the final location and rename it into place, so a half-extracted cache never gets used
+            temp_dir = cache_dir.with_name(cache_dir.name + '.tmp')
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            with zipfile.ZipFile(ADB_ZIP, 'r') as zip_ref:
+                zip_ref.extractall(temp_dir)
+            if not IS_WINDOWS:
+                for file in (temp_dir / 'platform-tools').iterdir():
+                    if file.is_file():
+                        file.chmod(file.stat().st_mode | 0o111)
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            os.replace(temp_dir, cache_dir)
+
+        print('ADB executable:', adb_exe)
+        subprocess.run([str(adb_exe), 'start-server'])
+        _adb_exe = adb_exe
+        return adb_exe
+
+def get_adb_client() -> 'AdbClient':
+    # One client for the whole run, talking to the server started from the cached adb
+    global _adb_client
+    if _adb_client is None:
+        if ADB_ZIP.exists():
+            get_adb_exe()
+        from ppadb.client import Client as AdbClient
+        _adb_client = AdbClient()
+    return _adb_client
+
+def install_apk(apk_path: Path, device: 'Device', metrics=None):
+    # Install an APK that has already been downloaded, see download_util.fetch_artifacts
+    print(f'[{device.serial}] Installing {Path(apk_path).name}...')
+    adb_exe = get_adb_exe()
+    with phase(metrics, 'install_apk', device=device.serial, apk=Path(apk_path).name) as timing:
+        result = subprocess.run([str(adb_exe), '-s', device.serial, 'install', '-r', str(apk_path)])
+        timing.add(files=1, bytes=Path(apk_path).stat().st_size)
+    # device.install(apk_path, reinstall=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'adb install {Path(apk_path).name} failed with exit code {result.returncode}')
+    print(f'[{device.serial}] Installed {Path(apk_path).name}.')
+
+def make_folder(device: 'Device', folder: Path):
     # Check that it starts with /sdcard/
     if not folder.parts[0] == 'sdcard':
         # Make it start with /sdcard/
@@ -98,21 +148,26 @@ def make_folder(device: Device, folder: Path):
     device.shell(f'mkdir {folder}')
     print(f'Made {folder} on device.')
 
-def push_folder(device: Device, local_folder: str, remote_folder: Path):
+def push_folder(device: 'Device', local_folder: str, remote_folder: Path, metrics=None):
     # Check that it starts with /sdcard/
     if not remote_folder.parts[0] == 'sdcard':
         # Make it start with /sdcard/
         remote_folder = Path('/sdcard') / remote_folder
-    
+
+    with phase(metrics, 'push', device=device.serial, folder=local_folder) as timing:
+        _push_folder(device, local_folder, remote_folder)
+        local_index = TreeIndex(local_folder)
+        timing.add(files=len(local_index), bytes=local_index.total_bytes())
+
+def _push_folder(device: 'Device', local_folder: str, remote_folder: Path):
     if IS_WINDOWS:
         # Have to use subprocess because the ppadb push function doesn't work on Windows
         # Replace \ with / in the remote folder
         remote_folder = str(remote_folder).replace('\\', '/')
         print('remote_folder:', remote_folder)
         print('Current directory:', os.getcwd())
-        adb_exe, temp_dir = get_adb_exe()
+        adb_exe = get_adb_exe()
         subprocess.run([str(adb_exe), '-s', device.serial, 'push', str(local_folder), str(remote_folder)])
-        delete_temp_dir(temp_dir)
     else:
          # # Make sure the local folder ends with a / so that it copies the contents of the folder instead of the folder itself
         if not str(local_folder).endswith('/'):
@@ -122,7 +177,302 @@ def push_folder(device: Device, local_folder: str, remote_folder: Path):
 
     print(f'Pushed {local_folder} to {remote_folder} on device.')
 
-def copy_all_files(device: Device, src: Path, dest: Path):
+def push_file(device: 'Device', local_file: Path, remote_file: str):
+    # Push a single file, remote_file should be a full /sdcard/... path
+    if IS_WINDOWS:
+        # Have to use subprocess because the ppadb push function doesn't work on Windows
+        subprocess.run([str(get_adb_exe()), '-s', device.serial, 'push', str(local_file), remote_file])
+    else:
+        device.push(str(local_file), remote_file)
+
+def local_md5(path: Path) -> str:
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def list_remote_files(device: 'Device', remote_folder: str) -> dict:
+    # Get the size of every file under remote_folder with a single shell call, returns {relative path: size}
+    quoted = shlex.quote(remote_folder)
+    output = device.shell(f"find {quoted} -type f -exec stat -c '%s %n' {{}} + 2>/dev/null")
+    sizes = {}
+    prefix = remote_folder.rstrip('/') + '/'
+    for line in output.splitlines():
+        stat_match = re.match(r'^(\d+) (/.*)$', line)
+        if stat_match and stat_match.group(2).startswith(prefix):
+            sizes[stat_match.group(2)[len(prefix):]] = int(stat_match.group(1))
+    return sizes
+
+def remote_md5s(device: 'Device', remote_folder: str, rels: list) -> dict:
+    # md5 of the given files under remote_folder, a few hundred per shell call. Returns {relative path: md5}
+    hashes = {}
+    rels = sorted(rels)
+    for i in range(0, len(rels), MD5_BATCH_FILES):
+        names = ' '.join(shlex.quote(rel) for rel in rels[i:i + MD5_BATCH_FILES])
+        output = device.shell(f'cd {shlex.quote(remote_folder)} && md5sum {names} 2>/dev/null')
+        for line in output.splitlines():
+            md5_match = re.match(r'^([0-9a-f]{32})  (.*)$', line)
+            if md5_match:
+                hashes[md5_match.group(2)] = md5_match.group(1)
+    return hashes
+
+def same_on_device(device: 'Device', remote_folder: str, remote_sizes: dict, files: list) -> set:
+    # Which of files ([(local path, relative path, size)]) the device already has. Only files whose size matches
+    # are hashed, on both ends, so a changed pak is usually caught without reading it at all.
+    candidates = {rel: path for path, rel, size in files if remote_sizes.get(rel) == size}
+    if not candidates:
+        return set()
+    hashes = remote_md5s(device, remote_folder, list(candidates))
+    return {rel for rel, path in candidates.items() if rel in hashes and hashes[rel] == local_md5(path)}
+
+def sync_folder(device: 'Device', local_folder: Path, remote_folder: Path, delete_stale: bool = True, metrics=None, ready: 'queue.Queue' = None, transfer: str = 'sync', compression: str = 'auto'):
+    # Only push the files that are different on the device, and delete pak files that are no longer part of the build.
+    # Anything else already on the device (saves, configs the game wrote) is left alone.
+    # With ready, the relative paths put on the queue are pushed as they arrive while local_folder is still being built.
+    # None on the queue means the build is done and the rest of the folder gets synced, an exception means it failed.
+    # transfer and compression are how the files are sent, see TRANSFER_MODES and COMPRESSION_MODES.
+    # Check that it starts with /sdcard/
+    if not remote_folder.parts[0] == 'sdcard':
+        # Make it start with /sdcard/
+        remote_folder = Path('/sdcard') / remote_folder
+    remote_folder = str(remote_folder).replace('\\', '/')
+    local_folder = Path(local_folder)
+    remote_files = None
+    pushed = set()
+    if ready is not None:
+        remote_files = list_remote_files(device, remote_folder)
+        pushed = _push_as_ready(device, local_folder, remote_folder, remote_files, ready, metrics, transfer=transfer, compression=compression)
+    with phase(metrics, 'sync_plan', device=device.serial, folder=local_folder) as timing:
+        to_push, stale = _plan_sync(device, local_folder, remote_folder, delete_stale, remote_files=remote_files, already_synced=pushed)
+        timing.add(files=len(to_push), bytes=sum(size for _, _, size in to_push))
+
+    if stale:
+        device.shell('rm -f ' + ' '.join(shlex.quote(f'{remote_folder}/{rel}') for rel in stale))
+        for rel in stale:
+            print(f'Deleted {remote_folder}/{rel} from device.')
+
+    with phase(metrics, 'push', total_files=len(to_push), total_bytes=sum(size for _, _, size in to_push), device=device.serial, folder=local_folder, transfer=transfer) as timing:
+        push_files(device, to_push, remote_folder, transfer=transfer, compression=compression, timing=timing)
+
+    print(f'Synced {local_folder} to {remote_folder} on device.')
+
+def _push_as_ready(device: 'Device', local_folder: Path, remote_folder: str, remote_files: dict, ready: 'queue.Queue', metrics=None, transfer: str = 'sync', compression: str = 'auto') -> set:
+    # Push the files named on the ready queue if the device doesn't already have them, until the build says it's done.
+    # Whatever has piled up on the queue while the last push was going is sent together, as one tar stream in tar mode.
+    # Returns every relative path that was dealt with.
+    done = set()
+    made_dirs = set()
+    with phase(metrics, 'push', device=device.serial, folder=local_folder, streamed=True, transfer=transfer) as timing:
+        finished = False
+        while not finished:
+            batch = [ready.get()]
+            while True:
+                try:
+                    batch.append(ready.get_nowait())
+                except queue.Empty:
+                    break
+            files = []
+            for rel in batch:
+                if rel is None:
+                    finished = True
+                    continue
+                if isinstance(rel, BaseException):
+                    if isinstance(rel, BuildCancelled):
+                        raise BuildCancelled('Build cancelled, stopped pushing.')
+                    raise RuntimeError(f'Build failed, stopped pushing: {rel}')
+                if rel not in done:
+                    done.add(rel)
+                    file = local_folder / rel
+                    files.append((file, rel, file.stat().st_size))
+            same = same_on_device(device, remote_folder, remote_files, files)
+            push_files(device, [(file, rel, size) for file, rel, size in files if rel not in same], remote_folder, transfer=transfer, compression=compression, timing=timing, made_dirs=made_dirs)
+    return done
+
+def _plan_sync(device: 'Device', local_folder: Path, remote_folder: str, delete_stale: bool, remote_files: dict = None, already_synced: set = frozenset()) -> (list, list):
+    # Work out which local files differ from the device and which old pak files on the device should go.
+    # Files in already_synced were pushed (or checked) while the folder was being built, so they're skipped.
+    if remote_files is None:
+        remote_files = list_remote_files(device, remote_folder)
+
+    local_files = sorted(TreeIndex(local_folder).files.items())
+    local_names = {rel for rel, _ in local_files}
+    to_check = [(file.path, rel, file.size) for rel, file in local_files if rel not in already_synced]
+    same = same_on_device(device, remote_folder, remote_files, to_check)
+    to_push = [(path, rel, size) for path, rel, size in to_check if rel not in same]
+    skipped = len(same)
+    skipped_bytes = sum(size for _, rel, size in to_check if rel in same)
+    stale = [rel for rel in remote_files if rel not in local_names and re.fullmatch(r'pak\d+\.pak', Path(rel).name)] if delete_stale else []
+
+    push_bytes = sum(size for _, _, size in to_push)
+    print(f'Sync plan for {device.serial}: {len(to_push)} files ({push_bytes / 1024 ** 2:.1f} MB) to send, '
+          f'{skipped} files ({skipped_bytes / 1024 ** 2:.1f} MB) already up to date, {len(stale)} old pak files to delete.')
+    return to_push, stale
+
+def push_files(device: 'Device', files: list, remote_folder: str, transfer: str = 'sync', compression: str = 'auto', timing=None, made_dirs: set = None):
+    # Push files ([(local path, relative path, size)]) into remote_folder, either as one tar stream or one adb push each.
+    # If the tar stream doesn't work on this device, falls back to pushing them one at a time.
+    # made_dirs is the set of remote folders already known to exist, so they aren't made again.
+    if not files:
+        return
+    if transfer == 'tar':
+        try:
+            sent = push_tar(device, files, remote_folder, compression=compression, timing=timing)
+            total = sum(size for _, _, size in files)
+            print(f'Pushed {len(files)} file(s) ({total / 1024 ** 2:.1f} MB) as a tar stream, {sent / 1024 ** 2:.1f} MB over the link')
+            return
+        except (OSError, RuntimeError) as e:
+            print(f'[{device.serial}] Tar push failed, pushing the files one at a time instead: {e}')
+
+    # Make every folder up front so each push doesn't have to
+    made_dirs = made_dirs if made_dirs is not None else set()
+    remote_dirs = sorted({f'{remote_folder}/{rel}'.rsplit('/', 1)[0] for _, rel, _ in files} - made_dirs)
+    if remote_dirs:
+        device.shell('mkdir -p ' + ' '.join(shlex.quote(d) for d in remote_dirs))
+        made_dirs.update(remote_dirs)
+    for file, rel, size in files:
+        push_file(device, file, f'{remote_folder}/{rel}')
+        print(f'Pushed {rel} ({size / 1024 ** 2:.1f} MB)')
+        if timing is not None:
+            timing.add(files=1, bytes=size)
+
+def choose_compression(files: list, link_bytes_per_second: float = None) -> str:
+    # 'gzip' if gzipping ([(local path, relative path, size)]) would get them onto the device sooner, else 'none'.
+    # Compresses a sample from the middle of some of the files to see how much smaller and how fast it goes. Each sample
+    # counts as much as its file's size, so a few big paks outweigh lots of tiny configs.
+    link = link_bytes_per_second or LINK_BYTES_PER_SECOND
+    step = max(1, len(files) // COMPRESSION_SAMPLE_FILES)
+    total = compressed = 0.0
+    seconds = 0.0
+    for file, _, size in files[::step]:
+        if not size:
+            continue
+        with open(file, 'rb') as f:
+            f.seek(max(0, size // 2 - COMPRESSION_SAMPLE_BYTES // 2))
+            sample = f.read(COMPRESSION_SAMPLE_BYTES)
+        if not sample:
+            continue
+        start = time.perf_counter()
+        ratio = len(zlib.compress(sample, 1)) / len(sample)
+        seconds += (time.perf_counter() - start) * size / len(sample)
+        compressed += ratio * size
+        total += size
+    if not total or not seconds:
+        return 'none'
+    # Compressing and sending overlap, so the gzipped stream takes as long as the slower of the two.
+    # Ask for a clear win since the sample is small.
+    gzip_seconds = max(seconds, compressed / link)
+    return 'gzip' if gzip_seconds < 0.9 * total / link else 'none'
+
+def shell_with_stdin(device: 'Device', command: str) -> subprocess.Popen:
+    # Run command on the device with a pipe to its stdin. ppadb can't stream stdin, so this goes through the adb executable.
+    # -T means no pty, so the bytes get through untouched and the command's exit code comes back.
+    adb_exe = get_adb_exe() if ADB_ZIP.exists() else shutil.which('adb')
+    if adb_exe is None:
+        raise RuntimeError('no adb executable to stream through')
+    return subprocess.Popen([str(adb_exe), '-s', device.serial, 'shell', '-T', command], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+class _PipeWriter:
+    # Writes to f on its own thread so reading and gzipping the next files carries on while adb is busy sending.
+    # Counts the bytes too, to report how much actually went over the link.
+    def __init__(self, f):
+        self.f = f
+        self.bytes = 0
+        self.error = None
+        self._chunks = queue.Queue(maxsize=64)
+        self._thread = threading.Thread(target=self._run, name='pipe-writer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while (data := self._chunks.get()) is not None:
+            if self.error is None:
+                try:
+                    self.f.write(data)
+                except OSError as e:
+                    self.error = e
+        if self.error is None:
+            try:
+                self.f.close()
+            except OSError as e:
+                self.error = e
+
+    def write(self, data) -> int:
+        if self.error is not None:
+            raise self.error
+        self._chunks.put(bytes(data))
+        self.bytes += len(data)
+        return len(data)
+
+    def close(self):
+        # Wait for everything to be written and close f, a failed write is left in self.error
+        if self._thread.is_alive():
+            self._chunks.put(None)
+            self._thread.join()
+
+class _PipeReader:
+    # Reads f to the end on its own thread, so a command that writes a lot to stderr can't fill the pipe and stall
+    # while we're still busy writing to its stdin
+    def __init__(self, f):
+        self.f = f
+        self._data = b''
+        self._thread = threading.Thread(target=self._run, name='pipe-reader', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            self._data = self.f.read()
+        except OSError:
+            pass
+
+    def read(self) -> bytes:
+        # Everything f had, once it's closed
+        self._thread.join()
+        return self._data
+
+def push_tar(device: 'Device', files: list, remote_folder: str, compression: str = 'auto', timing=None) -> int:
+    # Stream files ([(local path, relative path, size)]) to the device as one tar and unpack it there with toybox tar.
+    # adb push pays a round trip for every file, this is one long write, gzipped first if the files compress.
+    # Returns the number of bytes sent over the link.
+    if compression == 'auto':
+        compression = choose_compression(files)
+        print(f'[{device.serial}] Compression: {compression}')
+    quoted = shlex.quote(remote_folder)
+    # -m and -o: /sdcard can't take the mtime and owner from the archive anyway
+    process = shell_with_stdin(device, f'mkdir -p {quoted} && tar -xmo{"z" if compression == "gzip" else ""}f - -C {quoted}')
+    errors = _PipeReader(process.stderr)
+    sent = _PipeWriter(process.stdin)
+    try:
+        stream = gzip.GzipFile(fileobj=sent, mode='wb', compresslevel=1, mtime=0) if compression == 'gzip' else sent
+        # GNU long names are what toybox tar understands best
+        with tarfile.open(fileobj=stream, mode='w|', format=tarfile.GNU_FORMAT) as tar:
+            for file, rel, size in files:
+                info = tarfile.TarInfo(rel)
+                info.size = size
+                info.mode = 0o644
+                with open(file, 'rb') as f:
+                    tar.addfile(info, f)
+                if timing is not None:
+                    timing.add(files=1, bytes=size)
+        if stream is not sent:
+            stream.close()
+        sent.close()
+        if sent.error is not None:
+            raise sent.error
+    except BrokenPipeError:
+        # tar on the device gave up, its error comes back below
+        sent.close()
+    except BaseException:
+        # Cancelled or failed reading a local file, the half written file on the device gets replaced by the next sync
+        process.kill()
+        sent.close()
+        process.wait()
+        raise
+    error = errors.read().decode(errors='replace').strip()
+    if process.wait() != 0:
+        raise RuntimeError(f'tar on the device exited with {process.returncode}: {error}')
+    return sent.bytes
+
+def copy_all_files(device: 'Device', src: Path, dest: Path):
     # Traverse the src directory and copy all files to the dest directory
     # Check that it starts with /sdcard/
     if not dest.parts[0] == 'sdcard':
@@ -151,7 +501,7 @@ def copy_all_files(device: Device, src: Path, dest: Path):
             device.push(str(file), str(dest / relative_path))
             print(f'Pushed {file} to {dest / relative_path} on device.')
 
-def check_if_app_installed(device: Device, package_name: str):
+def check_if_app_installed(device: 'Device', package_name: str):
     # Check if the app is installed
     packages = device.shell('pm list packages')
     # print('Installed packages:', packages)
@@ -160,44 +510,16 @@ def check_if_app_installed(device: Device, package_name: str):
     else:
         return False
 
-def install_hl_gold_hd(base_path: Path, zip_path: Path = None):
-    # Download the HL Gold HD zip to a temporary directory
-    with TemporaryDirectory() as temp_dir:
-        if zip_path is not None:
-            if zip_path.exists():
-                print(f'Using existing zip at {zip_path}.')
-            else:
-                print(f'Error: Zip path {zip_path} does not exist.')
-                exit(1)
-        else:
-            zip_path = Path(temp_dir) / 'hl_gold_hd.zip'
-            download_with_progress(HL_GOLD_HD_URL, zip_path)
-        
-        # Extract the zip 
-        print('Extracting zip...')
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            # There is the HL_Gold_HD folder inside the zip, so extract that to the base path
-            # Ignore the How_to_install.txt and commandline.txt files
-            iterator = tqdm(zip_ref.infolist()) if TQDM_AVAILABLE else zip_ref.infolist()
-            for zip_info in iterator:
-                if zip_info.filename.endswith('.txt'):
-                    continue
-                # We need to rewrite the path to remove the "hl gold" folder and make it just start with "HL_Gold_HD"
-                zip_info.filename = zip_info.filename.replace('hl gold/', '')
-                # Extract the file
-                if zip_info.filename:
-                    zip_ref.extract(zip_info, base_path)
-        print('Extracted zip.')
-
 def main():
     # Get the device
     quest_devices = find_quest_devices()
     print(quest_devices)
-    # Install the APKs
-    for apk_url in APK_CONFIGS['quest'].values():
+    # Download each APK once, then install them on every device
+    apk_paths, _ = fetch_artifacts([(apk['apk_url'], apk.get('sha256')) for apk in APK_CONFIGS['quest'].values()])
+    for apk_path in apk_paths.values():
         for device in quest_devices:
-            print(f'Installing {apk_url} to {device.get_properties()["ro.product.model"]}...')
-            install_apk(apk_url, device)
+            print(f'Installing {apk_path.name} to {device.get_properties()["ro.product.model"]}...')
+            install_apk(apk_path, device)
 
 
 if __name__ == '__main__':
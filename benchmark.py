@@ -0,0 +1,515 @@
+import io
+import os
+import time
+import contextlib
+import random
+import sys
+import shutil
+import hashlib
+import statistics
+import json
+import platform
+import subprocess
+from datetime import datetime
+from pathlib import Path
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+from cli import parse_size
+from pak_util import make_hl_pak, format_size, MAX_PAK_NAME_LEN, MAX_BYTES_PER_PAK
+from metrics_util import BuildMetrics, peak_rss, io_bytes_written
+from path_util import TreeIndex
+
+
+# (folder, extension, lognormal mu, sigma) for the kinds of files in a Half-Life game folder, weighted roughly like valve/
+FILE_KINDS = [
+    ('sound/{sound}', 'wav', 10.3, 1.0),
+    ('sound/{sound}', 'wav', 10.3, 1.0),
+    ('sound/{sound}', 'wav', 10.3, 1.0),
+    ('sound/vox', 'wav', 9.5, 0.6),
+    ('models', 'mdl', 11.8, 1.2),
+    ('models/player/{name}', 'mdl', 12.5, 0.8),
+    ('sprites', 'spr', 9.0, 1.2),
+    ('gfx/env', 'tga', 12.0, 0.7),
+    ('maps', 'bsp', 13.8, 0.7),
+    ('maps/graphs', 'nod', 10.0, 0.8),
+    ('events', 'sc', 5.5, 0.5),
+]
+SOUND_DIRS = ['weapons', 'zombie', 'scientist', 'barney', 'hgrunt', 'ambience', 'debris', 'doors', 'plats',
+              'ambience/xen/caves', 'ambience/lab/vents/deep', 'common/player/footsteps']
+WORDS = ['scientist', 'barney', 'hgrunt', 'zombie', 'headcrab', 'houndeye', 'bullsquid', 'gargantua', 'tentacle',
+         'crowbar', 'glock', 'shotgun', 'crossbow', 'satchel', 'gauss', 'egon', 'hornet', 'squeak', 'osprey', 'apache']
+# Overlay layers as (folder, fraction of the base file count, size multiplier, fraction of files that replace a base file)
+HL_LAYERS = [
+    ('valve_hd', 0.15, 2.0, 0.9),
+    ('STEP 4/valve', 0.25, 4.0, 0.8),
+    ('STEP 5/valve', 0.25, 4.0, 0.8),
+]
+# Files are carved out of this much random data so generating the tree isn't dominated by os.urandom
+RANDOM_POOL_SIZE = 16 * 1024 * 1024
+
+
+def fake_name(rng: random.Random, folder: str, ext: str, i: int, long_names: float) -> str:
+    # A Half-Life looking relative path, a fraction of them padded out to around the 56 char pak name limit
+    name = f'{rng.choice(WORDS)}{i}'
+    if rng.random() < 0.03 and ext == 'mdl' and folder == 'models':
+        name = f'v_{name}'  # Viewmodels get skipped by make_hl_pak
+    relpath = f'{folder}/{name}.{ext}'
+    if rng.random() < long_names:
+        target = rng.randint(MAX_PAK_NAME_LEN - 6, MAX_PAK_NAME_LEN + 4)
+        padding = '_'.join(rng.choice(WORDS) for _ in range(6))
+        relpath = f'{folder}/{name}_{padding}'[:max(target - len(ext) - 1, len(folder) + len(name) + 1)] + f'.{ext}'
+    return relpath
+
+
+def write_fake_file(path: Path, size: int, rng: random.Random, pool: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'wb') as f:
+        # Start each file with a unique header so files only come out identical when they're meant to
+        header = path.as_posix().encode()[-size:] if size else b''
+        f.write(header)
+        remaining = size - len(header)
+        while remaining > 0:
+            n = min(remaining, len(pool) // 2)
+            start = rng.randrange(len(pool) - n + 1)
+            f.write(pool[start:start + n])
+            remaining -= n
+
+
+def make_fake_hl_tree(root: Path, num_files: int, seed: int = 0, layers: bool = True, size_scale: float = 1.0, long_names: float = 0.05, duplicates: float = 0.02, max_file_size: int = 64 * 1024 * 1024, compressibility: float = 0.0) -> (Path, list):
+    # Generate a fake Half-Life install under root so builds can be timed without a real one.
+    # Makes a valve/ base with deep models/ and sound/ folders, then (with layers) valve_hd and the two AI upscale
+    # layers on top, which mostly replace base files with bigger ones. Returns (base folder, [overlay folders]).
+    # compressibility is the fraction of the data that only uses 16 byte values, so it gzips to about half like real
+    # sounds and 8 bit textures do. The rest is random and doesn't compress at all.
+    rng = random.Random(seed)
+    pool = rng.randbytes(RANDOM_POOL_SIZE)
+    if compressibility:
+        low = bytes(i & 15 for i in range(256))
+        block = 64 * 1024
+        pool = b''.join(pool[i:i + block].translate(low) if rng.random() < compressibility else pool[i:i + block] for i in range(0, len(pool), block))
+    base = root / 'valve'
+    relpaths = []
+    sizes = {}
+    seen = set()
+    for i in range(num_files):
+        folder, ext, mu, sigma = rng.choice(FILE_KINDS)
+        folder = folder.format(sound=rng.choice(SOUND_DIRS), name=rng.choice(WORDS))
+        relpath = fake_name(rng, folder, ext, i, long_names)
+        if relpath.lower() in seen:
+            continue
+        seen.add(relpath.lower())
+        size = min(int(rng.lognormvariate(mu, sigma) * size_scale), max_file_size)
+        if relpaths and rng.random() < duplicates:
+            # Same contents as an earlier file, e.g. a sound reused by two entities
+            copy_of = rng.choice(relpaths)
+            (base / relpath).parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(base / copy_of, base / relpath)
+            sizes[relpath] = sizes[copy_of]
+        else:
+            write_fake_file(base / relpath, size, rng, pool)
+            sizes[relpath] = size
+        relpaths.append(relpath)
+
+    # The loose files in the root of a game folder, and a couple of folders that stay empty
+    (base / 'liblist.gam').write_bytes(b'game "Half-Life"\ngamedll "dlls\\hl.dll"\n')
+    (base / 'gameinfo.txt').write_bytes(b'game "Half-Life"\n')
+    (base / 'config.cfg').write_bytes(b'sensitivity "3"\n' * 64)
+    for empty in ('save', 'logos', 'media/empty'):
+        (base / empty).mkdir(parents=True, exist_ok=True)
+
+    overlays = []
+    if layers:
+        for folder, fraction, multiplier, replace in HL_LAYERS:
+            layer = root / folder
+            for i in range(int(num_files * fraction)):
+                if rng.random() < replace:
+                    relpath = rng.choice(relpaths)
+                    size = sizes[relpath] * multiplier
+                else:
+                    folder_name, ext, mu, sigma = rng.choice(FILE_KINDS)
+                    folder_name = folder_name.format(sound=rng.choice(SOUND_DIRS), name=rng.choice(WORDS))
+                    relpath = fake_name(rng, folder_name, ext, num_files + i, long_names)
+                    size = rng.lognormvariate(mu, sigma) * size_scale * multiplier
+                write_fake_file(layer / relpath, min(int(size), max_file_size), rng, pool)
+            overlays.append(layer)
+    return base, overlays
+
+
+def tree_stats(paths: list) -> (int, int):
+    # Number of files and total bytes under the given folders
+    indexes = [TreeIndex(path) for path in paths]
+    return sum(len(index) for index in indexes), sum(index.total_bytes() for index in indexes)
+
+
+def drop_caches():
+    # Only works as root on Linux, otherwise the runs after the first will be served from the page cache
+    os.sync()
+    try:
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3\n')
+        return True
+    except OSError:
+        return False
+
+
+def hash_paks(out_path: Path) -> dict:
+    return {pak.name: hashlib.md5(pak.read_bytes()).hexdigest() for pak in sorted(out_path.glob('pak*.pak'))}
+
+
+def bench_jobs(args):
+    # Time the same build with different numbers of jobs, run it once per disk you want to compare (e.g. NVMe vs spinning)
+    work_dir = Path(args.dir)
+    src = work_dir / 'bench_src' / 'valve'
+    if not src.exists():
+        print(f'Generating {args.files} files in {src}...')
+        make_fake_hl_tree(src.parent, args.files, layers=False)
+
+    results = {}
+    reference = None
+    for jobs in [int(j) for j in args.jobs.split(',')]:
+        out_path = work_dir / 'bench_out' / f'jobs{jobs}'
+        if out_path.exists():
+            shutil.rmtree(out_path)
+        if args.drop_caches and not drop_caches():
+            print('Warning: could not drop the page cache, results will be warm-cache numbers.')
+
+        start = time.perf_counter()
+        make_hl_pak(src, out_path, max_chunk_size=args.max_chunk_size, use_tqdm=False, print_fcn=lambda *a: None, incremental=False, jobs=jobs)
+        results[jobs] = time.perf_counter() - start
+
+        # Parallel builds have to give exactly the same paks as a serial one
+        paks = hash_paks(out_path)
+        if reference is None:
+            reference = paks
+        elif paks != reference:
+            print(f'Error: output with --jobs {jobs} differs from the first run!')
+        shutil.rmtree(out_path)
+
+    baseline = next(iter(results.values()))
+    print(f'\nResults for {work_dir}:')
+    for jobs, seconds in results.items():
+        print(f'  jobs={jobs}: {seconds:.2f}s ({baseline / seconds:.2f}x)')
+
+
+def measure_build(base: Path, overlays: list, out_path: Path, max_chunk_size: int, max_chunk_bytes: int, jobs: int, dedup: bool) -> dict:
+    # Time a whole make_hl_pak from scratch along with each of its phases.
+    # Runs in a fresh process so the peak memory is just this build's.
+    metrics = BuildMetrics()
+    written = io_bytes_written()
+    start = time.perf_counter()
+    make_hl_pak(base, out_path, also_include_overwrites=overlays, max_chunk_size=max_chunk_size, max_chunk_bytes=max_chunk_bytes,
+                use_tqdm=False, print_fcn=lambda *a: None, incremental=False, jobs=jobs, dedup=dedup, metrics=metrics)
+    seconds = time.perf_counter() - start
+    written_after = io_bytes_written()
+    files, num_bytes = tree_stats([out_path])
+    return {
+        'seconds': seconds,
+        'files': files,
+        'bytes': num_bytes,
+        'bytes_per_second': num_bytes / seconds if seconds else None,
+        'disk_bytes_written': written_after - written if written is not None else None,
+        'peak_rss': peak_rss(),
+        'stages': metrics.summary(),
+    }
+
+
+def in_fresh_process(fcn: callable, *args):
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(fcn, *args).result()
+
+
+def bench_build(args):
+    # Build a generated Half-Life tree with all its overlay layers, timing each stage and the whole build.
+    # Results are saved as JSON so runs on different commits can be compared with the compare command.
+    work_dir = Path(args.dir)
+    tree_dir = work_dir / 'bench_hl'
+    params = {'files': args.files, 'seed': args.seed, 'size_scale': args.size_scale, 'layers': not args.no_layers}
+    params_path = tree_dir / 'tree.json'
+    if not params_path.exists() or json.loads(params_path.read_text()) != params:
+        shutil.rmtree(tree_dir, ignore_errors=True)
+        print(f'Generating a {args.files} file Half-Life tree in {tree_dir}...')
+        make_fake_hl_tree(tree_dir, args.files, seed=args.seed, layers=params['layers'], size_scale=args.size_scale)
+        params_path.write_text(json.dumps(params))
+    base = tree_dir / 'valve'
+    overlays = [tree_dir / folder for folder, *_ in HL_LAYERS] if params['layers'] else []
+    num_files, num_bytes = tree_stats([base] + overlays)
+    print(f'Source tree: {num_files} files, {format_size(num_bytes)} in {1 + len(overlays)} layers.')
+
+    max_chunk_bytes = args.max_chunk_bytes or MAX_BYTES_PER_PAK
+    build_args = (args.max_chunk_size, max_chunk_bytes, args.jobs, args.dedup)
+    runs = []
+    out_path = work_dir / 'bench_out' / 'valve'
+    for run in range(args.runs):
+        shutil.rmtree(out_path, ignore_errors=True)
+        if args.drop_caches and not drop_caches():
+            print('Warning: could not drop the page cache, results will be warm-cache numbers.')
+        result = in_fresh_process(measure_build, base, overlays, out_path, *build_args)
+        shutil.rmtree(out_path, ignore_errors=True)
+        runs.append(result)
+        stages = ', '.join(f'{name} {stage["seconds"]:.2f}s' for name, stage in result['stages'].items())
+        print(f'Run {run + 1}/{args.runs}: build {result["seconds"]:.2f}s ({stages})')
+
+    summary = {name: statistics.median(run['stages'][name]['seconds'] for run in runs) for name in runs[0]['stages']}
+    summary['build'] = statistics.median(run['seconds'] for run in runs)
+    results = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'params': dict(params, max_chunk_size=args.max_chunk_size, max_chunk_bytes=max_chunk_bytes, jobs=args.jobs, dedup=args.dedup, drop_caches=args.drop_caches),
+        'tree': {'files': num_files, 'bytes': num_bytes},
+        'runs': runs,
+        'summary': {
+            'seconds': summary,
+            'peak_rss': max(run['peak_rss'] or 0 for run in runs) or None,
+            'build_bytes_per_second': statistics.median(run['bytes_per_second'] for run in runs),
+        },
+    }
+
+    output = Path(args.output) if args.output else work_dir / f'build-{datetime.now():%Y%m%d-%H%M%S}.json'
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=1))
+
+    print(f'\nMedian of {args.runs} run(s):')
+    for name, seconds in summary.items():
+        print(f'  {name}: {seconds:.3f}s')
+    print(f'  throughput: {format_size(results["summary"]["build_bytes_per_second"])}/s')
+    if results['summary']['peak_rss']:
+        print(f'  peak RSS: {format_size(results["summary"]["peak_rss"])}')
+    print(f'Saved results to {output}')
+
+
+def bench_compare(args):
+    # Compare the median stage times of two build results, fails if anything got slower by more than the threshold
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    if baseline['params'] != current['params']:
+        print('Warning: the two results were made with different settings, the comparison may not mean much.')
+
+    regressions = []
+    print(f'{"stage":<16}{"baseline":>12}{"current":>12}{"change":>10}')
+    for name, old in baseline['summary']['seconds'].items():
+        new = current['summary']['seconds'].get(name)
+        if new is None:
+            continue
+        change = (new - old) / old if old else 0.0
+        # Tiny stages are mostly noise, so they also have to be slower by a noticeable amount of time
+        regressed = change > args.threshold and new - old > args.min_seconds
+        if regressed:
+            regressions.append(name)
+        print(f'{name:<16}{old:>11.3f}s{new:>11.3f}s{change:>+10.0%}{"  REGRESSION" if regressed else ""}')
+
+    old_rss, new_rss = baseline['summary'].get('peak_rss'), current['summary'].get('peak_rss')
+    if old_rss and new_rss:
+        change = (new_rss - old_rss) / old_rss
+        regressed = change > args.threshold
+        if regressed:
+            regressions.append('peak_rss')
+        print(f'{"peak RSS":<16}{format_size(old_rss):>12}{format_size(new_rss):>12}{change:>+10.0%}{"  REGRESSION" if regressed else ""}')
+
+    if regressions:
+        print(f'Error: {", ".join(regressions)} regressed by more than {args.threshold:.0%}.')
+        exit(1)
+
+
+class LocalDevice:
+    # Stands in for a headset: its /sdcard is a folder on this computer, shell commands run locally and every byte that
+    # goes "over USB" is slowed down to bandwidth bytes per second. Each adb push also waits file_latency seconds, which
+    # is what the sync protocol's per-file round trips cost. Needs a Unix shell with find, stat, md5sum and tar.
+
+    def __init__(self, root: Path, bandwidth: float, file_latency: float):
+        self.serial = 'local'
+        self.sdcard = str(root / 'sdcard')
+        self.bandwidth = bandwidth
+        self.file_latency = file_latency
+        self.bytes_sent = 0
+
+    def _local(self, text: str) -> str:
+        return text.replace('/sdcard', self.sdcard)
+
+    def shell(self, command: str) -> str:
+        output = subprocess.run(['sh', '-c', self._local(command)], capture_output=True, text=True).stdout
+        return output.replace(self.sdcard, '/sdcard')
+
+    def _send(self, num_bytes: int, start: float):
+        # Sleep until the link would have carried num_bytes more since start
+        self.bytes_sent += num_bytes
+        time.sleep(max(0.0, start + num_bytes / self.bandwidth - time.perf_counter()))
+
+    def push(self, local: str, remote: str):
+        start = time.perf_counter()
+        time.sleep(self.file_latency)
+        shutil.copyfile(local, self._local(remote))
+        self._send(os.path.getsize(local), start)
+
+    def shell_with_stdin(self, command: str) -> subprocess.Popen:
+        time.sleep(self.file_latency)
+        process = subprocess.Popen(['sh', '-c', self._local(command)], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        process.stdin = _ThrottledPipe(process.stdin, self)
+        return process
+
+
+class _ThrottledPipe:
+    # The stdin of a LocalDevice command, written no faster than the device's bandwidth
+    def __init__(self, f, device: LocalDevice):
+        self.f = f
+        self.device = device
+        self.start = None
+        self.written = 0
+
+    def write(self, data) -> int:
+        if self.start is None:
+            self.start = time.perf_counter()
+        self.f.write(data)
+        # Keep to the bandwidth over the whole stream, sleeping after every small write would add up to too much
+        self.written += len(data)
+        self.device.bytes_sent += len(data)
+        time.sleep(max(0.0, self.start + self.written / self.device.bandwidth - time.perf_counter()))
+        return len(data)
+
+    def close(self):
+        self.f.close()
+
+
+def bench_push(args):
+    # Push the same built game folder to empty LocalDevices with each transfer mode and compare the times.
+    # Only the link is simulated, the tar and gzip work is real, so it shows when compressing pays off for a given speed.
+    import adb_util
+    # Send the tar streams to the stand-in instead of a real adb, and let auto compression know how fast its link is
+    adb_util.shell_with_stdin = lambda device, command: device.shell_with_stdin(command)
+    adb_util.LINK_BYTES_PER_SECOND = args.bandwidth
+
+    work_dir = Path(args.dir)
+    tree_dir = work_dir / 'bench_push'
+    out_path = tree_dir / 'xash' / 'valve'
+    params = {'files': args.files, 'seed': args.seed, 'size_scale': args.size_scale, 'compressibility': args.compressibility}
+    params_path = tree_dir / 'tree.json'
+    if not params_path.exists() or json.loads(params_path.read_text()) != params:
+        shutil.rmtree(tree_dir, ignore_errors=True)
+        print(f'Generating and building a {args.files} file game folder in {tree_dir}...')
+        base, overlays = make_fake_hl_tree(tree_dir / 'src', args.files, seed=args.seed, size_scale=args.size_scale, compressibility=args.compressibility)
+        make_hl_pak(base, out_path, also_include_overwrites=overlays, use_tqdm=False, print_fcn=lambda *a: None, incremental=False)
+        params_path.write_text(json.dumps(params))
+    local_index = TreeIndex(out_path)
+    print(f'Game folder: {len(local_index)} files, {format_size(local_index.total_bytes())}, '
+          f'link: {format_size(args.bandwidth)}/s with {args.file_latency * 1000:.0f}ms per file.')
+
+    results = {}
+    for mode in args.modes.split(','):
+        transfer, _, compression = mode.partition(':')
+        device_root = work_dir / 'bench_device'
+        shutil.rmtree(device_root, ignore_errors=True)
+        (device_root / 'sdcard').mkdir(parents=True)
+        device = LocalDevice(device_root, args.bandwidth, args.file_latency)
+        metrics = BuildMetrics()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            adb_util.sync_folder(device, out_path, Path('/sdcard/xash/valve'), metrics=metrics, transfer=transfer, compression=compression or 'auto')
+        seconds = time.perf_counter() - start
+
+        # Every mode has to leave the same files on the device
+        pushed = TreeIndex(device_root / 'sdcard' / 'xash' / 'valve')
+        if sorted(pushed.files) != sorted(local_index.files) or any(adb_util.local_md5(file.path) != adb_util.local_md5(pushed.files[rel].path) for rel, file in local_index.files.items()):
+            print(f'Error: {mode} left different files on the device!')
+        results[mode] = (seconds, device.bytes_sent)
+        shutil.rmtree(device_root)
+
+    baseline = next(iter(results.values()))[0]
+    print(f'{"mode":<12}{"seconds":>10}{"speedup":>10}{"over link":>12}')
+    for mode, (seconds, sent) in results.items():
+        print(f'{mode:<12}{seconds:>10.2f}{baseline / seconds:>9.2f}x{format_size(sent):>12}')
+
+
+# Modules that should only be loaded once a command actually needs them
+HEAVY_MODULES = ['requests', 'ppadb', 'tqdm', 'pak_util', 'adb_util']
+
+
+def bench_startup(args):
+    # Time how long the CLI takes to get going for commands that shouldn't load the pak builder or the adb/network stack.
+    # Pass --exe to time a frozen PyInstaller build instead of the source.
+    base_cmd = [args.exe] if args.exe else [sys.executable, str(Path(__file__).parent / 'cli.py')]
+    failed = False
+    for cli_args in (['--help'], ['--show-presets']):
+        times = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            subprocess.run(base_cmd + cli_args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            times.append(time.perf_counter() - start)
+        median = statistics.median(times)
+        ok = median <= args.budget
+        failed |= not ok
+        print(f'  {" ".join(cli_args)}: median {median * 1000:.0f}ms, best {min(times) * 1000:.0f}ms ({"ok" if ok else "OVER BUDGET"})')
+
+    if not args.exe:
+        # Importing the CLI on its own shouldn't pull in anything heavy
+        code = 'import sys, cli; print(",".join(sorted({m.split(".")[0] for m in sys.modules})))'
+        loaded = subprocess.run([sys.executable, '-c', code], cwd=Path(__file__).parent, capture_output=True, text=True, check=True).stdout.strip().split(',')
+        heavy = [module for module in HEAVY_MODULES if module in loaded]
+        if heavy:
+            print(f'Error: importing cli.py loads {", ".join(heavy)}')
+            failed = True
+
+    print(f'Budget: {args.budget * 1000:.0f}ms')
+    if failed:
+        exit(1)
+
+
+def main():
+    parser = ArgumentParser(description='Benchmarks for hl-paker.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    jobs_parser = subparsers.add_parser('jobs', help='Compare pak build times for different --jobs values.')
+    jobs_parser.add_argument('--dir', default='bench_work', help='Working directory, put it on the disk you want to measure.')
+    jobs_parser.add_argument('--files', default=20000, type=int, help='Number of files in the generated tree.')
+    jobs_parser.add_argument('--max_chunk_size', default=3900, type=int, help='Max number of files per pak file.')
+    jobs_parser.add_argument('--jobs', default='1,2,4,8', help='Comma separated list of job counts to try.')
+    jobs_parser.add_argument('--drop_caches', action='store_true', help='Drop the page cache before each run (Linux, needs root).')
+    jobs_parser.set_defaults(func=bench_jobs)
+
+    startup_parser = subparsers.add_parser('startup', help='Check that --help and --show-presets start within a time budget.')
+    startup_parser.add_argument('--exe', help='Time this frozen build (e.g. dist/cli.exe) instead of running cli.py with this Python.')
+    startup_parser.add_argument('--runs', default=10, type=int, help='Number of times to run each command.')
+    startup_parser.add_argument('--budget', default=0.5, type=float, help='Max median startup time in seconds.')
+    startup_parser.set_defaults(func=bench_startup)
+
+    build_parser = subparsers.add_parser('build', help='Time each stage of a build of a generated Half-Life tree and save the results as JSON.')
+    build_parser.add_argument('--dir', default='bench_work', help='Working directory, put it on the disk you want to measure.')
+    build_parser.add_argument('--files', default=20000, type=int, help='Number of files in the generated valve folder, the overlay layers add more.')
+    build_parser.add_argument('--size_scale', default=1.0, type=float, help='Multiply every generated file size by this.')
+    build_parser.add_argument('--seed', default=0, type=int, help='Random seed for the generated tree.')
+    build_parser.add_argument('--no_layers', action='store_true', help='Only generate valve, without the HD and AI upscale layers on top.')
+    build_parser.add_argument('--max_chunk_size', default=3900, type=int, help='Max number of files per pak file.')
+    build_parser.add_argument('--max_chunk_bytes', default=None, type=parse_size, help='Max size of each pak file, e.g. 1500M.')
+    build_parser.add_argument('--jobs', default=1, type=int, help='Number of pak files to build at the same time.')
+    build_parser.add_argument('--dedup', action='store_true', help='Build with deduplication on.')
+    build_parser.add_argument('--runs', default=3, type=int, help='Number of times to run the build.')
+    build_parser.add_argument('--drop_caches', action='store_true', help='Drop the page cache before each run (Linux, needs root).')
+    build_parser.add_argument('--output', help='Where to save the results. Defaults to a timestamped file in --dir.')
+    build_parser.set_defaults(func=bench_build)
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two results from the build command and fail on regressions.')
+    compare_parser.add_argument('baseline', help='Results to compare against.')
+    compare_parser.add_argument('current', help='New results.')
+    compare_parser.add_argument('--threshold', default=0.1, type=float, help='Fail if a stage is slower by more than this fraction.')
+    compare_parser.add_argument('--min_seconds', default=0.05, type=float, help='Ignore slowdowns smaller than this many seconds.')
+    compare_parser.set_defaults(func=bench_compare)
+
+    push_parser = subparsers.add_parser('push', help='Compare adb push with the tar stream transfer modes on a simulated headset.')
+    push_parser.add_argument('--dir', default='bench_work', help='Working directory.')
+    push_parser.add_argument('--files', default=5000, type=int, help='Number of files in the generated valve folder, the overlay layers add more.')
+    push_parser.add_argument('--size_scale', default=1.0, type=float, help='Multiply every generated file size by this.')
+    push_parser.add_argument('--seed', default=0, type=int, help='Random seed for the generated tree.')
+    push_parser.add_argument('--compressibility', default=0.5, type=float, help='Fraction of the generated data that compresses (to about half).')
+    push_parser.add_argument('--bandwidth', default='40M', type=parse_size, help='Simulated USB link speed per second, e.g. 40M for USB 2.')
+    push_parser.add_argument('--file_latency', default=0.01, type=float, help='Simulated round trip cost of each adb push in seconds.')
+    push_parser.add_argument('--modes', default='sync,tar,tar:none,tar:gzip', help='Comma separated transfer[:compression] modes, the first is the baseline.')
+    push_parser.set_defaults(func=bench_push)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
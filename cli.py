@@ -1,5 +1,6 @@
+import sys
+import json
 from pathlib import Path
-from pak_util import make_hl_pak
 from argparse import ArgumentParser
 
 from presets import presets, search_for_halflife
@@ -12,53 +13,329 @@ def show_presets():
         print(f'{key}: {value["description"]}\n')
 
 
+def parse_size(value: str) -> int:
+    # Turn a size like 1500M or 1.5G into a number of bytes
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def list_paks(args):
+    # List every entry in a pak file or a folder of pak files
+    from pak_util import open_pak_set
+    for archive in open_pak_set(args.path):
+        with archive:
+            dead = archive.dead_bytes()
+            print(f'{archive.pakfilename} ({len(archive)} files, {archive.size} bytes{f", {dead} unused" if dead else ""})')
+            for name, (offset, length) in archive.entries.items():
+                print(f'  {length:>10}  {name}')
+
+
+def cat_pak(args):
+    # Write a single member to stdout, using the highest numbered pak that has it
+    from pak_util import open_pak_set, resolve_pak_set
+    archives = open_pak_set(args.path)
+    archive = resolve_pak_set(archives).get(args.member)
+    if archive is None:
+        print(f'Error: {args.member} not found in {args.path}.', file=sys.stderr)
+        exit(1)
+    with archive.read(args.member) as data:
+        sys.stdout.buffer.write(data)
+    for archive in archives:
+        archive.close()
+
+
+def extract_paks(args):
+    # Extract the whole set (or just the given members) into a folder
+    from pak_util import open_pak_set, resolve_pak_set
+    archives = open_pak_set(args.path)
+    resolved = resolve_pak_set(archives)
+    members = args.members or list(resolved)
+    missing = [name for name in members if name not in resolved]
+    if missing:
+        print(f'Error: not found in {args.path}: {", ".join(missing)}', file=sys.stderr)
+        exit(1)
+    for archive in archives:
+        names = [name for name in members if resolved[name] is archive]
+        if names:
+            print(f'Extracting {len(names)} files from {archive.pakfilename}...')
+            archive.extract(args.dest, names, jobs=args.jobs)
+        archive.close()
+    print(f'Extracted {len(members)} files to {args.dest}')
+
+
+def verify_paks(args):
+    # Check every pak in the set, and check the contents against the build manifest if there is one
+    from pak_util import open_pak_set, manifest_path_for, data_matches_hash
+    path = Path(args.path)
+    archives = open_pak_set(path)
+    if not archives:
+        print(f'Error: no pak files found in {path}.')
+        exit(1)
+
+    errors = []
+    for archive in archives:
+        errors += [f'{archive.pakfilename.name}: {error}' for error in archive.verify()]
+
+    manifest_path = manifest_path_for(path)
+    if path.is_dir() and manifest_path.exists():
+        print(f'Checking contents against {manifest_path}...')
+        by_name = {archive.pakfilename.name: archive for archive in archives}
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        for name, record in manifest['files'].items():
+            # Files in a patch pak are checked there, the copy in their full pak is an older one
+            pak = record.get('patch') or record['pak']
+            if not pak:
+                continue
+            archive = by_name.get(pak)
+            if archive is None or name not in archive:
+                errors.append(f'{pak}: missing {name}')
+                continue
+            with archive.read(name) as data:
+                # New files are only recorded with their size until a later build has a reason to hash them
+                matches = data_matches_hash(data, record['hash']) if record['hash'] else len(data) == record['size']
+            if not matches:
+                errors.append(f'{pak}: {name} does not match its source {record["source"]}')
+
+    for archive in archives:
+        archive.close()
+    for error in errors:
+        print(f'  Error: {error}')
+    if errors:
+        print(f'Found {len(errors)} problems in {path}.')
+        exit(1)
+    print(f'{path} looks good ({len(archives)} pak files).')
+
+
+def update_pak_file(args):
+    # Add or replace files in an existing pak from a folder laid out like the game folder, and remove others
+    from pak_util import update_pak, format_size
+    from path_util import TreeIndex
+    source = Path(args.source) if args.source else None
+    if source is None and args.members:
+        print('Error: files to add need a source folder.', file=sys.stderr)
+        exit(1)
+    files = {}
+    if source is not None:
+        index = TreeIndex(source)
+        for name in args.members or sorted(index.files):
+            name = name.replace('\\', '/')
+            if name not in index:
+                print(f'Error: {source / name} does not exist.', file=sys.stderr)
+                exit(1)
+            files[name] = index.get(name).path
+    stats = update_pak(args.pak, files, remove=args.remove or (), dedup=args.dedup)
+    print(f'{args.pak}: added {stats["added"]}, replaced {stats["replaced"]}, removed {stats["removed"]} files, wrote {format_size(stats["bytes"])}.')
+    if stats['dead_bytes']:
+        print(f'{format_size(stats["dead_bytes"])} of {format_size(stats["size"])} is no longer used, run compact to reclaim it.')
+
+
+def compact_paks(args):
+    # Rewrite a pak (or every pak in a folder) without the space left behind by updates
+    from pak_util import open_pak_set, compact_pak, format_size
+    archives = open_pak_set(args.path)
+    pak_paths = [archive.pakfilename for archive in archives]
+    for archive in archives:
+        archive.close()
+    if not pak_paths:
+        print(f'Error: no pak files found in {args.path}.')
+        exit(1)
+    total = 0
+    for pak_path in pak_paths:
+        reclaimed = compact_pak(pak_path)
+        total += reclaimed
+        print(f'{pak_path.name}: reclaimed {format_size(reclaimed)}' if reclaimed else f'{pak_path.name}: nothing to reclaim')
+    print(f'Reclaimed {format_size(total)} in {len(pak_paths)} pak files.')
+
+
+def preset_folders(preset: dict) -> list:
+    # Every folder a preset reads from, relative to the Half-Life directory
+    return [preset['base_folder']] + (preset['also_include_overwrites'] or [])
+
+
+def resolve_presets(value: str, base_path: Path) -> list:
+    # Turn --preset (a name, a comma separated list, or "all") into a list of preset names, None if it doesn't work.
+    # "all" is every preset that has all of its folders installed.
+    from path_util import rewrite_path_for_os
+    if value == 'all':
+        names = [name for name, preset in presets.items() if all(rewrite_path_for_os(base_path / folder).exists() for folder in preset_folders(preset))]
+        if not names:
+            print(f'Error: No presets have all of their folders in {base_path}.')
+        return names
+
+    names = list(dict.fromkeys(name.strip() for name in value.split(',') if name.strip()))
+    unknown = [name for name in names if name not in presets]
+    if unknown:
+        print(f'Error: Preset {", ".join(unknown)} not found.')
+        show_presets()
+        return None
+    return names
+
+
+def build_preset(name: str, base_path: Path, out_root: Path, build_options: dict, print_fcn: callable=print, **shared) -> Path:
+    # Build one preset into out_root/<game>, returns the output path
+    from pak_util import make_hl_pak
+    preset = presets[name]
+    game_path = base_path / preset['base_folder']
+    also_include = [base_path / new_folder for new_folder in preset['also_include_overwrites']] if preset['also_include_overwrites'] else None
+    out_path = out_root / preset['base_folder']
+    ignore_files = preset.get('ignore_files', None)
+    print_fcn(f'Game path: {game_path}')
+    print_fcn(f'Also include: {also_include}')
+    print_fcn(f'Out path: {out_path}')
+    make_hl_pak(game_path, out_path, also_include_overwrites=also_include, ignore_files=ignore_files, print_fcn=print_fcn, **build_options, **shared)
+    return out_path
+
+
+def write_commandline(name: str, out_path: Path):
+    commandline = presets[name].get('commandline', None)
+    if commandline:
+        # Write out commandline.txt to the output directory
+        commandline_path = out_path.parent / 'commandline.txt'
+        print(f'Writing commandline to {commandline_path}...')
+        with open(commandline_path, 'w') as f:
+            f.write(commandline)
+
+
+def build_presets(names: list, base_path: Path, out_folder: str, build_options: dict, io_jobs: int=2) -> bool:
+    # Build several presets at once. Each one goes into its own out_folder/<preset> folder with its own commandline.txt,
+    # so presets for the same game don't overwrite each other, and that folder is what goes in /sdcard/xash/.
+    # The source folders are only walked once however many presets read them, and at most io_jobs of the presets
+    # hash or write pak files at the same time so they don't fight over the disk. Returns False if any failed.
+    if len(names) == 1:
+        write_commandline(names[0], build_preset(names[0], base_path, base_path / out_folder, build_options))
+        return True
+
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from path_util import TreeIndexCache
+    shared = {'index_cache': TreeIndexCache(), 'io_slots': threading.Semaphore(max(1, io_jobs)), 'use_tqdm': False}
+    print(f'Building {len(names)} presets: {", ".join(names)}')
+    with ThreadPoolExecutor(max_workers=len(names)) as executor:
+        futures = {}
+        for name in names:
+            print_fcn = lambda text, name=name: print(f'[{name}] {text}')
+            futures[name] = executor.submit(build_preset, name, base_path, base_path / out_folder / name, build_options, print_fcn, **shared)
+
+    failed = []
+    for name, future in futures.items():
+        try:
+            write_commandline(name, future.result())
+        except Exception as e:
+            print(f'Error: {name} failed: {e}')
+            failed.append(name)
+    print(f'Built {len(names) - len(failed)}/{len(names)} presets, each in its own folder in {base_path / out_folder}.')
+    return not failed
+
+
+def save_metrics(metrics, args):
+    # Print the build phases and write them out if --metrics or --trace was given
+    if metrics is None:
+        return
+    metrics.print_summary()
+    if args.metrics:
+        metrics.save(args.metrics)
+    if args.trace:
+        metrics.save(args.trace, chrome_trace=True)
+
+
 def main():
     # Create ArgumentParser object
     parser = ArgumentParser(description='Create pak files from Half-Life directory.')
-    parser.add_argument('--preset', help='Preset to use. If not using a preset, must specify game_path and also_include if desired.')
+    parser.add_argument('--preset', help='Preset to use, several comma separated presets (e.g. hl_hd,blueshift_hd,opfor_hd), or "all" for every preset whose folders are installed. With more than one, each preset is built into its own folder in out_path. If not using a preset, must specify game_path and also_include if desired.')
     parser.add_argument('--game_path', help='Path to game directory to create pak files for if not using a preset. For example, for Half-Life this would be the full path to Half-Life\\valve.')
-    parser.add_argument('--hl_base_path', default=search_for_halflife(), help='Path to base Half-Life directory (one dir up from \\valve\). Will search for Half-Life directory if not specified.')
+    parser.add_argument('--hl_base_path', help='Path to base Half-Life directory (one dir up from \\valve\\). Will search for Half-Life directory if not specified.')
     parser.add_argument('--max_chunk_size', default=3900, help='Max number of files per pak file.', type=int)
+    parser.add_argument('--max_chunk_bytes', default=None, help='Max size of each pak file, e.g. 1500M or 1G. Defaults to the 2 GiB limit of the pak format.', type=parse_size)
     parser.add_argument('--also_include', action='append', help='Folders to also include in pak files.')
     parser.add_argument('--verbose', action='store_true', help='Print verbose output.')
+    parser.add_argument('--jobs', default=1, help='Number of pak files to build at the same time.', type=int)
+    parser.add_argument('--io_jobs', default=2, help='When building several presets, how many of them can hash files or write pak files at the same time.', type=int)
+    parser.add_argument('--dedup', action='store_true', help='Store files with identical contents only once per pak file.')
+    parser.add_argument('--prune', action='store_true', help='Leave out models, sounds, wads and skies that no map, model or the game code uses. Writes a report of what was left out next to the output folder.')
+    parser.add_argument('--prune_keep', action='append', default=[], help='Glob pattern of files to always keep when pruning, e.g. "models/custom/*". Can be given more than once.')
+    parser.add_argument('--patch', action='store_true', help='Leave the paks from the last build alone and put only the files that changed in a new, higher numbered pak.')
+    parser.add_argument('--patch_rollup', default=0.25, type=float, help='With --patch, rewrite the full paks instead once the patch paks add up to more than this fraction of them.')
+    parser.add_argument('--clean', action='store_true', help='Rebuild every pak file from scratch instead of only the ones whose sources changed since the last build.')
     parser.add_argument('--out_path', default='xash', help='Output directory for pak files relative to hl_base_path. Defaults to \\xash in the Half-Life directory.')
     parser.add_argument('--show-presets', action='store_true', help='Show available presets and exit.')
+    parser.add_argument('--metrics', help='Print the time, files and bytes of each build phase and save them to this JSON file.')
+    parser.add_argument('--trace', help='Save the build phases as a Chrome trace (open it in chrome://tracing or ui.perfetto.dev).')
+
+    # Commands for looking inside pak files that have already been built
+    subparsers = parser.add_subparsers(dest='command', title='pak commands')
+    list_parser = subparsers.add_parser('list', help='List the files in a pak file or a folder of pak files.')
+    list_parser.add_argument('path', help='A pak file, or a folder like xash/valve containing pak0.pak, pak1.pak, etc.')
+    list_parser.set_defaults(func=list_paks)
+    cat_parser = subparsers.add_parser('cat', help='Write a file from inside the paks to stdout.')
+    cat_parser.add_argument('path', help='A pak file or a folder of pak files.')
+    cat_parser.add_argument('member', help='Name of the file inside the pak, e.g. models/player.mdl')
+    cat_parser.set_defaults(func=cat_pak)
+    extract_parser = subparsers.add_parser('extract', help='Extract files from a pak file or a folder of pak files.')
+    extract_parser.add_argument('path', help='A pak file or a folder of pak files.')
+    extract_parser.add_argument('dest', help='Folder to extract into.')
+    extract_parser.add_argument('members', nargs='*', help='Files to extract. Extracts everything if not specified.')
+    extract_parser.add_argument('--jobs', default=4, type=int, help='Number of files to extract at the same time.')
+    extract_parser.set_defaults(func=extract_paks)
+    verify_parser = subparsers.add_parser('verify', help='Check a pak file or a folder of pak files for problems.')
+    verify_parser.add_argument('path', help='A pak file or a folder of pak files.')
+    verify_parser.set_defaults(func=verify_paks)
+    update_parser = subparsers.add_parser('update', help='Add, replace or remove files in an existing pak file without rebuilding it.')
+    update_parser.add_argument('pak', help='The pak file to update, e.g. xash/valve/pak1.pak')
+    update_parser.add_argument('source', nargs='?', help='Folder laid out like the game folder to take the new files from.')
+    update_parser.add_argument('members', nargs='*', help='Files in source to add, e.g. models/player.mdl. Adds everything in source if not specified.')
+    update_parser.add_argument('--remove', action='append', help='Name of a file to remove from the pak, can be given more than once.')
+    update_parser.add_argument('--dedup', action='store_true', help='Store new files with identical contents only once.')
+    update_parser.set_defaults(func=update_pak_file)
+    compact_parser = subparsers.add_parser('compact', help='Reclaim the space left behind in pak files by update.')
+    compact_parser.add_argument('path', help='A pak file or a folder of pak files.')
+    compact_parser.set_defaults(func=compact_paks)
     args = parser.parse_args()
 
+    if args.command:
+        args.func(args)
+        return
+
     # If show-presets was specified, show the presets and exit
     if args.show_presets:
         show_presets()
         return
-    
+
+    # Only go looking for Half-Life when it's needed and wasn't given
+    if args.hl_base_path is None:
+        args.hl_base_path = search_for_halflife()
+        if args.hl_base_path is None:
+            print('Error: Unable to find the Half-Life directory, pass it with --hl_base_path.')
+            exit(1)
+
+    # Only load the pak builder once we know there's something to build, so --help and --show-presets start quickly
+    from pak_util import make_hl_pak, MAX_BYTES_PER_PAK
     max_chunk_size = args.max_chunk_size
     verbose = args.verbose
+    incremental = not args.clean
+    jobs = args.jobs
+    max_chunk_bytes = args.max_chunk_bytes or MAX_BYTES_PER_PAK
+    dedup = args.dedup
+    metrics = None
+    if args.metrics or args.trace:
+        from metrics_util import BuildMetrics
+        metrics = BuildMetrics()
+
+    build_options = {'max_chunk_size': max_chunk_size, 'verbose': verbose, 'incremental': incremental, 'jobs': jobs, 'max_chunk_bytes': max_chunk_bytes, 'dedup': dedup, 'metrics': metrics, 'prune': args.prune, 'prune_keep': args.prune_keep, 'patch': args.patch, 'patch_rollup': args.patch_rollup}
 
     # If a preset was specified, use that
     if args.preset:
-        if args.preset not in presets:
-            print(f'Error: Preset {args.preset} not found.')
-            show_presets()
-            return
-        
         base_path = Path(args.hl_base_path)
+        names = resolve_presets(args.preset, base_path)
+        if not names:
+            return
         print(f'Base path: {base_path}')
-        
-        preset = presets[args.preset]
-        game_path = base_path / preset['base_folder']
-        also_include = [base_path / new_folder for new_folder in preset['also_include_overwrites']] if preset['also_include_overwrites'] else None
-        out_path = base_path / args.out_path / preset['base_folder']
-        ignore_files = preset.get('ignore_files', None)
-        print(f'Game path: {game_path}')
-        print(f'Also include: {also_include}')
-        print(f'Out path: {out_path}')
-        make_hl_pak(game_path, out_path, also_include_overwrites=also_include, max_chunk_size=max_chunk_size, verbose=verbose, ignore_files=ignore_files)
-        commandline = preset.get('commandline', None)
-        if commandline:
-            # Write out commandline.txt to the output directory
-            commandline_path = out_path.parent / 'commandline.txt'
-            print(f'Writing commandline to {commandline_path}...')
-            with open(commandline_path, 'w') as f:
-                f.write(commandline)
+        if not build_presets(names, base_path, args.out_path, build_options, io_jobs=args.io_jobs):
+            exit(1)
+        save_metrics(metrics, args)
         return
     
     # If a preset was not specified, use the game_path and also_include arguments
@@ -71,10 +348,10 @@ def main():
         print(f'Error: {game_path} does not exist.')
         return
     
-    also_include = args.also_include
-    also_include = [base_path / new_folder for new_folder in preset['also_include_overwrites']] if preset['also_include_overwrites'] else None
-    out_path = args.hl_base_path / args.out_path / game_path.name
-    make_hl_pak(game_path, out_path, also_include_overwrites=also_include, max_chunk_size=max_chunk_size, verbose=verbose)
+    also_include = [Path(new_folder) for new_folder in args.also_include] if args.also_include else None
+    out_path = Path(args.hl_base_path) / args.out_path / game_path.name
+    make_hl_pak(game_path, out_path, also_include_overwrites=also_include, **build_options)
+    save_metrics(metrics, args)
     return
 
 if __name__ == '__main__':
@@ -0,0 +1,207 @@
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlsplit, unquote
+
+from presets import CACHE_DIR, tqdm_available, progress
+from metrics_util import phase
+
+
+# Chunk size starts small so progress shows up quickly, then grows while the connection keeps up
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+# Aim for roughly this many seconds per chunk when adapting the chunk size
+TARGET_CHUNK_SECONDS = 0.25
+# How many times a dropped connection is resumed before giving up
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_TIMEOUT = 30
+# How many different artifacts to download at the same time
+DEFAULT_FETCH_JOBS = 4
+
+# One lock per cached artifact so two devices asking for the same APK don't write the same .part file
+_locks_lock = threading.Lock()
+_locks = {}
+
+
+class ChecksumError(Exception):
+    pass
+
+
+def artifact_path(url: str, sha256: str=None, cache_dir: Path=None) -> Path:
+    # Keyed by the URL and the expected hash, so a changed hash in presets.py never reuses a stale file
+    cache_dir = Path(cache_dir) if cache_dir is not None else CACHE_DIR / 'downloads'
+    key = hashlib.sha256(f'{url}\n{(sha256 or "").lower()}'.encode('utf-8')).hexdigest()[:16]
+    filename = unquote(urlsplit(url).path.rstrip('/').split('/')[-1]) or 'download'
+    return cache_dir / key / filename
+
+
+def sidecar_path(path: Path) -> Path:
+    return path.with_name(path.name + '.sha256')
+
+
+def is_cached(url: str, sha256: str=None, cache_dir: Path=None) -> bool:
+    path = artifact_path(url, sha256, cache_dir)
+    return path.exists() and sidecar_path(path).exists()
+
+
+def hash_file(path: Path, digest=None):
+    digest = digest or hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(MAX_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest
+
+
+def _lock_for(path: Path) -> threading.Lock:
+    with _locks_lock:
+        return _locks.setdefault(str(path), threading.Lock())
+
+
+def _next_chunk_size(chunk_size: int, seconds: float) -> int:
+    if seconds < TARGET_CHUNK_SECONDS / 2:
+        return min(chunk_size * 2, MAX_CHUNK_SIZE)
+    if seconds > TARGET_CHUNK_SECONDS * 2:
+        return max(chunk_size // 2, MIN_CHUNK_SIZE)
+    return chunk_size
+
+
+def _download_part(url: str, part_path: Path, digest, session, use_tqdm: bool, metrics=None):
+    # Append whatever is still missing to part_path and return the digest of the whole file so far.
+    # Cancelling through metrics stops it between chunks, and the .part file is resumed next time.
+    import requests
+    import urllib3
+    have = part_path.stat().st_size if part_path.exists() else 0
+    headers = {'Range': f'bytes={have}-'} if have else {}
+    with session.get(url, stream=True, headers=headers, timeout=DOWNLOAD_TIMEOUT) as r:
+        if r.status_code == 416:
+            # Nothing left to send. That only means the .part file is complete if it's exactly as long as the file,
+            # a longer one (or the file changing on the server) needs starting over.
+            content_range = r.headers.get('Content-Range', '')
+            if content_range.startswith('bytes */') and content_range[len('bytes */'):].strip() == str(have):
+                return digest
+            r.close()
+            part_path.unlink()
+            return _download_part(url, part_path, hashlib.sha256(), session, use_tqdm, metrics)
+        r.raise_for_status()
+        if have and r.status_code != 206:
+            # Server ignored the Range header, start again from scratch
+            have = 0
+            digest = hashlib.sha256()
+        remaining = r.headers.get('Content-Length')
+        total = have + int(remaining) if remaining is not None else None
+
+        pbar = progress(None, use_tqdm, total=total, initial=have, unit='B', unit_scale=True, unit_divisor=1024, desc=part_path.stem)
+        chunk_size = MIN_CHUNK_SIZE
+        try:
+            with phase(metrics, 'download', total_bytes=int(remaining) if remaining is not None else None, file=part_path.stem) as timing, open(part_path, 'ab' if have else 'wb') as f:
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        chunk = r.raw.read(chunk_size, decode_content=True)
+                    except urllib3.exceptions.HTTPError as e:
+                        # Reading raw skips requests' own wrapping, so make drops look like any other connection error
+                        raise requests.ConnectionError(e) from e
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    digest.update(chunk)
+                    if pbar is not None:
+                        pbar.update(len(chunk))
+                    timing.add(bytes=len(chunk))
+                    chunk_size = _next_chunk_size(chunk_size, time.perf_counter() - start)
+        finally:
+            if pbar is not None:
+                pbar.close()
+
+    if total is not None and part_path.stat().st_size < total:
+        raise requests.ConnectionError(f'Connection closed after {part_path.stat().st_size} of {total} bytes')
+    return digest
+
+
+def fetch_artifact(url: str, sha256: str=None, cache_dir: Path=None, print_fcn=print, use_tqdm: bool=None, session=None, metrics=None) -> Path:
+    # Download url into the artifact cache (or reuse it) and return the local path.
+    # Partial downloads are kept as .part files and resumed with a Range request, on this run or the next one.
+    # If sha256 is given the file has to match it, otherwise the hash of what was downloaded is recorded next to it.
+    # Pass a metrics_util.BuildMetrics as metrics for progress reports and to be able to cancel it.
+    # requests takes a while to import, so only load it once something actually has to be downloaded
+    import requests
+    path = artifact_path(url, sha256, cache_dir)
+    sidecar = sidecar_path(path)
+    part_path = path.with_name(path.name + '.part')
+    session = session or requests.Session()
+
+    with _lock_for(path):
+        if path.exists() and sidecar.exists():
+            # The cached file has to still match what was recorded when it was downloaded, and the expected hash
+            actual = hash_file(path).hexdigest()
+            recorded = (sidecar.read_text().split() or [''])[0].lower()
+            if actual == recorded and (sha256 is None or actual == sha256.lower()):
+                print_fcn(f'Using cached {path.name}.')
+                return path
+            print_fcn(f'Cached {path.name} has sha256 {actual}, expected {sha256 or recorded}, downloading it again...')
+            path.unlink()
+            sidecar.unlink()
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Re-hash whatever was already downloaded so the final check covers the whole file
+        digest = hash_file(part_path) if part_path.exists() else hashlib.sha256()
+        if part_path.exists():
+            print_fcn(f'Resuming {path.name} from {part_path.stat().st_size} bytes...')
+        else:
+            print_fcn(f'Downloading {path.name}...')
+
+        for attempt in range(DOWNLOAD_RETRIES + 1):
+            try:
+                digest = _download_part(url, part_path, digest, session, use_tqdm, metrics)
+                break
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                if attempt == DOWNLOAD_RETRIES:
+                    raise
+                print_fcn(f'Download interrupted ({e}), resuming...')
+                # The server may have restarted us from zero before dropping, so trust the file over the digest
+                digest = hash_file(part_path) if part_path.exists() else hashlib.sha256()
+                time.sleep(min(2 ** attempt, 10))
+
+        actual = digest.hexdigest()
+        if sha256 is not None and actual != sha256.lower():
+            # A bad .part would just fail again on resume, so throw it away
+            part_path.unlink()
+            raise ChecksumError(f'{path.name} has sha256 {actual}, expected {sha256}')
+
+        part_path.replace(path)
+        sidecar.write_text(f'{actual}  {path.name}\n')
+        print_fcn(f'Downloaded {path.name}.')
+        return path
+
+
+def fetch_artifacts(artifacts: list, max_workers: int=DEFAULT_FETCH_JOBS, print_fcn=print, use_tqdm: bool=None) -> tuple:
+    # Fetch each (url, sha256) once, different artifacts in parallel.
+    # Returns ({url: Path, or the exception if it failed}, bytes actually downloaded this time)
+    artifacts = list(dict.fromkeys(artifacts))
+    # Several progress bars at once just garble each other
+    use_tqdm = (tqdm_available() if use_tqdm is None else use_tqdm) and len(artifacts) == 1
+    results = {}
+    downloaded = []
+
+    def fetch(url, sha256):
+        path = artifact_path(url, sha256)
+        part_path = path.with_name(path.name + '.part')
+        already_have = None if is_cached(url, sha256) else (part_path.stat().st_size if part_path.exists() else 0)
+        path = fetch_artifact(url, sha256, print_fcn=print_fcn, use_tqdm=use_tqdm)
+        if already_have is not None:
+            downloaded.append(path.stat().st_size - already_have)
+        return path
+
+    if not artifacts:
+        return results, 0
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(artifacts)))) as executor:
+        futures = {url: executor.submit(fetch, url, sha256) for url, sha256 in artifacts}
+        for url, future in futures.items():
+            try:
+                results[url] = future.result()
+            except Exception as e:
+                print_fcn(f'Error: could not download {url}: {e}')
+                results[url] = e
+    return results, sum(downloaded)
@@ -2,6 +2,7 @@ import PySimpleGUI as sg
 from pathlib import Path
 from pak_util import make_hl_pak
 from presets import presets, search_for_halflife
+from gui_util import BackgroundTask, describe_progress, progress_fraction, was_cancelled, PRINT_EVENT, PROGRESS_EVENT, DONE_EVENT
 
 sg.theme('DarkAmber')
 
@@ -22,25 +23,42 @@ def tuple_string_to_list(string):
         # It's a string that looks like val1, val2 so just split on the comma
         return [v.strip() for v in string.split(',')]
 
-base_path = search_for_halflife()
 default_preset = 'hl_hd'
 preset = presets[default_preset]
 
 layout = [
     [sg.Text('Preset', tooltip='Select a preset from the dropdown'), sg.Combo(list(presets.keys()), key='preset', enable_events=True, default_value=default_preset)],
     [sg.Multiline(preset['description'], size=(50, 10), key='preset_description')],
-    [sg.Text('Half-Life Base Path', tooltip='Enter the base path for Half-Life'), sg.Input(key='hl_base_path', default_text=search_for_halflife(), expand_x=True,), sg.FolderBrowse()],
+    [sg.Text('Half-Life Base Path', tooltip='Enter the base path for Half-Life'), sg.Input(key='hl_base_path', expand_x=True,), sg.FolderBrowse()],
     [sg.Text('Game Path', tooltip='Enter the path to the game, relative to the base path.'), sg.Input(key='game_path', default_text=preset['base_folder'], expand_x=True,)],
     [sg.Text('Max Chunk Size', tooltip='Maximum amount of files per .pak (do not exceed 4000).'), sg.Input(key='max_chunk_size', default_text=3999)],
     [sg.Text('Also Include', tooltip='Enter any additional directories relative to the base path to copy over, comma separated'), sg.Input(key='also_include', default_text=preset['also_include_overwrites'], expand_x=True,)],
     [sg.Text('Ignore Files', tooltip='Enter any files to ignore, comma separated'), sg.Input(key='ignore_files', default_text=preset.get('ignore_files', None), expand_x=True,)],
     [sg.Checkbox('Verbose', key='verbose')],
     [sg.Text('Output Path', tooltip='Enter the output path for the PAK files'), sg.Input(key='out_path', default_text='xash')],
-    [sg.Button('Show Presets'), sg.Button('Start')],
+    [sg.Button('Show Presets'), sg.Button('Start'), sg.Button('Cancel', disabled=True)],
+    [sg.ProgressBar(1000, orientation='h', size=(40, 15), key='progress', expand_x=True)],
+    [sg.Text('', key='status', expand_x=True)],
     [sg.Multiline(size=(400, 20), key='output', font='Courier 10', text_color='white', background_color='black', pad=(0, 0), tooltip='Output from the program will be displayed here.', expand_y=True, expand_x=True)],
 ]
 
-window = sg.Window('Half-Life PAK Creator', layout, size=(800, 800))
+window = sg.Window('Half-Life PAK Creator', layout, size=(800, 800), finalize=True)
+# Builds run here so the window keeps responding, output and progress come back as events
+task = BackgroundTask(window)
+
+def set_running(running: bool):
+    window['Start'].update(disabled=running)
+    window['Cancel'].update(disabled=not running)
+
+# Looking through the Steam libraries can take a couple of seconds with a slow drive, so it happens after the window is up
+FIND_HALFLIFE = 'Find Half-Life'
+
+def find_halflife(metrics=None):
+    return search_for_halflife()
+
+if task.start(FIND_HALFLIFE, find_halflife):
+    set_running(True)
+    window['status'].update('Looking for Half-Life...')
 
 while True:
     event, values = window.read()
@@ -48,14 +66,45 @@ while True:
 
     def print_fcn(text):
         output.print(text)
-        window.refresh()
 
     def error_fcn(text):
         output.print(text, text_color='red')
-        window.refresh()    
     
     if event == sg.WINDOW_CLOSED:
+        task.cancel()
         break
+
+    elif event == PRINT_EVENT:
+        print_fcn(values[event])
+
+    elif event == PROGRESS_EVENT:
+        progress = values[event]
+        window['status'].update(describe_progress(progress))
+        fraction = progress_fraction(progress)
+        if fraction is not None:
+            window['progress'].update(int(fraction * 1000))
+
+    elif event == DONE_EVENT:
+        description, out_path, error = values[event]
+        set_running(False)
+        window['progress'].update(0)
+        window['status'].update('')
+        if description == FIND_HALFLIFE:
+            # Don't replace a path that was typed in while it was looking
+            if out_path is not None and not window['hl_base_path'].get():
+                window['hl_base_path'].update(str(out_path))
+            elif out_path is None:
+                error_fcn('Unable to find the Half-Life directory, enter the Half-Life Base Path above.')
+        elif was_cancelled(error):
+            error_fcn('Cancelled. Anything that was finished is kept, the next build picks up from there.')
+        elif error is not None:
+            error_fcn(f'Error: {error}')
+        else:
+            print_fcn(f'Done. Place the contents of the output folder ({out_path}) in /sdcard/xash/')
+
+    elif event == 'Cancel':
+        print_fcn('Cancelling...')
+        task.cancel()
     
     elif event == 'Show Presets':
         sg.popup(show_presets())
@@ -72,6 +121,9 @@ while True:
     elif event == 'Start':
         # Here you would call the function to create the pak files, passing in the values from the form
         print_fcn('Starting...')
+        if not values['hl_base_path']:
+            error_fcn('Error: Enter the Half-Life Base Path first.')
+            continue
         base_path = Path(values['hl_base_path'])
         game_path = base_path / values['game_path']
         also_include = [base_path / new_folder for new_folder in tuple_string_to_list(values['also_include'])] if values['also_include'] else []
@@ -83,10 +135,11 @@ while True:
         if not game_path.exists():
             error_fcn(f'Error: Game path {game_path} does not exist.')
             continue
-        for path in also_include:
-            if not path.exists():
-                error_fcn(f'Error: Also include path {path} does not exist.')
-                continue
+        missing = [path for path in also_include if not path.exists()]
+        for path in missing:
+            error_fcn(f'Error: Also include path {path} does not exist.')
+        if missing:
+            continue
             
         out_path = base_path / values['out_path'] / values['game_path']
         ignore_files = [v for v in tuple_string_to_list(values['ignore_files'])] if values['ignore_files'] else None
@@ -96,8 +149,11 @@ while True:
         # print(values['also_include'], type(values['also_include']), tuple_string_to_list(values['also_include']))
         # print(ignore_files)
         # print(also_include)
-        make_hl_pak(game_path, out_path, also_include_overwrites=also_include, max_chunk_size=max_chunk_size, verbose=verbose, ignore_files=ignore_files, use_tqdm=False, print_fcn=print_fcn)
-        
-        print_fcn(f'Done. Place the contents of the output folder ({out_path}) in /sdcard/xash/')
+        def build(metrics=None):
+            make_hl_pak(game_path, out_path, also_include_overwrites=also_include, max_chunk_size=max_chunk_size, verbose=verbose, ignore_files=ignore_files, use_tqdm=False, print_fcn=task.print, metrics=metrics)
+            return out_path
+
+        if task.start('Build', build):
+            set_running(True)
 
 window.close()
\ No newline at end of file
@@ -0,0 +1,101 @@
+import threading
+
+from metrics_util import BuildMetrics, BuildCancelled
+from pak_util import format_size
+
+
+# Events the worker thread posts back to the window's event loop
+PRINT_EVENT = '-PRINT-'
+PROGRESS_EVENT = '-PROGRESS-'
+DONE_EVENT = '-DONE-'
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f'{seconds // 3600}:{seconds % 3600 // 60:02}:{seconds % 60:02}'
+    return f'{seconds // 60}:{seconds % 60:02}'
+
+
+def progress_fraction(progress: dict) -> float:
+    # How far through its phase the progress event is, None if the phase didn't say how much work it had
+    if progress['total_bytes']:
+        return min(progress['bytes'] / progress['total_bytes'], 1.0)
+    if progress['total_files']:
+        return min(progress['files'] / progress['total_files'], 1.0)
+    return None
+
+
+def describe_progress(progress: dict) -> str:
+    # e.g. "pak_write pak1.pak: 1200/3900 files, 310.2 MiB/1.1 GiB, 0:42 left"
+    label = ' '.join([progress['name']] + [value for key, value in progress['args'].items() if key in ('pak', 'device', 'apk', 'file')])
+    files = f'{progress["files"]}/{progress["total_files"]}' if progress['total_files'] else str(progress['files'])
+    text = f'{label}: {files} files'
+    if progress['bytes']:
+        text += f', {format_size(progress["bytes"])}'
+        if progress['total_bytes']:
+            text += f'/{format_size(progress["total_bytes"])}'
+    if progress['eta'] is not None:
+        text += f', {format_duration(progress["eta"])} left'
+    return text
+
+
+class BackgroundTask:
+    # Runs one long operation at a time on a worker thread so the window keeps responding.
+    # The operation gets metrics=self.metrics, which sends progress back as PROGRESS_EVENTs and stops it with
+    # BuildCancelled at the next file once cancel() is called. print() sends a line of output as a PRINT_EVENT,
+    # and when the operation ends a DONE_EVENT carries (description, result, error).
+
+    def __init__(self, window):
+        self.window = window
+        self.cancel_event = threading.Event()
+        self.metrics = BuildMetrics(on_progress=self._post_progress, cancel_event=self.cancel_event)
+        self.description = None
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, description: str, fcn: callable, *args, **kwargs) -> bool:
+        # Returns False if something else is still running
+        if self.running:
+            return False
+        self.cancel_event.clear()
+        self.description = description
+        self._thread = threading.Thread(target=self._run, args=(fcn, args, kwargs), name=description, daemon=True)
+        self._thread.start()
+        return True
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def print(self, text):
+        self.window.write_event_value(PRINT_EVENT, str(text))
+
+    def _run(self, fcn: callable, args: tuple, kwargs: dict):
+        result = error = None
+        try:
+            result = fcn(*args, metrics=self.metrics, **kwargs)
+        except BaseException as e:
+            # SystemExit too, some of the wizard steps still exit() on errors
+            error = e
+        self.window.write_event_value(DONE_EVENT, (self.description, result, error))
+
+    def _post_progress(self, phase):
+        self.window.write_event_value(PROGRESS_EVENT, {
+            'name': phase.name,
+            'args': phase.args,
+            'files': phase.files,
+            'bytes': phase.bytes,
+            'total_files': phase.total_files,
+            'total_bytes': phase.total_bytes,
+            'eta': phase.eta(),
+        })
+
+
+def was_cancelled(results) -> bool:
+    # Whether an operation's error, or any of the per-device errors it returned, came from cancelling it
+    if isinstance(results, BuildCancelled):
+        return True
+    return isinstance(results, dict) and any(isinstance(error, BuildCancelled) for error in results.values())
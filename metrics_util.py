@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import time
+import threading
+from pathlib import Path
+
+
+def peak_rss() -> int:
+    # Peak resident memory of this process in bytes so far, None where the OS doesn't tell us (Windows)
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def io_bytes_written() -> int:
+    # Bytes this process has sent to the storage layer, only available on Linux
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('write_bytes:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class BuildCancelled(Exception):
+    pass
+
+
+class Phase:
+    # One timed piece of work. Add to files and bytes while it runs, the rest is filled in when it ends.
+    # total_files/total_bytes are how much work the phase expects to do, if known, for progress reports.
+    def __init__(self, metrics: 'BuildMetrics', name: str, args: dict, total_files: int=None, total_bytes: int=None):
+        self.metrics = metrics
+        self.name = name
+        # Paths and the like, stored as strings so they can go straight into JSON
+        self.args = {key: str(value) for key, value in args.items()}
+        self.files = 0
+        self.bytes = 0
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.thread = threading.current_thread().name
+        self.tid = threading.get_ident()
+
+    def add(self, files: int=0, bytes: int=0):
+        self.files += files
+        self.bytes += bytes
+        self.check()
+
+    def check(self):
+        # A safe point to stop at: raises BuildCancelled if the run was cancelled, and reports progress
+        self.metrics._progress(self)
+
+    def eta(self) -> float:
+        # Seconds left based on how fast it's gone so far, None if there's nothing to go on
+        done, total = (self.bytes, self.total_bytes) if self.total_bytes else (self.files, self.total_files)
+        if not total or not done:
+            return None
+        return (time.perf_counter() - self.start) * max(total - done, 0) / done
+
+    def __enter__(self):
+        self._written = io_bytes_written()
+        self.start = time.perf_counter()
+        self.check()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.seconds = time.perf_counter() - self.start
+        written = io_bytes_written()
+        self.disk_bytes_written = written - self._written if self._written is not None else None
+        self.peak_rss = peak_rss()
+        self.failed = exc_type is not None
+        self.metrics._record(self)
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'args': self.args,
+            'thread': self.thread,
+            'start': self.start - self.metrics.start,
+            'seconds': self.seconds,
+            'files': self.files,
+            'bytes': self.bytes,
+            'bytes_per_second': self.bytes / self.seconds if self.seconds else None,
+            'disk_bytes_written': self.disk_bytes_written,
+            'peak_rss': self.peak_rss,
+            'failed': self.failed,
+        }
+
+
+class _NullPhase:
+    # Stands in for a Phase when nobody asked for metrics
+    def add(self, files: int=0, bytes: int=0):
+        pass
+
+    def check(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+class BuildMetrics:
+    # Collects timed phases from make_hl_pak, dir_to_pak, push and install calls, from any number of threads.
+    # Pass one into those functions as metrics=..., then print_summary() it or save it as JSON or a Chrome trace
+    # (open the trace in chrome://tracing or https://ui.perfetto.dev).
+    # on_progress(phase) is called from the working thread at most every progress_interval seconds, and setting
+    # cancel_event makes the work stop with BuildCancelled at the next file or phase boundary.
+
+    def __init__(self, on_progress: callable=None, cancel_event: threading.Event=None, progress_interval: float=0.2):
+        self.start = time.perf_counter()
+        self.phases = []
+        self._lock = threading.Lock()
+        self.on_progress = on_progress
+        self.cancel_event = cancel_event
+        self.progress_interval = progress_interval
+        self._last_progress = 0.0
+
+    def phase(self, name: str, total_files: int=None, total_bytes: int=None, **args) -> Phase:
+        return Phase(self, name, args, total_files=total_files, total_bytes=total_bytes)
+
+    def _progress(self, phase: Phase):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise BuildCancelled('Cancelled.')
+        if self.on_progress is not None:
+            now = time.perf_counter()
+            if now - self._last_progress >= self.progress_interval:
+                self._last_progress = now
+                self.on_progress(phase)
+
+    def _record(self, phase: Phase):
+        with self._lock:
+            self.phases.append(phase)
+
+    def summary(self) -> dict:
+        # Totals for each phase name, in the order the phases first finished.
+        # Phases that ran at the same time (e.g. one per pak with --jobs) add up to more than the wall time.
+        totals = {}
+        for phase in self.phases:
+            total = totals.setdefault(phase.name, {'count': 0, 'seconds': 0.0, 'files': 0, 'bytes': 0, 'peak_rss': None})
+            total['count'] += 1
+            total['seconds'] += phase.seconds
+            total['files'] += phase.files
+            total['bytes'] += phase.bytes
+            if phase.peak_rss is not None:
+                total['peak_rss'] = max(total['peak_rss'] or 0, phase.peak_rss)
+        for total in totals.values():
+            total['bytes_per_second'] = total['bytes'] / total['seconds'] if total['seconds'] else None
+        return totals
+
+    def print_summary(self, print_fcn: callable=print):
+        from pak_util import format_size
+        print_fcn(f'{"phase":<16}{"count":>6}{"seconds":>10}{"files":>9}{"bytes":>12}{"per second":>14}{"peak RSS":>12}')
+        for name, total in self.summary().items():
+            rate = f'{format_size(total["bytes_per_second"])}/s' if total['bytes'] and total['bytes_per_second'] else ''
+            rss = format_size(total['peak_rss']) if total['peak_rss'] else ''
+            print_fcn(f'{name:<16}{total["count"]:>6}{total["seconds"]:>10.3f}{total["files"]:>9}{format_size(total["bytes"]):>12}{rate:>14}{rss:>12}')
+
+    def to_json(self) -> dict:
+        return {'phases': [phase.to_dict() for phase in self.phases], 'summary': self.summary()}
+
+    def to_chrome_trace(self) -> dict:
+        # Complete ("X") events in microseconds, one row per thread
+        events = []
+        for phase in self.phases:
+            record = phase.to_dict()
+            args = {key: value for key, value in record.items() if key not in ('name', 'args', 'thread', 'start', 'seconds')}
+            args.update(phase.args)
+            events.append({'name': phase.name, 'ph': 'X', 'pid': os.getpid(), 'tid': phase.tid,
+                           'ts': record['start'] * 1e6, 'dur': phase.seconds * 1e6, 'args': args})
+        for tid, thread in {phase.tid: phase.thread for phase in self.phases}.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': thread}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, path, chrome_trace: bool=False):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.to_chrome_trace() if chrome_trace else self.to_json(), f, indent=1)
+
+
+def phase(metrics: BuildMetrics, name: str, total_files: int=None, total_bytes: int=None, **args):
+    # metrics.phase(name) when there is a metrics object, otherwise something that does nothing
+    if metrics is None:
+        return _NullPhase()
+    return metrics.phase(name, total_files=total_files, total_bytes=total_bytes, **args)
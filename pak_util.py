@@ -1,217 +1,926 @@
 # Thanks to Tome Of Preach for the basis of this script
 # Originally found here: https://tomeofpreach.wordpress.com/2013/06/22/makepak-py/
+import io
 import os
-import math
+import re
+import mmap
+import errno
 import shutil
+import json
 import struct
-from tqdm import tqdm
+import hashlib
+import zipfile
+import zlib
+from contextlib import nullcontext
+from datetime import datetime
+from array import array
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
-from presets import TQDM_AVAILABLE
-from adb_util import rewrite_path_for_os
+from presets import progress
+from metrics_util import phase, BuildCancelled
+from path_util import rewrite_path_for_os, TreeIndex
 
 
 MAX_FILES_PER_PAK = 3900
- 
-#dummy class for stuffing the file headers into
-class FileEntry:
-    pass
- 
+MANIFEST_VERSION = 1
+MAX_PAK_NAME_LEN = 56
+# Offsets and lengths are stored as signed 32-bit ints
+MAX_PAK_OFFSET = 2**31 - 1
+# Default cap on the size of each pak file, anything bigger can't be addressed by the 32-bit offsets
+MAX_BYTES_PER_PAK = MAX_PAK_OFFSET
+# Patch paks get rolled back into the full paks once they add up to more than this fraction of them
+PATCH_ROLLUP_FRACTION = 0.25
+COPY_CHUNK_SIZE = 1024 * 1024
 
-def dir_to_pak(rootdir, pakfilename):
+PAK_HEADER = struct.Struct("<4s2l")
+PAK_ENTRY = struct.Struct("<56s2l")
+PAK_ENTRY_POSITION = struct.Struct("<2l")
+
+# Errors that mean a kernel-side copy isn't supported for this pair of files, so fall back to the next method
+_COPY_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSOCK, errno.EBADF}
+
+
+def _kernel_copy(src_fd: int, dst_fd: int, length: int) -> int:
+    # Copy up to length bytes from the start of src_fd to the current position of dst_fd without going through userspace.
+    # Tries copy_file_range first, then sendfile, returns the number of bytes copied so the caller can finish the rest.
+    copied = 0
+    for copy_fcn in (getattr(os, 'copy_file_range', None), getattr(os, 'sendfile', None)):
+        if copy_fcn is None:
+            continue
+        try:
+            while copied < length:
+                if copy_fcn is os.sendfile:
+                    n = os.sendfile(dst_fd, src_fd, copied, length - copied)
+                else:
+                    n = copy_fcn(src_fd, dst_fd, length - copied, copied)
+                if n == 0:
+                    return copied
+                copied += n
+            return copied
+        except OSError as e:
+            if copied or e.errno not in _COPY_UNSUPPORTED_ERRNOS:
+                raise
+    return copied
+
+
+class PakWriter:
+    # Streams files into a PACK file one at a time without loading them into memory.
+    # File bodies are copied kernel-side where the OS allows it, and the directory is kept in compact arrays
+    # and written out in a single write when the pak is closed.
+    # With dedup on, files are hashed as they're written and repeated contents just get another directory entry
+    # pointing at the first copy.
+    # With append on, an existing pak is opened instead and files are added, replaced or removed in place. New data
+    # goes after everything already in the file, old directory included, and the header only moves to the new
+    # directory once close() has written it, so an interrupted update leaves the pak as it was. Replaced and removed
+    # data stays behind as dead space until compact_pak rewrites the file.
+
+    def __init__(self, pakfilename, dedup: bool=False, append: bool=False):
+        self.pakfilename = pakfilename
+        self._names = bytearray()
+        self._offsets = array('i')
+        self._lengths = array('i')
+        # Name -> position in the directory, so adding a name that's already there replaces it
+        self._index = {}
+        if append:
+            with PakArchive(pakfilename) as archive:
+                for name, (offset, length) in archive.entries.items():
+                    self._add_entry(name, offset, length)
+            self.pakfile = open(pakfilename, "r+b", buffering=0)
+            self.offset = self.pakfile.seek(0, os.SEEK_END)
+            self._appended_from = self.offset
+        else:
+            self._appended_from = None
+            self.pakfile = open(pakfilename, "wb", buffering=0)
+            # write a dummy header to start with, it gets filled in on close
+            self.pakfile.write(PAK_HEADER.pack(b"PACK", 0, 0))
+            self.offset = PAK_HEADER.size
+        self._buffer = None
+        self.dedup = dedup
+        # Content digest -> (offset, length) of the first copy written
+        self._seen = {}
+        self.duplicates = 0
+        self.bytes_saved = 0
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and self._appended_from is not None:
+            self.abort()
+        else:
+            self.close()
+
+    def abort(self):
+        # Give up on an append and cut off anything written since, the old header and directory were never touched
+        if self.pakfile.closed:
+            return
+        self.pakfile.truncate(self._appended_from)
+        self.pakfile.close()
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def _add_entry(self, name: str, offset: int, length: int):
+        encoded = name.encode("ascii")
+        if len(encoded) > MAX_PAK_NAME_LEN:
+            raise ValueError(f'{name} is too long for pak file ({MAX_PAK_NAME_LEN} char limit).')
+        i = self._index.get(name)
+        if i is not None:
+            self._offsets[i] = offset
+            self._lengths[i] = length
+            return
+        self._index[name] = len(self._offsets)
+        self._names += encoded.ljust(MAX_PAK_NAME_LEN, b"\0")
+        self._offsets.append(offset)
+        self._lengths.append(length)
+
+    def remove(self, name: str) -> bool:
+        # Drop a file from the directory, its data is left where it is. Returns False if it wasn't there.
+        i = self._index.pop(name, None)
+        if i is None:
+            return False
+        del self._names[i * MAX_PAK_NAME_LEN:(i + 1) * MAX_PAK_NAME_LEN]
+        del self._offsets[i]
+        del self._lengths[i]
+        for other, j in self._index.items():
+            if j > i:
+                self._index[other] = j - 1
+        return True
+
+    def _check_room(self, name: str, length: int):
+        if self.offset + length > MAX_PAK_OFFSET:
+            raise ValueError(f'Adding {name} would push {self.pakfilename} past the {MAX_PAK_OFFSET} byte pak limit.')
+
+    def add_file(self, name: str, filename) -> int:
+        # Add a file from disk under the given name, returns its length
+        with open(filename, "rb") as importfile:
+            if self.dedup:
+                return self._add_deduped(name, importfile)
+            length = os.fstat(importfile.fileno()).st_size
+            self._check_room(name, length)
+            copied = _kernel_copy(importfile.fileno(), self.pakfile.fileno(), length)
+            if copied < length:
+                # Finish off with a chunked copy if the kernel couldn't do it all
+                importfile.seek(copied)
+                copied += self._copy_chunks(name, importfile, copied)
+        self._add_entry(name, self.offset, copied)
+        self.offset += copied
+        return copied
+
+    def add_fileobj(self, name: str, fileobj) -> int:
+        # Add the contents of a readable file object under the given name, returns its length
+        if self.dedup:
+            return self._add_deduped(name, fileobj)
+        length = self._copy_chunks(name, fileobj)
+        self._add_entry(name, self.offset, length)
+        self.offset += length
+        return length
+
+    def add_data(self, name: str, data) -> int:
+        # Add a bytes-like object (e.g. a view from PakArchive.read) under the given name, returns its length
+        if self.dedup:
+            return self._add_deduped(name, io.BytesIO(data))
+        self._check_room(name, len(data))
+        self.pakfile.write(data)
+        self._add_entry(name, self.offset, len(data))
+        self.offset += len(data)
+        return len(data)
+
+    def _add_deduped(self, name: str, fileobj) -> int:
+        # Hash the file while writing it, then if the same contents are already in the pak, throw away the new copy
+        digest = new_digest()
+        length = self._copy_chunks(name, fileobj, digest=digest)
+        first = self._seen.get(digest.digest())
+        if first is not None and first[1] == length:
+            self.pakfile.seek(self.offset)
+            self.pakfile.truncate()
+            self._add_entry(name, *first)
+            self.duplicates += 1
+            self.bytes_saved += length
+        else:
+            self._seen[digest.digest()] = (self.offset, length)
+            self._add_entry(name, self.offset, length)
+            self.offset += length
+        return length
+
+    def _copy_chunks(self, name: str, fileobj, already_copied: int=0, digest=None) -> int:
+        # Copy the rest of fileobj through a reusable buffer so memory use doesn't depend on the file size
+        if self._buffer is None:
+            self._buffer = bytearray(COPY_CHUNK_SIZE)
+        view = memoryview(self._buffer)
+        length = 0
+        while True:
+            n = fileobj.readinto(view)
+            if not n:
+                break
+            self._check_room(name, already_copied + length + n)
+            self.pakfile.write(view[:n])
+            if digest is not None:
+                digest.update(view[:n])
+            length += n
+        return length
+
+    def close(self):
+        if self.pakfile.closed:
+            return
+        # after all the file data, write the list of entries in one go
+        directory = bytearray(PAK_ENTRY.size * len(self))
+        names = memoryview(self._names)
+        for i in range(len(self)):
+            pos = i * PAK_ENTRY.size
+            directory[pos:pos + MAX_PAK_NAME_LEN] = names[i * MAX_PAK_NAME_LEN:(i + 1) * MAX_PAK_NAME_LEN]
+            PAK_ENTRY_POSITION.pack_into(directory, pos + MAX_PAK_NAME_LEN, self._offsets[i], self._lengths[i])
+        self.pakfile.write(directory)
+        if self._appended_from is not None:
+            # The data and new directory have to be on disk before the header points at them
+            os.fsync(self.pakfile.fileno())
+
+        # return to the header and write the values correctly
+        self.pakfile.seek(0)
+        self.pakfile.write(PAK_HEADER.pack(b"PACK", self.offset, len(directory)))
+        self.pakfile.close()
+
+
+class PakArchive:
+    # Read-only view of an existing PACK file.
+    # The directory is parsed into a dict keyed by name, and the file is memory-mapped so that opening
+    # a multi-GB pak is cheap and reading a member hands back a view of the mapping instead of a copy.
+
+    def __init__(self, pakfilename):
+        self.pakfilename = Path(pakfilename)
+        self._file = open(pakfilename, "rb")
+        self.size = os.fstat(self._file.fileno()).st_size
+        if self.size < PAK_HEADER.size:
+            self._file.close()
+            raise ValueError(f'{pakfilename} is too small to be a pak file.')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.dir_offset, self.dir_length = PAK_HEADER.unpack_from(self._mmap, 0)
+        if magic != b"PACK" or self.dir_length % PAK_ENTRY.size or self.dir_offset < PAK_HEADER.size or self.dir_offset + self.dir_length > self.size:
+            self.close()
+            raise ValueError(f'{pakfilename} is not a valid pak file.')
+
+        # name -> (offset, length), later duplicates win the same way they would in the engine's lookup
+        self.entries = {}
+        self.duplicate_names = []
+        for raw_name, offset, length in PAK_ENTRY.iter_unpack(self._mmap[self.dir_offset:self.dir_offset + self.dir_length]):
+            name = raw_name.split(b"\0", 1)[0].decode("ascii", errors="replace")
+            if name in self.entries:
+                self.duplicate_names.append(name)
+            self.entries[name] = (offset, length)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        if getattr(self, '_mmap', None) is not None and not self._mmap.closed:
+            self._mmap.close()
+        self._file.close()
+
+    def read(self, name: str) -> memoryview:
+        # Returns a zero-copy view of the member, release it before closing the archive
+        offset, length = self.entries[name]
+        return memoryview(self._mmap)[offset:offset + length]
+
+    def extract(self, dest_dir, names: list=None, jobs: int=1) -> list:
+        # Extract the given members (or all of them) under dest_dir, returns the paths written
+        dest_dir = Path(dest_dir)
+        names = list(self.entries) if names is None else names
+        for name in names:
+            if name not in self.entries:
+                raise KeyError(f'{name} is not in {self.pakfilename}')
+            if Path(name).is_absolute() or '..' in Path(name).parts:
+                raise ValueError(f'Refusing to extract {name} outside of {dest_dir}')
+
+        def extract_one(name: str) -> Path:
+            dest = dest_dir / name
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            with self.read(name) as data, open(dest, "wb") as f:
+                f.write(data)
+            return dest
+
+        if jobs > 1:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                return list(executor.map(extract_one, names))
+        return [extract_one(name) for name in names]
+
+    def dead_bytes(self) -> int:
+        # Bytes of file data no entry points at any more, left behind by update_pak until compact_pak
+        live = 0
+        end = PAK_HEADER.size
+        for offset, length in sorted(set(self.entries.values())):
+            live += max(0, offset + length - max(offset, end))
+            end = max(end, offset + length)
+        return self.size - PAK_HEADER.size - self.dir_length - live
+
+    def verify(self) -> list:
+        # Check the directory for problems, returns a list of error messages (empty if everything is fine)
+        errors = [f'Duplicate entry: {name}' for name in self.duplicate_names]
+        spans = []
+        for name, (offset, length) in self.entries.items():
+            if not name.isascii():
+                errors.append(f'Non-ASCII name: {name}')
+            if offset < PAK_HEADER.size or length < 0 or offset + length > self.dir_offset:
+                errors.append(f'Entry out of bounds: {name} (offset {offset}, length {length})')
+            elif length:
+                spans.append((offset, length, name))
+
+        # Entries pointing at exactly the same data are fine, partial overlaps mean a corrupt directory
+        spans.sort()
+        for (offset, length, name), (next_offset, next_length, next_name) in zip(spans, spans[1:]):
+            if next_offset < offset + length and (next_offset, next_length) != (offset, length):
+                errors.append(f'Overlapping entries: {name} and {next_name}')
+        return errors
+
+
+def open_pak_set(path) -> list:
+    # Open a single pak file, or every pakN.pak in a folder in load order
+    path = Path(path)
+    if path.is_file():
+        return [PakArchive(path)]
+    pak_paths = [p for p in path.glob('pak*.pak') if p.stem[3:].isdigit()]
+    return [PakArchive(p) for p in sorted(pak_paths, key=lambda p: int(p.stem[3:]))]
+
+
+def resolve_pak_set(archives: list) -> dict:
+    # Map every name to the archive it would be loaded from, higher numbered paks take priority over lower ones
+    resolved = {}
+    for archive in archives:
+        for name in archive:
+            resolved[name] = archive
+    return resolved
+
+
+def dir_to_pak(rootdir, pakfilename, metrics=None):
     # Rootdir is the directory to be packed
     # Pakfilename is the name of the pak file to be created
-    
-    pakfile = open(pakfilename,"wb")
-    
-    # write a dummy header to start with
-    pakfile.write(struct.Struct("<4s2l").pack(b"PACK",0,0))
-    
-    # walk the directory recursively, add the files and record the file entries
-    offset = 12
-    fileentries = []
-    for root, subFolders, files in os.walk(rootdir):
-        for file in files:
-            entry = FileEntry()
-            impfilename = os.path.join(root,file)  
-            entry.filename = os.path.relpath(impfilename,rootdir).replace("\\","/")       
-            with open(impfilename, "rb") as importfile:
-                pakfile.write(importfile.read())
-                entry.offset = offset
-                entry.length = importfile.tell()
-                offset = offset + entry.length
-            fileentries.append(entry)
-    tablesize = 0
-    
-    # after all the file data, write the list of entries
-    for entry in fileentries:
-        pakfile.write(struct.Struct("<56s").pack(entry.filename.encode("ascii")))
-        pakfile.write(struct.Struct("<l").pack(entry.offset))
-        pakfile.write(struct.Struct("<l").pack(entry.length))
-        tablesize = tablesize + 64
-    
-    # return to the header and write the values correctly
-    pakfile.seek(0)
-    pakfile.write(struct.Struct("<4s2l").pack(b"PACK",offset,tablesize))
-    pakfile.close()
-
-
-def make_hl_pak(in_path: Path, out_path: Path, also_include_overwrites: list=None, ignore_files: list=None, print_fcn: callable=print, verbose: bool=False, max_chunk_size: int=MAX_FILES_PER_PAK, use_tqdm: bool=TQDM_AVAILABLE):
-    # First, make the output directory if it doesn't exist
-    out_path = rewrite_path_for_os(Path(out_path))
-    # Delete the output directory if it already exists
-    if out_path.exists():
-        shutil.rmtree(out_path)
-    # Ensure the output path exists
-    out_path.mkdir(parents=True)
 
-    # Get a list of all of the base HL files
-    base_files = list(Path(in_path).rglob("*"))
-    # Copy all of the base HL files to the output directory, preserving directory structure
-    print_fcn(f'Copying files from {in_path} to output directory...')
+    # walk the directory recursively and add the files
+    with phase(metrics, 'dir_to_pak', pak=Path(pakfilename).name) as timing, PakWriter(pakfilename) as writer:
+        for root, subFolders, files in os.walk(rootdir):
+            for file in files:
+                impfilename = os.path.join(root,file)
+                timing.add(files=1, bytes=writer.add_file(os.path.relpath(impfilename,rootdir).replace("\\","/"), impfilename))
 
-    if use_tqdm:
-        file_iter = tqdm(base_files)
+
+def update_pak(pak_path, files: dict, remove: list=(), dedup: bool=False, metrics=None) -> dict:
+    # Add or replace files ({name in the pak: path on disk or ZipMember}) and remove names in an existing pak without
+    # rewriting the rest of it, so it takes time in proportion to the changed bytes.
+    # Returns counts of what changed and how much dead space the pak now has, see PakWriter for how it's done.
+    pak_path = Path(pak_path)
+    stats = {'added': 0, 'replaced': 0, 'removed': 0, 'bytes': 0}
+    with phase(metrics, 'pak_update', total_files=len(files), pak=pak_path.name) as timing, PakWriter(pak_path, dedup=dedup, append=True) as writer:
+        for name in remove:
+            if writer.remove(name):
+                stats['removed'] += 1
+        for name, file in files.items():
+            stats['replaced' if name in writer else 'added'] += 1
+            if isinstance(file, ZipMember):
+                with file.open() as fileobj:
+                    length = writer.add_fileobj(name, fileobj)
+            else:
+                length = writer.add_file(name, file)
+            stats['bytes'] += length
+            timing.add(files=1, bytes=length)
+        if len(writer) > MAX_FILES_PER_PAK:
+            print(f'Warning: {pak_path.name} now has {len(writer)} files, more than the {MAX_FILES_PER_PAK} a pak should have.')
+    with PakArchive(pak_path) as archive:
+        stats['dead_bytes'] = archive.dead_bytes()
+        stats['size'] = archive.size
+    return stats
+
+
+def compact_pak(pak_path, metrics=None) -> int:
+    # Rewrite a pak with only the data its directory still points at, in the same order. Entries that share data
+    # keep sharing it. Returns the number of bytes reclaimed.
+    pak_path = Path(pak_path)
+    temp_path = pak_path.with_name(pak_path.name + '.tmp')
+    with PakArchive(pak_path) as archive:
+        old_size = archive.size
+        if not archive.dead_bytes():
+            return 0
+        try:
+            with phase(metrics, 'pak_compact', total_files=len(archive), pak=pak_path.name) as timing, PakWriter(temp_path) as writer:
+                # (old offset, length) -> new offset, for entries pointing at the same data
+                moved = {}
+                for name, (offset, length) in archive.entries.items():
+                    if (offset, length) in moved:
+                        writer._add_entry(name, moved[offset, length], length)
+                        continue
+                    moved[offset, length] = writer.offset
+                    with archive.read(name) as data:
+                        writer.add_data(name, data)
+                    timing.add(files=1, bytes=length)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+    os.replace(temp_path, pak_path)
+    return old_size - pak_path.stat().st_size
+
+
+class ZipMember:
+    # A file inside a zip archive, used as a pak source without extracting it first
+    def __init__(self, zip_file: zipfile.ZipFile, info: zipfile.ZipInfo):
+        self.zip_file = zip_file
+        self.info = info
+        self.name = info.filename.rstrip('/').split('/')[-1]
+
+    def __str__(self):
+        return f'{self.zip_file.filename}:{self.info.filename}'
+
+    def open(self):
+        # ZipFile can read different members from several threads at once
+        return self.zip_file.open(self.info)
+
+    @property
+    def mtime_ns(self) -> int:
+        # Zip timestamps only have 2 second resolution and no timezone, which is fine for spotting changes
+        return int(datetime(*self.info.date_time).timestamp()) * 10**9
+
+    @property
+    def hash(self) -> str:
+        # The CRC from the zip directory is free, and good enough to tell if a member changed between builds
+        return f'crc32:{self.info.CRC:08x}'
+
+
+def copy_source(file, dest: Path):
+    # Copy a source file (on disk or in a zip) to dest
+    if isinstance(file, ZipMember):
+        with file.open() as src, open(dest, 'wb') as dst:
+            shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
     else:
-        file_iter = base_files
+        shutil.copy(file, dest)
 
-    for file in file_iter:
-        if file.is_file():
-            # Check if this file should be ignored
-            if ignore_files and file.name in ignore_files:
-                print_fcn(f'  Skipping {file}')
-                continue
 
-            # Create necessary subdirectories in dst
-            relative_path = file.relative_to(in_path)
-            new_dst = out_path / relative_path.parent
-            new_dst.mkdir(parents=True, exist_ok=True)
-            # Copy file to new destination
-            if verbose:
-                print_fcn(f'Copying {file} to {new_dst}')
-            shutil.copy(file, new_dst)
-    print_fcn(f'Copy complete.\n')
+def collect_zip_files(source_zip: Path, folder: str, zip_prefix: str='', print_fcn: callable=print, use_tqdm: bool=None) -> dict:
+    # List the files under folder in a zip, as if the zip had been extracted with zip_prefix stripped from the member names.
+    # Returns relpath (posix) -> ZipMember, nothing is read or extracted yet.
+    print_fcn(f'Scanning files in {source_zip}...')
+    zip_file = zipfile.ZipFile(source_zip)
+    folder = Path(folder).as_posix().strip('/') + '/'
+    files = {}
+    infos = zip_file.infolist()
+    for info in progress(infos, use_tqdm):
+        name = info.filename.replace(zip_prefix, '', 1) if info.filename.startswith(zip_prefix) else info.filename
+        if info.is_dir() or not name.startswith(folder):
+            continue
+        files[name[len(folder):]] = ZipMember(zip_file, info)
+    return files
 
-    # Copy all of the files from the overwrites to the output directory, preserving directory structure
+
+def collect_overlay_files(in_path: Path, also_include_overwrites: list=None, ignore_files: list=None, print_fcn: callable=print, use_tqdm: bool=None, source_zip: Path=None, zip_prefix: str='', ignore_suffixes: tuple=(), metrics=None, index_cache=None) -> dict:
+    # Resolve the winning source file for every relative path across the base and overlay layers, without copying anything.
+    # Later layers win, just like copying them over the base in order would.
+    # Each layer on disk is walked once, the files come back as IndexedFiles with their size and mtime from that walk.
+    # Pass a path_util.TreeIndexCache as index_cache to share those walks with other builds.
+    # With source_zip, the base layer is the in_path folder inside that zip instead of a folder on disk.
+    layers = [Path(in_path)]
     if also_include_overwrites:
         for path in also_include_overwrites:
             new_dir = rewrite_path_for_os(Path(path))
             if not new_dir.exists():
                 print_fcn(f'Error: {new_dir} does not exist, skipping.')
                 continue
-            print_fcn(f'Copying files from {new_dir} to output directory...')
-            files = list(Path(new_dir).rglob("*"))
+            layers.append(new_dir)
 
-            if use_tqdm:
-                file_iter = tqdm(files)
-            else:
-                file_iter = files
-            for file in file_iter:
-                if file.is_file():
-                    # Check if this file should be ignored
-                    if ignore_files and file.name in ignore_files:
-                        print_fcn(f'  Skipping {file}')
-                        continue
+    def layer_files(layer: Path) -> list:
+        if source_zip is not None and layer is layers[0]:
+            return list(collect_zip_files(source_zip, in_path, zip_prefix, print_fcn=print_fcn, use_tqdm=use_tqdm).items())
+        if index_cache is not None:
+            return list(index_cache.get(layer, on_scan=lambda: print_fcn(f'Scanning files in {layer}...')).files.items())
+        print_fcn(f'Scanning files in {layer}...')
+        return list(TreeIndex(layer).files.items())
 
-                    # Create necessary subdirectories in dst
-                    relative_path = file.relative_to(new_dir)
-                    new_dst = out_path / relative_path.parent
-                    new_dst.mkdir(parents=True, exist_ok=True)
-                    # Copy file to new destination
-                    if verbose:
-                        print_fcn(f'Copying {file} to {new_dst}')
-                    shutil.copy(file, new_dst)
-            print_fcn(f'Copy complete.\n')
-
-    # Bundle up all of the subdirectories into pak files
-    # Split files into chunks, put each chunk into a pak file
-    pak_num = 0
-    print_fcn(f'Output path: {out_path}')
-    final_files = list(Path(out_path).rglob("*"))
-    num_files = len(final_files)
-
-    # Switch to the output directory
-    os.chdir(out_path)
-    pak_files_source_dir = Path(out_path / 'pak_files')
-    pak_files_source_dir.mkdir(parents=True, exist_ok=True)
-
-    # Iterate through the files and move them into pak files if appropriate
-    file_iter = tqdm(final_files, desc='Staging files for pak_files') if use_tqdm else final_files
-    for file in file_iter:
-        if file.is_dir():
-            # This is a directory, don't try to copy it
-            continue
-        # Filter out viewmodels, they start with v_ and end with .mdl
-        if file.name.startswith('v_') and file.name.endswith('.mdl'):
-            print_fcn(f'  Skipping viewmodel: {file}')
-            # Delete it from the output directory
-            file.unlink()
-            continue
+    scanned = []
+    for layer in layers:
+        with phase(metrics, 'scan', layer=source_zip if source_zip is not None and layer is layers[0] else layer) as timing:
+            scanned.append(layer_files(layer))
+            timing.add(files=len(scanned[-1]), bytes=sum(file.info.file_size if isinstance(file, ZipMember) else file.size for _, file in scanned[-1]))
 
-        relpath: Path = file.relative_to(out_path)
-        # If it's in the root, don't do anything
-        if relpath.parent == Path():
-            continue
+    # Keyed on the normalized path so that overlays replace base files the same way the filesystem would (case-insensitive on Windows)
+    resolved = {}
+    with phase(metrics, 'overlay_merge') as timing:
+        for layer in scanned:
+            for relpath, file in layer:
+                # Check if this file should be ignored
+                if (ignore_files and file.name in ignore_files) or file.name.endswith(tuple(ignore_suffixes)):
+                    print_fcn(f'  Skipping {file}')
+                    continue
+
+                key = os.path.normcase(relpath)
+                # Keep the name of the first copy, the same as overwriting an existing file keeps its name
+                name = resolved[key][0] if key in resolved else relpath
+                resolved[key] = (name, file)
+        timing.add(files=len(resolved))
+    print_fcn('Scan complete.\n')
+
+    return dict(resolved.values())
+
+
+def new_digest():
+    # The content hash used for manifests and pak verification
+    return hashlib.blake2b(digest_size=16)
+
+
+def data_matches_hash(data, expected: str) -> bool:
+    # Check data against a manifest hash, files that came from a zip are recorded by their CRC instead
+    if expected.startswith('crc32:'):
+        return f'crc32:{zlib.crc32(data):08x}' == expected
+    digest = new_digest()
+    digest.update(data)
+    return digest.hexdigest() == expected
+
+
+def file_digest(filename) -> str:
+    # Hash the contents of a file without reading it into memory all at once
+    digest = new_digest()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def manifest_path_for(out_path: Path) -> Path:
+    # The manifest lives next to the output directory so it doesn't get pushed to the device with it
+    return out_path.parent / f'{out_path.name}.manifest.json'
+
+
+def load_manifest(out_path: Path, options: dict) -> dict:
+    # Load the manifest from the last build of out_path, returns None if there isn't a usable one
+    manifest_path = manifest_path_for(out_path)
+    if not out_path.exists() or not manifest_path.exists():
+        return None
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # Anything built with different settings can't be reused
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('options') != options:
+        return None
+    return manifest
+
+
+def save_manifest(out_path: Path, manifest: dict):
+    # Write to a temporary file first so a crash never leaves a half-written manifest behind
+    manifest_path = manifest_path_for(out_path)
+    tmp_path = manifest_path.with_name(manifest_path.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+
+def pak_size(num_files: int, data_bytes: int) -> int:
+    # Total size of a pak file holding num_files files adding up to data_bytes
+    return PAK_HEADER.size + data_bytes + num_files * PAK_ENTRY.size
+
+
+def format_size(num_bytes: int) -> str:
+    size = float(num_bytes)
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024 or unit == 'GiB':
+            return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+        size /= 1024
+
+
+def plan_chunks(sizes: dict, max_chunk_size: int=MAX_FILES_PER_PAK, max_chunk_bytes: int=MAX_BYTES_PER_PAK, previous: dict=None, groups: dict=None) -> list:
+    # Split the pak entries (name -> size) into chunks that stay under both the file count and the byte limits.
+    # Names that were in a pak last time stay in that pak if it still has room, so that one new file doesn't shift every later pak.
+    # Everything else goes largest first into whichever pak is emptiest, so the paks come out about the same size.
+    # Names that share a key in groups (e.g. a content hash when deduplicating) are kept in the same pak and their data only counted once.
+    max_chunk_bytes = min(max_chunk_bytes, MAX_PAK_OFFSET)
+    units = {}
+    for name in sorted(sizes):
+        units.setdefault(groups.get(name, name) if groups else name, []).append(name)
+    units = [names[i:i + max_chunk_size] for names in units.values() for i in range(0, len(names), max_chunk_size)]
+
+    total_bytes = pak_size(len(sizes), sum(sizes[names[0]] for names in units))
+    num_chunks = max(-(-len(sizes) // max_chunk_size), -(-total_bytes // max_chunk_bytes), 1)
+    chunks = [[] for _ in range(num_chunks)]
+    chunk_bytes = [0] * num_chunks
+
+    def fits(pak_num: int, names: list) -> bool:
+        num_files = len(chunks[pak_num]) + len(names)
+        return num_files <= max_chunk_size and pak_size(num_files, chunk_bytes[pak_num] + sizes[names[0]]) <= max_chunk_bytes
+
+    def add(pak_num: int, names: list):
+        chunks[pak_num].extend(names)
+        chunk_bytes[pak_num] += sizes[names[0]]
+
+    previous = previous or {}
+    pending = []
+    for names in units:
+        pak_num = previous.get(names[0])
+        if pak_num is not None:
+            while len(chunks) <= pak_num:
+                chunks.append([])
+                chunk_bytes.append(0)
+            if fits(pak_num, names):
+                add(pak_num, names)
+                continue
+        pending.append(names)
 
-        # Put the file in the pak_files dir, keeping the directory structure
-        if len(str(relpath)) > 56:
-            # This file is too long!
-            print_fcn(f'  Error: path {relpath} is too long for pak file (56 char limit). Skipping.')
+    for names in sorted(pending, key=lambda names: (-sizes[names[0]], names[0])):
+        candidates = [pak_num for pak_num in range(len(chunks)) if fits(pak_num, names)]
+        if candidates:
+            add(min(candidates, key=lambda pak_num: (chunk_bytes[pak_num], pak_num)), names)
         else:
-            # Move the file to the pak_files dir
+            chunks.append([])
+            chunk_bytes.append(0)
+            add(len(chunks) - 1, names)
+
+    # Drop trailing empty paks, but always make at least one
+    while len(chunks) > 1 and not chunks[-1]:
+        chunks.pop()
+    return [sorted(chunk) for chunk in chunks]
+
+
+def make_hl_pak(in_path: Path, out_path: Path, also_include_overwrites: list=None, ignore_files: list=None, print_fcn: callable=print, verbose: bool=False, max_chunk_size: int=MAX_FILES_PER_PAK, use_tqdm: bool=None, incremental: bool=True, jobs: int=1, max_chunk_bytes: int=MAX_BYTES_PER_PAK, dedup: bool=False, source_zip: Path=None, zip_prefix: str='', ignore_suffixes: tuple=(), metrics=None, index_cache=None, io_slots=None, on_file_ready: callable=None, prune: bool=False, prune_keep: list=(), patch: bool=False, patch_rollup: float=PATCH_ROLLUP_FRACTION):
+    # With source_zip, in_path is a folder inside that zip and its members are streamed straight into the paks.
+    # Pass a metrics_util.BuildMetrics as metrics to get the time, files and bytes of each phase of the build.
+    # When several builds run at once, they can share index_cache (a path_util.TreeIndexCache) so each source folder is
+    # only scanned once, and io_slots (a threading.Semaphore) to limit how many of them hash or write paks at the same time.
+    # on_file_ready(relpath) is called (from any thread) as soon as each loose file or pak file it writes is complete,
+    # so it can be sent on while the rest is still being built.
+    # With prune, models, sounds, wads and skies that no map, model, text file or the game code references are left out,
+    # except for the glob patterns in prune_keep, see prune_util.prune_unreachable.
+    # With patch, the existing paks are left alone and everything that changed since the last build goes into one new
+    # pak numbered after them, which the engine loads over the rest. Once the patches add up to more than patch_rollup
+    # of the full paks, or files were deleted, the next build rolls them back in and only rewrites the full paks they touch.
+    io_slot = (lambda: io_slots) if io_slots is not None else nullcontext
+    out_path = rewrite_path_for_os(Path(out_path))
+    print_fcn(f'Output path: {out_path}')
+
+    # If the last build of this output used the same settings, only rewrite what changed since then
+    options = {
+        'sources': [f'{source_zip}:{zip_prefix}{in_path}' if source_zip else str(in_path)] + [str(path) for path in also_include_overwrites or []],
+        'ignore_files': sorted(ignore_files or []),
+        'ignore_suffixes': sorted(ignore_suffixes),
+        'max_chunk_size': max_chunk_size,
+        'max_chunk_bytes': max_chunk_bytes,
+        'dedup': dedup,
+    }
+    if prune:
+        options['prune_keep'] = sorted(prune_keep)
+    max_chunk_bytes = min(max_chunk_bytes, MAX_PAK_OFFSET)
+    manifest = load_manifest(out_path, options) if incremental else None
+    can_patch = patch and manifest is not None
+    if manifest is None:
+        # Delete the output directory if it already exists
+        if out_path.exists():
+            shutil.rmtree(out_path)
+        manifest = {'version': MANIFEST_VERSION, 'options': options, 'files': {}, 'paks': {}}
+    else:
+        print_fcn('Found a manifest from the last build, only changed paks will be rebuilt.')
+    # Ensure the output path exists
+    out_path.mkdir(parents=True, exist_ok=True)
+    previous_files = manifest['files']
+    # What the last build left in the output directory, so the checks below don't have to hit the disk one file at a time
+    out_index = TreeIndex(out_path)
+
+    # Work out which file wins for every path across the base HL files and the overwrites
+    files = collect_overlay_files(in_path, also_include_overwrites, ignore_files=ignore_files, print_fcn=print_fcn, use_tqdm=use_tqdm,
+                                  source_zip=source_zip, zip_prefix=zip_prefix, ignore_suffixes=ignore_suffixes, metrics=metrics, index_cache=index_cache)
+    if prune:
+        from prune_util import prune_unreachable, save_prune_report, prune_report_path_for
+        print_fcn('Looking for files nothing references...')
+        with io_slot(), phase(metrics, 'prune', total_files=len(files)) as timing:
+            files, report = prune_unreachable(files, keep=prune_keep, print_fcn=print_fcn, timing=timing)
+        save_prune_report(out_path, report)
+        if report['pruned']:
+            print_fcn(f'  Saved the list of pruned files to {prune_report_path_for(out_path)}')
+
+    def record_for(relpath: str, file) -> (dict, bool):
+        # Returns the manifest record for a source file and whether it changed since the last build.
+        # New and resized files are changed whatever their contents, so only their size and mtime are recorded. The
+        # contents only get hashed when the size is the same as last time but the mtime isn't, since that's the only
+        # way to tell, and then the hash is kept so the next build can compare against it.
+        prev = previous_files.get(relpath)
+        if isinstance(file, ZipMember):
+            # Zip members come with a CRC, so there's nothing to hash
+            record = {'source': str(file), 'size': file.info.file_size, 'mtime_ns': file.mtime_ns, 'hash': file.hash, 'pak': None}
+            return record, not (prev and prev['source'] == record['source'] and prev['size'] == record['size'] and prev['hash'] == record['hash'])
+        # The size and mtime come from the scan
+        record = {'source': str(file), 'size': file.size, 'mtime_ns': file.mtime_ns, 'hash': None, 'pak': None}
+        if prev and prev['source'] == record['source'] and prev['size'] == record['size']:
+            if prev['mtime_ns'] == record['mtime_ns']:
+                record['hash'] = prev['hash']
+                return record, False
+            hashing.add(bytes=file.size)
+            record['hash'] = file_digest(file)
+            return record, prev['hash'] is None or record['hash'] != prev['hash']
+        return record, True
+
+    # Sort the files into pak entries and loose files, only the loose files get written to the output directory
+    pak_entries = {}
+    records = {}
+    changed = set()
+    out_dirs = set()
+    loose_files = []
+    # Counts every file checked, and the bytes of the ones that actually had to be hashed
+    hashing = phase(metrics, 'hash', total_files=len(files))
+    with io_slot(), hashing:
+        for relpath, file in sorted(files.items()):
+            hashing.add(files=1)
+            relpath = Path(relpath)
+            out_dirs.add(relpath.parent)
+            # Filter out viewmodels, they start with v_ and end with .mdl
+            if relpath.name.startswith('v_') and relpath.name.endswith('.mdl'):
+                print_fcn(f'  Skipping viewmodel: {file}')
+                continue
+
+            name = relpath.as_posix()
+            records[name], is_changed = record_for(name, file)
+            if is_changed:
+                changed.add(name)
+
+            # Files in the root, and files that can't go in a pak, are left loose in the output directory
+            too_long = len(name) > MAX_PAK_NAME_LEN
+            too_big = pak_size(1, records[name]['size']) > max_chunk_bytes
+            if relpath.parent == Path() or too_long or too_big:
+                if relpath.parent != Path() and too_long:
+                    # This file is too long! Leave it loose in the output directory instead
+                    print_fcn(f'  Error: path {relpath} is too long for pak file (56 char limit). Skipping.')
+                elif relpath.parent != Path():
+                    print_fcn(f'  Error: {relpath} is too big for a pak file ({format_size(records[name]["size"])}). Skipping.')
+                if is_changed or name not in out_index:
+                    loose_files.append((relpath, file))
+            else:
+                if verbose:
+                    print_fcn(f'  adding: {relpath}')
+                pak_entries[name] = file
+                # Dedup groups files by hash while planning, before anything is written
+                if dedup and records[name]['hash'] is None:
+                    hashing.add(bytes=file.size)
+                    records[name]['hash'] = file_digest(file)
+
+    with phase(metrics, 'loose_files', total_files=len(loose_files), total_bytes=sum(records[relpath.as_posix()]['size'] for relpath, _ in loose_files)) as timing:
+        for relpath, file in loose_files:
             if verbose:
-                print_fcn(f'  adding: {relpath}')
-            # Create necessary subdirectories in dst
-            new_dst = pak_files_source_dir / relpath.parent
-            new_dst.mkdir(parents=True, exist_ok=True)
-            # Move file to new destination
-            shutil.move(file, pak_files_source_dir / relpath)
-
-    # Break the pak_files dir into chunks if there are more than max_chunk_size files in it
-    pak_files = list(Path(pak_files_source_dir).rglob("*"))
-    num_pak_files = len(pak_files)
-    if num_pak_files > max_chunk_size:
-        # Split the directory into however many chunks are needed
-        num_chunks = math.ceil(num_pak_files / max_chunk_size)
-        for i in range(0, num_chunks):
-            # Create a new pak_files dir for each chunk
-            new_pak_files_dir = pak_files_source_dir / f'pak_files_{i}'
-            new_pak_files_dir.mkdir(parents=True, exist_ok=True)
-            for file in pak_files[i * max_chunk_size: (i + 1) * max_chunk_size]:
-                if file.is_dir():
-                    # This is a directory, don't try to copy it
-                    continue
-                relpath: Path = file.relative_to(out_path)
-                relpath: Path = file.relative_to(out_path)
-                # Create necessary subdirectories in dst
-                new_dst = new_pak_files_dir / relpath.parent
-                new_dst.mkdir(parents=True, exist_ok=True)
-                # Move file to new destination
-                shutil.move(file, new_pak_files_dir / relpath)
-
-            # Create a pak file for this chunk
+                print_fcn(f'Copying {file} to {out_path / relpath.parent}')
+            (out_path / relpath.parent).mkdir(parents=True, exist_ok=True)
+            copy_source(file, out_path / relpath)
+            timing.add(files=1, bytes=records[relpath.as_posix()]['size'])
+            if on_file_ready is not None:
+                on_file_ready(relpath.as_posix())
+
+    # Remove loose files from the last build whose sources are gone
+    for name, prev in previous_files.items():
+        if prev['pak'] is None and name not in records and name in out_index:
+            (out_path / name).unlink()
+
+    # Recreate the directory structure so that it is preserved on the device
+    for dir in out_dirs:
+        (out_path / dir).mkdir(parents=True, exist_ok=True)
+
+    # Decide whether the changed pak entries can go in a patch pak, or the patches so far have to be rolled up
+    previous_patches = manifest.get('patches', [])
+    patch_names = sorted(name for name in pak_entries if name in changed)
+    sizes = {name: records[name]['size'] for name in pak_entries}
+    # A patch pak can only add or replace files, anything that has to come out of a pak means rewriting that pak
+    removed = [name for name, prev in previous_files.items() if (prev['pak'] or prev.get('patch')) and name not in pak_entries]
+    patching = can_patch
+    patch_pak = None
+    if can_patch:
+        patch_bytes = pak_size(len(patch_names), sum(sizes[name] for name in patch_names)) if patch_names else 0
+        base_bytes = sum(pak['size'] for pak in manifest['paks'].values())
+        total_patch_bytes = patch_bytes + sum(previous['size'] for previous in previous_patches)
+        if removed:
+            patching = False
+            print_fcn(f"{len(removed)} files are gone since the last build and a patch pak can't remove them, rewriting the paks they were in.")
+        elif total_patch_bytes > patch_rollup * base_bytes or len(patch_names) > max_chunk_size or patch_bytes > max_chunk_bytes:
+            patching = False
+            print_fcn(f'The patches would add up to {format_size(total_patch_bytes)} ({total_patch_bytes / max(base_bytes, 1):.0%} of the full paks), rolling them into the full paks.')
+        elif patch_names:
+            # Right after the highest numbered pak there is, the engine stops looking at the first gap
+            last_pak = max((int(name[3:-4]) for name in out_index.files if re.fullmatch(r'pak\d+\.pak', name)), default=-1)
+            patch_pak = f'pak{last_pak + 1}.pak'
+
+    if patching:
+        # Unchanged files stay where they were, changed ones remember which full pak they belong to for the rollup
+        for name in pak_entries:
+            prev = previous_files.get(name)
+            records[name]['pak'] = prev['pak'] if prev else None
+            if name in changed:
+                records[name]['patch'] = patch_pak
+            elif prev and prev.get('patch'):
+                records[name]['patch'] = prev['patch']
+        chunks = []
+        to_write = []
+        if patch_pak is not None:
+            print_fcn(f'Putting the {len(patch_names)} changed files in {patch_pak} ({format_size(patch_bytes)}), the other paks stay as they are.')
+            to_write.append((out_path / patch_pak, patch_names))
+        else:
+            print_fcn('Nothing changed, the paks are up to date.')
+    else:
+        # Rolling the patches in: the full paks holding anything that was patched have to be rewritten
+        changed.update(name for name in pak_entries if previous_files.get(name, {}).get('patch'))
+        # Bundle up the pak entries into pak files
+        # Split the entries into chunks that respect both max_chunk_size and max_chunk_bytes, put each chunk into a pak file
+        previous_paks = {name: int(prev['pak'][3:-4]) for name, prev in previous_files.items() if prev['pak']}
+        # When deduplicating, files with the same contents go in the same pak so they can share one copy
+        groups = {name: records[name]['hash'] for name in pak_entries} if dedup else None
+        with phase(metrics, 'chunking') as timing:
+            chunks = plan_chunks(sizes, max_chunk_size, max_chunk_bytes, previous=previous_paks, groups=groups)
+            timing.add(files=len(sizes), bytes=sum(sizes.values()))
+        print_fcn(f'Planned {len(chunks)} pak files for {len(pak_entries)} files:')
+        to_write = []
+        for pak_num, chunk in enumerate(chunks):
             pak_name = f'pak{pak_num}.pak'  # e.g. pak0.pak, pak1.pak, etc.
             pak_path = out_path / pak_name
-            print_fcn(f'Creating pak file: {pak_name}')
-            dir_to_pak(str(new_pak_files_dir / 'pak_files'), pak_path)
-            # Delete the pak_files dir
-            shutil.rmtree(new_pak_files_dir)
-            pak_num += 1
+            for name in chunk:
+                records[name]['pak'] = pak_name
+            if dedup:
+                planned_size = pak_size(len(chunk), sum({groups[name]: sizes[name] for name in chunk}.values()))
+            else:
+                planned_size = pak_size(len(chunk), sum(sizes[name] for name in chunk))
+            print_fcn(f'  {pak_name}: {len(chunk)} files ({len(chunk) / max_chunk_size:.0%} of {max_chunk_size}), {format_size(planned_size)} ({planned_size / max_chunk_bytes:.0%} of {format_size(max_chunk_bytes)})')
+
+            # Only rewrite the pak if its contents would be any different from last time
+            previous_chunk = sorted(name for name, num in previous_paks.items() if num == pak_num)
+            previous_size = manifest['paks'].get(pak_name, {}).get('size')
+            existing = out_index.get(pak_name)
+            if chunk == previous_chunk and not changed.intersection(chunk) and existing is not None and existing.size == previous_size:
+                print_fcn(f'{pak_name} is up to date, skipping.')
+            else:
+                to_write.append((pak_path, chunk))
+
+    def write_pak(pak_path: Path, chunk: list, position: int=0) -> PakWriter:
+        print_fcn(f'Creating pak file: {pak_path.name}')
+        try:
+            with io_slot(), phase(metrics, 'pak_write', total_files=len(chunk), total_bytes=sum(sizes[name] for name in chunk), pak=pak_path.name) as timing, PakWriter(pak_path, dedup=dedup) as writer:
+                for name in progress(chunk, use_tqdm, desc=pak_path.name, position=position):
+                    file = pak_entries[name]
+                    if isinstance(file, ZipMember):
+                        with file.open() as fileobj:
+                            length = writer.add_fileobj(name, fileobj)
+                    else:
+                        length = writer.add_file(name, file)
+                    timing.add(files=1, bytes=length)
+        except BuildCancelled:
+            # Don't leave a half-written pak behind for the next build to trust
+            pak_path.unlink(missing_ok=True)
+            raise
+        if on_file_ready is not None:
+            on_file_ready(pak_path.name)
+        return writer
+
+    # The chunks are independent of each other, so they can be written at the same time
+    if jobs > 1 and len(to_write) > 1:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(write_pak, pak_path, chunk, i) for i, (pak_path, chunk) in enumerate(to_write)]
+            writers = [future.result() for future in futures]
+    else:
+        writers = [write_pak(pak_path, chunk) for pak_path, chunk in to_write]
+    if dedup and writers:
+        duplicates = sum(writer.duplicates for writer in writers)
+        bytes_saved = sum(writer.bytes_saved for writer in writers)
+        print_fcn(f'Deduplicated {duplicates} files, saved {format_size(bytes_saved)}.')
+    if patching:
+        paks = manifest['paks']
+        patches = previous_patches
+        if patch_pak is not None:
+            patches = patches + [{'pak': patch_pak, 'size': (out_path / patch_pak).stat().st_size, 'files': len(patch_names)}]
     else:
-        # Create a pak file for the pak_files dir
-        pak_name = f'pak{pak_num}.pak'
-        pak_path = out_path / pak_name
-        print_fcn(f'Creating pak file: {pak_name}')
-        dir_to_pak(str(pak_files_source_dir), pak_path)
-
-    # Delete the pak_files dir
-    shutil.rmtree(pak_files_source_dir)
-
-    # Loop through the empty dirs and add a KEEP_ME file to each one to preserve the directory structure
-    empty_dirs = list(Path(out_path).rglob("*"))
-    for dir in empty_dirs:
-        if dir.is_dir() and not list(dir.rglob("*")):
-            # This directory is empty
-            keep_me_file = dir / 'KEEP_ME'
-            keep_me_file.touch()
+        paks = {f'pak{pak_num}.pak': {'size': (out_path / f'pak{pak_num}.pak').stat().st_size} for pak_num in range(len(chunks))}
+        patches = []
+
+        # Delete any leftover paks (and rolled up patches) from a previous build that had more of them
+        for name, file in out_index.files.items():
+            if '/' not in name and name.startswith('pak') and name.endswith('.pak') and name not in paks:
+                print_fcn(f'Removing old pak file: {name}')
+                file.path.unlink()
+
+    manifest['files'] = records
+    manifest['paks'] = paks
+    manifest['patches'] = patches
+    with phase(metrics, 'manifest'):
+        save_manifest(out_path, manifest)
+    for zip_file in {file.zip_file for file in files.values() if isinstance(file, ZipMember)}:
+        zip_file.close()
+
+    with phase(metrics, 'empty_dirs'):
+        add_keep_me_files(out_path)
+
 
+def add_keep_me_files(out_path: Path):
+    # Add a KEEP_ME file to each empty dir to preserve the directory structure, found with one walk of the output
+    for dir in TreeIndex(out_path).empty_dirs():
+        keep_me_file = dir / 'KEEP_ME'
+        keep_me_file.touch()
@@ -0,0 +1,102 @@
+import os
+import threading
+from pathlib import Path
+
+
+IS_WINDOWS = os.name == 'nt'
+
+def rewrite_path_for_os(path: Path) -> Path:
+    if IS_WINDOWS:
+        return Path(str(path).replace('/', '\\'))
+
+    return Path(str(path).replace('\\', '/'))
+
+
+class IndexedFile:
+    # A file found by TreeIndex, carrying the size and mtime from the scan so nothing has to stat it again.
+    # Works anywhere a path does (open, shutil.copy, ...) through __fspath__.
+    __slots__ = ('path', 'size', 'mtime_ns')
+
+    def __init__(self, path: Path, size: int, mtime_ns: int):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+
+    def __fspath__(self):
+        return str(self.path)
+
+    def __str__(self):
+        return str(self.path)
+
+    def __repr__(self):
+        return f'IndexedFile({str(self.path)!r}, {self.size})'
+
+    @property
+    def name(self) -> str:
+        return self.path.name
+
+
+class TreeIndex:
+    # Everything under root from a single os.scandir walk.
+    # files maps each relative path (posix) to an IndexedFile, dirs maps each folder's relative path ('' for root)
+    # to how many entries it has, so empty folders can be found without walking again.
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.files = {}
+        self.dirs = {}
+        if not self.root.is_dir():
+            return
+        stack = [(str(self.root), '')]
+        while stack:
+            dir_path, rel_dir = stack.pop()
+            count = 0
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    count += 1
+                    rel = f'{rel_dir}/{entry.name}' if rel_dir else entry.name
+                    # Symlinks aren't followed, so a link back up the tree can't send the walk round forever
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append((entry.path, rel))
+                    elif entry.is_file(follow_symlinks=False):
+                        st = entry.stat(follow_symlinks=False)
+                        self.files[rel] = IndexedFile(Path(entry.path), st.st_size, st.st_mtime_ns)
+            self.dirs[rel_dir] = count
+
+    def __len__(self):
+        return len(self.files)
+
+    def __contains__(self, relpath):
+        return relpath in self.files
+
+    def get(self, relpath: str) -> IndexedFile:
+        return self.files.get(relpath)
+
+    def total_bytes(self) -> int:
+        return sum(file.size for file in self.files.values())
+
+    def empty_dirs(self) -> list:
+        # Folders under root (not root itself) with nothing at all in them
+        return [self.root / rel for rel, count in self.dirs.items() if rel and not count]
+
+
+class TreeIndexCache:
+    # Shares TreeIndexes between builds, so presets that use the same source folder only walk it once.
+    # Safe to use from several threads, a folder being indexed by one thread is waited on by the others.
+
+    def __init__(self):
+        self._indexes = {}
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    def get(self, root, on_scan: callable=None) -> TreeIndex:
+        # on_scan() is called just before root is walked, which only happens the first time it's asked for
+        key = os.path.normcase(os.path.abspath(root))
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self._indexes:
+                if on_scan is not None:
+                    on_scan()
+                self._indexes[key] = TreeIndex(root)
+            return self._indexes[key]
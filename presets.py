@@ -1,34 +1,51 @@
-from tqdm import tqdm
+import os
 from pathlib import Path
 
 THIS_FILE = Path(__file__).resolve()
 ROOT_DIR = THIS_FILE.parent
 ADB_ZIP = ROOT_DIR / 'platform-tools.zip'
+# Extracted tools and downloads are kept here between runs
+CACHE_DIR = Path(os.environ.get('HL_PAKER_CACHE_DIR') or Path(os.environ.get('LOCALAPPDATA') or Path.home() / '.cache') / 'hl-paker')
 
-# Test TQDM to see if it works, if not then disable it
-TQDM_AVAILABLE = True
-try:
-    for i in tqdm(range(10)):
-        pass
-    print('TQDM is available.')
-except:
-    TQDM_AVAILABLE = False
-    print('TQDM is not available.')
+# Whether TQDM works here (it doesn't in the windowed PyInstaller build), only tested the first time a progress bar is wanted
+_tqdm_available = None
+
+def tqdm_available() -> bool:
+    global _tqdm_available
+    if _tqdm_available is None:
+        try:
+            from tqdm import tqdm
+            for i in tqdm(range(10)):
+                pass
+            _tqdm_available = True
+        except:
+            _tqdm_available = False
+    return _tqdm_available
+
+def progress(iterable=None, use_tqdm: bool=None, **kwargs):
+    # Wrap iterable in a tqdm progress bar if use_tqdm (or tqdm_available() when it's None), tqdm is only imported here.
+    # Without an iterable this returns the bar to update by hand, or None when progress bars are off.
+    if use_tqdm is None:
+        use_tqdm = tqdm_available()
+    if not use_tqdm:
+        return iterable
+    from tqdm import tqdm
+    return tqdm(iterable, **kwargs)
 
 
 BASE_DIRS_TO_TRY = [
-    'C:\Program Files (x86)\Steam\steamapps\common\Half-Life',
-    'C:\Program Files\Steam\steamapps\common\Half-Life',
-    'C:\Sierra\Half-Life',
+    r'C:\Program Files (x86)\Steam\steamapps\common\Half-Life',
+    r'C:\Program Files\Steam\steamapps\common\Half-Life',
+    r'C:\Sierra\Half-Life',
     '~/Library/Application Support/Steam/steamapps/common/Half-Life',  # Mac
 ]
 
-# Add D-Z to the list of directories to try if you have it installed
+# Add D-Z to the list of directories to try if you have it installed, these are all checked at the same time
 # Iterate through alphabet
 for letter in range(ord('D'), ord('Z') + 1):
-    BASE_DIRS_TO_TRY.append(f'{chr(letter)}:\Program Files (x86)\Steam\steamapps\common\Half-Life')
-    BASE_DIRS_TO_TRY.append(f'{chr(letter)}:\Program Files\Steam\steamapps\common\Half-Life')
-    BASE_DIRS_TO_TRY.append(f'{chr(letter)}:\Sierra\Half-Life')
+    BASE_DIRS_TO_TRY.append(rf'{chr(letter)}:\Program Files (x86)\Steam\steamapps\common\Half-Life')
+    BASE_DIRS_TO_TRY.append(rf'{chr(letter)}:\Program Files\Steam\steamapps\common\Half-Life')
+    BASE_DIRS_TO_TRY.append(rf'{chr(letter)}:\Sierra\Half-Life')
 
 LAMBDA1_APK_URL_QUEST = 'https://github.com/DrBeef/Lambda1VR/releases/download/v1.5.1/lambda1vr-v1.5.1.apk'
 LAUNCHER_APK_URL_QUEST = 'https://github.com/berndolauerto/Lambda1VR_Launcher/releases/download/2.1/Lambda1_Launcher_Quest.apk'
@@ -37,32 +54,29 @@ APK_CONFIGS = {
     'quest': {
         'lambda1': {
             'apk_url': LAMBDA1_APK_URL_QUEST,
+            'sha256': None,
             'name': 'com.drbeef.lambda1vr',
         },
         'launcher': {
             'apk_url': LAUNCHER_APK_URL_QUEST,
+            'sha256': None,
             'name': 'com.CactusStudios.Lambda1VR_Launcher',
         }
     },
 }
 
 HL_GOLD_HD_URL = 'https://github.com/ryan-cranfill/hl-paker/releases/download/0.1.1/hl_gold_hd.zip'
+# Fill in the expected sha256 of a download to have it verified, None just records whatever was downloaded
+HL_GOLD_HD_SHA256 = None
+# Everything in the HL Gold HD zip is inside this folder, it gets stripped off so the zip looks like an HL_Gold_HD game folder
+HL_GOLD_HD_ZIP_PREFIX = 'hl gold/'
 
 
 def search_for_halflife(additional_dirs=None) -> Path:
-    # Try to find the half-life directory
-    for dir in BASE_DIRS_TO_TRY:
-        p = Path(dir).expanduser()
-        if p.exists():
-            return p
-        
-    # If we didn't find it, try the additional directories if they were specified
-    if additional_dirs:
-        for dir in additional_dirs:
-            p = Path(dir).expanduser()
-        if p.exists():
-            return p
-    return 'Unable to find Half-Life directory.'
+    # Try to find the half-life directory, looking through the Steam libraries first (see steam_util.find_halflife).
+    # None if it couldn't be found.
+    from steam_util import find_halflife
+    return find_halflife(additional_dirs)
 
 
 presets = {
@@ -0,0 +1,316 @@
+import re
+import json
+import struct
+from bisect import bisect_left
+from fnmatch import fnmatchcase
+from pathlib import Path
+
+from pak_util import ZipMember
+
+
+# Only these kinds of files can be left out, everything else (maps, sprites, configs, text, ...) is always packed.
+# They're where nearly all the space goes, and what loads them can be seen in maps, models and the game code.
+PRUNABLE_SUFFIXES = ('.mdl', '.wav', '.wad')
+PRUNABLE_FOLDERS = ('gfx/env/',)
+# Files the engine loads by itself, or that can be played by name from the console and scripts
+ENGINE_ASSETS = [
+    'models/player.mdl', 'models/player/*', 'models/shell.mdl', 'models/shotgunshell.mdl',
+    'sound/common/*', 'sound/player/*', 'sound/items/*', 'sound/vox/*', 'sound/misc/*',
+    'gfx/env/desert*',
+    'decals.wad', 'gfx.wad', 'fonts.wad', 'cached.wad', 'spraypaint.wad', 'tempdecal.wad', 'pldecal.wad',
+]
+# Text files that can name other files, read whole
+TEXT_SUFFIXES = ('.txt', '.res', '.cfg', '.gam', '.lst', '.rc', '.scr')
+# The game code, where most of the model and sound names it loads are string constants
+CODE_FOLDERS = ('dlls/', 'cl_dlls/')
+CODE_SUFFIXES = ('.dll', '.so', '.dylib')
+MAX_TEXT_SIZE = 16 * 1024 * 1024
+
+# Anything that looks like a file name with one of the extensions that can be referenced, in text or in a binary
+PATH_PATTERN = re.compile(rb'[A-Za-z0-9_\-./\\%#*()!@+~]+\.(?:wav|mdl|spr|wad|tga|bmp)(?![A-Za-z0-9])', re.IGNORECASE)
+# printf style placeholders in names the game code builds, e.g. "player/pl_step%d.wav"
+FORMAT_PATTERN = re.compile(r'%[-+ #0]*\d*(?:\.\d+)?[diuxs]')
+# Characters the engine puts in front of sound names for streaming and spatialization
+SOUND_PREFIXES = '*#)(^@$'
+SKY_SIDES = ('up', 'dn', 'lf', 'rt', 'ft', 'bk')
+
+BSP_VERSION = 30
+BSP_HEADER = struct.Struct('<i30i')
+BSP_ENTITIES_LUMP = 0
+BSP_TEXTURES_LUMP = 2
+MIPTEX = struct.Struct('<16s2I4I')
+MDL_HEADER = struct.Struct('<4si64si')
+# Offsets of (numseq, seqindex, numseqgroups, seqgroupindex, numtextures) in the studio header
+MDL_COUNTS = struct.Struct('<5i')
+MDL_COUNTS_OFFSET = 164
+MDL_SEQ_SIZE = 176
+MDL_SEQ_EVENTS = struct.Struct('<2i')
+MDL_SEQ_EVENTS_OFFSET = 48
+MDL_EVENT = struct.Struct('<3i64s')
+MDL_SEQGROUP = struct.Struct('<32s64s2i')
+WAD_HEADER = struct.Struct('<4s2i')
+WAD_LUMP = struct.Struct('<3i2b2x16s')
+ENTITY_PAIR = re.compile(rb'"([^"]*)"\s*"([^"]*)"')
+
+
+def prune_report_path_for(out_path: Path) -> Path:
+    # Lives next to the output directory like the manifest, so it doesn't get pushed to the device
+    return out_path.parent / f'{out_path.name}.prune.json'
+
+
+def source_size(file) -> int:
+    return file.info.file_size if isinstance(file, ZipMember) else file.size
+
+
+def open_source(file):
+    return file.open() if isinstance(file, ZipMember) else open(file, 'rb')
+
+
+def read_at(f, offset: int, size: int) -> bytes:
+    f.seek(offset)
+    return f.read(size)
+
+
+def is_prunable(relpath: str) -> bool:
+    return relpath.endswith(PRUNABLE_SUFFIXES) or relpath.startswith(PRUNABLE_FOLDERS)
+
+
+def c_string(raw: bytes) -> str:
+    return raw.split(b'\0', 1)[0].decode('latin-1')
+
+
+def parse_entities(text: bytes) -> list:
+    # The entity lump as a list of {key: value} dicts
+    entities = []
+    for block in re.findall(rb'\{([^{}]*)\}', text):
+        entities.append({key.decode('latin-1').lower(): value.decode('latin-1') for key, value in ENTITY_PAIR.findall(block)})
+    return entities
+
+
+def bsp_references(f) -> (list, list):
+    # Names in a map's entities (models, sounds, sprites, sky, wads), and the textures it expects to find in wads
+    header = f.read(BSP_HEADER.size)
+    if len(header) < BSP_HEADER.size:
+        return [], []
+    version, *lumps = BSP_HEADER.unpack(header)
+    if version != BSP_VERSION:
+        return [], []
+    offset, length = lumps[BSP_ENTITIES_LUMP * 2:BSP_ENTITIES_LUMP * 2 + 2]
+    names = []
+    for entity in parse_entities(read_at(f, offset, length)):
+        for key, value in entity.items():
+            if key == 'skyname' and value:
+                names += [f'gfx/env/{value}{side}.tga' for side in SKY_SIDES]
+            elif key == 'wad':
+                names += [name for name in value.split(';') if name]
+            else:
+                names += [match.decode('latin-1') for match in PATH_PATTERN.findall(value.encode('latin-1'))]
+
+    # Textures stored with no pixel data are loaded from the wads
+    offset, length = lumps[BSP_TEXTURES_LUMP * 2:BSP_TEXTURES_LUMP * 2 + 2]
+    textures = []
+    if length >= 4:
+        count = struct.unpack('<i', read_at(f, offset, 4))[0]
+        for texture_offset in struct.unpack(f'<{max(count, 0)}i', f.read(4 * max(count, 0))):
+            if texture_offset < 0:
+                continue
+            raw = read_at(f, offset + texture_offset, MIPTEX.size)
+            if len(raw) < MIPTEX.size:
+                continue
+            name, _, _, *mip_offsets = MIPTEX.unpack(raw)
+            if not any(mip_offsets):
+                textures.append(c_string(name).lower())
+    return names, textures
+
+
+def mdl_references(f, relpath: str) -> list:
+    # A model's separate texture file and sequence group files, and the sounds its animation events play
+    header = f.read(MDL_HEADER.size)
+    if len(header) < MDL_HEADER.size or header[:4] != b'IDST':
+        return []
+    stem = relpath[:-len('.mdl')]
+    num_seq, seq_index, num_groups, group_index, num_textures = MDL_COUNTS.unpack(read_at(f, MDL_COUNTS_OFFSET, MDL_COUNTS.size))
+    # Texture files have no sequences of their own, so they don't get mistaken for a model missing its textures
+    names = [f'{stem}t.mdl'] if num_textures == 0 and num_seq > 0 else []
+    names += [f'{stem}{group:02}.mdl' for group in range(1, max(num_groups, 1))]
+    for group in range(1, max(num_groups, 1)):
+        raw = read_at(f, group_index + group * MDL_SEQGROUP.size, MDL_SEQGROUP.size)
+        if len(raw) == MDL_SEQGROUP.size:
+            names.append(c_string(MDL_SEQGROUP.unpack(raw)[1]))
+    for seq in range(max(num_seq, 0)):
+        raw = read_at(f, seq_index + seq * MDL_SEQ_SIZE + MDL_SEQ_EVENTS_OFFSET, MDL_SEQ_EVENTS.size)
+        if len(raw) < MDL_SEQ_EVENTS.size:
+            break
+        num_events, event_index = MDL_SEQ_EVENTS.unpack(raw)
+        events = read_at(f, event_index, MDL_EVENT.size * max(num_events, 0))
+        for _, _, _, options in MDL_EVENT.iter_unpack(events[:len(events) - len(events) % MDL_EVENT.size]):
+            names += [match.decode('latin-1') for match in PATH_PATTERN.findall(options.split(b'\0', 1)[0])]
+    return names
+
+
+def wad_textures(f) -> list:
+    # Names of the textures in a WAD3 file, from its directory
+    raw = f.read(WAD_HEADER.size)
+    if len(raw) < WAD_HEADER.size or raw[:4] not in (b'WAD3', b'WAD2'):
+        return []
+    _, count, directory = WAD_HEADER.unpack(raw)
+    entries = read_at(f, directory, WAD_LUMP.size * max(count, 0))
+    return [c_string(entry[-1]).lower() for entry in WAD_LUMP.iter_unpack(entries[:len(entries) - len(entries) % WAD_LUMP.size])]
+
+
+def sentence_sounds(text: bytes) -> list:
+    # Every sound a sentences.txt can play: "NAME dir/word word(p120) word," plays sound/dir/word.wav and so on
+    names = []
+    for line in text.decode('latin-1').splitlines():
+        words = line.split()
+        if not words or line.lstrip().startswith('//'):
+            continue
+        folder = 'vox'
+        for word in words[1:]:
+            word = re.sub(r'\(.*?\)', '', word).strip(',.')
+            if '/' in word:
+                folder, word = word.rsplit('/', 1)
+            if word:
+                names.append(f'sound/{folder}/{word}.wav')
+    return names
+
+
+class Resolver:
+    # Turns names found in files into the relative paths of the files they mean, the way the engine looks them up
+
+    def __init__(self, relpaths: list):
+        self.by_lower = {relpath.lower(): relpath for relpath in relpaths}
+        self.sorted = sorted(self.by_lower)
+        self.wads = {}
+        for lower, relpath in self.by_lower.items():
+            if lower.endswith('.wad'):
+                self.wads.setdefault(lower.rsplit('/', 1)[-1], relpath)
+
+    @staticmethod
+    def normalize(name: str) -> str:
+        name = re.sub('/+', '/', name.replace('\\', '/').lower()).lstrip(SOUND_PREFIXES).lstrip('/')
+        while name.startswith('./'):
+            name = name[2:]
+        return name
+
+    def resolve(self, name: str) -> list:
+        name = self.normalize(name)
+        if not name or name.startswith('!'):
+            # Sentence names, their sounds all come from sentences.txt
+            return []
+        if '%' in name:
+            return self._expand(name) + self._expand(f'sound/{name}')
+        candidates = [name, f'sound/{name}']
+        if name.endswith(('.tga', '.bmp')):
+            # The engine takes either kind of image, e.g. for the sky
+            candidates.append(name[:-4] + ('.bmp' if name.endswith('.tga') else '.tga'))
+        for candidate in candidates:
+            if candidate in self.by_lower:
+                return [self.by_lower[candidate]]
+        if name.endswith('.wad'):
+            # Maps name their wads by the path on the mapper's computer, the engine only uses the file name
+            relpath = self.wads.get(name.rsplit('/', 1)[-1])
+            return [relpath] if relpath else []
+        return []
+
+    def _expand(self, pattern: str) -> list:
+        # Every file a name built with printf placeholders could be, found from the part before the first placeholder
+        prefix = FORMAT_PATTERN.split(pattern, 1)[0]
+        regex = re.compile('.*'.join(re.escape(part) for part in FORMAT_PATTERN.split(pattern)) + '$')
+        matches = []
+        for lower in self.sorted[bisect_left(self.sorted, prefix):]:
+            if not lower.startswith(prefix):
+                break
+            if regex.match(lower):
+                matches.append(self.by_lower[lower])
+        return matches
+
+
+def prune_unreachable(files: dict, keep: list=(), print_fcn: callable=print, timing=None) -> (dict, dict):
+    # Leave out the models, sounds, wads and skies that nothing can load.
+    # Every map, text file and the game code are roots, and the references are followed through maps (entities,
+    # sky, wads and the textures they need), models (texture and sequence group files, event sounds),
+    # sentences.txt and any other text or .res file. keep is a list of extra glob patterns that are always packed.
+    # Returns (the files to pack, a report of what was left out and which references couldn't be found).
+    relpaths = {relpath.replace('\\', '/'): relpath for relpath in files}
+    resolver = Resolver(list(relpaths))
+    keep = [pattern.lower() for pattern in list(ENGINE_ASSETS) + list(keep)]
+
+    has_code = any(relpath.lower().startswith(CODE_FOLDERS) and relpath.lower().endswith(CODE_SUFFIXES) for relpath in relpaths)
+    if not has_code:
+        print_fcn(f'Not pruning: no game code in {" or ".join(CODE_FOLDERS)} to see which models and sounds it loads.')
+        return files, {'pruned': {}, 'missing': {}, 'skipped': 'no game code found'}
+
+    references = {}
+    textures_needed = {}
+    wad_contents = {}
+
+    def add_references(relpath: str, names: list):
+        for name in names:
+            found = resolver.resolve(name)
+            if found:
+                references.setdefault(relpath, set()).update(found)
+            elif not resolver.normalize(name).startswith('!') and '%' not in name:
+                missing.setdefault(resolver.normalize(name), set()).add(relpath)
+
+    missing = {}
+    roots = set()
+    for relpath in sorted(relpaths):
+        lower = relpath.lower()
+        file = files[relpaths[relpath]]
+        if not is_prunable(lower) or any(fnmatchcase(lower, pattern) for pattern in keep):
+            roots.add(relpath)
+        try:
+            with open_source(file) as f:
+                if lower.endswith('.bsp'):
+                    names, textures = bsp_references(f)
+                    add_references(relpath, names)
+                    textures_needed[relpath] = textures
+                elif lower.endswith('.mdl'):
+                    add_references(relpath, mdl_references(f, lower))
+                elif lower.endswith('.wad'):
+                    wad_contents[relpath] = wad_textures(f)
+                elif lower.endswith(TEXT_SUFFIXES) and source_size(file) <= MAX_TEXT_SIZE:
+                    text = f.read()
+                    if lower.endswith('sentences.txt'):
+                        add_references(relpath, sentence_sounds(text))
+                    add_references(relpath, [match.decode('latin-1') for match in PATH_PATTERN.findall(text)])
+                elif lower.startswith(CODE_FOLDERS) and lower.endswith(CODE_SUFFIXES):
+                    add_references(relpath, [match.decode('latin-1') for match in PATH_PATTERN.findall(f.read())])
+        except (OSError, struct.error, ValueError) as e:
+            # Can't tell what it references, so it and everything it might need stays
+            print_fcn(f'  Could not read {relpath} ({e}), keeping it.')
+            roots.add(relpath)
+        if timing is not None:
+            timing.add(files=1)
+
+    # A map also needs every wad that has one of the textures it doesn't carry itself
+    wads_by_texture = {}
+    for wad, textures in wad_contents.items():
+        for texture in textures:
+            wads_by_texture.setdefault(texture, set()).add(wad)
+    for bsp, textures in textures_needed.items():
+        for texture in textures:
+            references.setdefault(bsp, set()).update(wads_by_texture.get(texture, ()))
+
+    reachable = set()
+    pending = list(roots)
+    while pending:
+        relpath = pending.pop()
+        if relpath in reachable:
+            continue
+        reachable.add(relpath)
+        pending += references.get(relpath, ())
+
+    pruned = {relpath: source_size(files[relpaths[relpath]]) for relpath in sorted(relpaths) if relpath not in reachable}
+    kept = {relpaths[relpath]: files[relpaths[relpath]] for relpath in relpaths if relpath in reachable}
+    print_fcn(f'Pruned {len(pruned)} files nothing references ({sum(pruned.values()) / 1024 ** 2:.1f} MB), kept {len(kept)}.')
+    if missing:
+        print_fcn(f'  {len(missing)} referenced files don\'t exist in this game folder (they may come from valve), see the prune report.')
+    report = {'pruned': pruned, 'missing': {name: sorted(sources) for name, sources in sorted(missing.items())}}
+    return kept, report
+
+
+def save_prune_report(out_path: Path, report: dict):
+    with open(prune_report_path_for(out_path), 'w') as f:
+        json.dump(report, f, indent=1)
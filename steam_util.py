@@ -0,0 +1,180 @@
+import re
+import json
+import time
+import threading
+from pathlib import Path, PureWindowsPath
+
+from presets import BASE_DIRS_TO_TRY, CACHE_DIR
+from path_util import IS_WINDOWS
+
+
+# How long to wait for folders to answer. A disconnected network or removable drive can take far longer than this,
+# anything that hasn't answered by then is treated as missing.
+PATH_CHECK_TIMEOUT = 2.0
+# Where the last folder found is remembered, along with what the Steam library config looked like at the time
+DISCOVERY_CACHE = CACHE_DIR / 'halflife_path.json'
+HALF_LIFE_FOLDER = Path('steamapps') / 'common' / 'Half-Life'
+
+STEAM_ROOTS_TO_TRY = [
+    r'C:\Program Files (x86)\Steam',
+    r'C:\Program Files\Steam',
+    '~/Library/Application Support/Steam',  # Mac
+    '~/.steam/steam',  # Linux
+    '~/.local/share/Steam',
+    '~/.var/app/com.valvesoftware.Steam/.local/share/Steam',  # Linux, Flatpak
+]
+# libraryfolders.vdf lives in steamapps/ these days, older Steam clients kept it in config/
+LIBRARY_FOLDERS_VDF = [Path('steamapps') / 'libraryfolders.vdf', Path('config') / 'libraryfolders.vdf']
+
+_VDF_TOKEN = re.compile(r'"((?:[^"\\]|\\.)*)"|([{}])|//[^\n]*|([^\s{}"]+)')
+
+
+def parse_vdf(text: str) -> dict:
+    # Steam's KeyValues text format: "key" "value" pairs and "key" { ... } blocks, nested as dicts.
+    # Keys are lowercased since Steam doesn't care about their case (older configs say "LibraryFolders").
+    root = {}
+    stack = [root]
+    key = None
+    for match in _VDF_TOKEN.finditer(text):
+        quoted, brace, bare = match.groups()
+        if brace == '{':
+            block = {}
+            if key is not None:
+                stack[-1][key] = block
+            stack.append(block)
+            key = None
+        elif brace == '}':
+            if len(stack) > 1:
+                stack.pop()
+            key = None
+        elif quoted is not None or bare is not None:
+            token = re.sub(r'\\(.)', r'\1', quoted) if quoted is not None else bare
+            if key is None:
+                key = token.lower()
+            else:
+                stack[-1][key] = token
+                key = None
+    return root
+
+
+def find_steam_root() -> Path:
+    # The Steam install that has a library config, None if there doesn't seem to be one
+    roots = [Path(root).expanduser() for root in STEAM_ROOTS_TO_TRY]
+    if IS_WINDOWS:
+        try:
+            import winreg
+            with winreg.OpenKey(winreg.HKEY_CURRENT_USER, r'Software\Valve\Steam') as key:
+                roots.insert(0, Path(winreg.QueryValueEx(key, 'SteamPath')[0]))
+        except (ImportError, OSError):
+            pass
+    for root in roots:
+        if library_folders_vdf(root) is not None:
+            return root
+    return None
+
+
+def library_folders_vdf(steam_root: Path) -> Path:
+    for vdf in LIBRARY_FOLDERS_VDF:
+        if (steam_root / vdf).is_file():
+            return steam_root / vdf
+    return None
+
+
+def steam_libraries(steam_root: Path) -> list:
+    # Every Steam library folder, the ones that say they have Half-Life (app 70) installed first
+    libraries = [steam_root]
+    with_halflife = []
+    vdf = library_folders_vdf(steam_root)
+    if vdf is None:
+        return libraries
+    try:
+        config = parse_vdf(vdf.read_text(encoding='utf-8', errors='replace'))
+    except OSError:
+        return libraries
+    for key, value in config.get('libraryfolders', {}).items():
+        if isinstance(value, dict):
+            # "1" { "path" "D:\\SteamLibrary" "apps" { "70" "..." } }
+            if 'path' not in value:
+                continue
+            library = Path(value['path'])
+            if '70' in value.get('apps', {}):
+                with_halflife.append(library)
+        elif key.isdigit():
+            # Older format, just "1" "D:\\SteamLibrary"
+            library = Path(value)
+        else:
+            continue
+        libraries.append(library)
+    return list(dict.fromkeys(with_halflife + libraries))
+
+
+def first_existing_dir(paths: list, timeout: float=PATH_CHECK_TIMEOUT) -> Path:
+    # Check all the paths at once, each on a daemon thread so a drive that never answers can't hold anything up
+    # (not even exiting), and return the first one in the list that is a folder. None if none of them answered yes in time.
+    paths = list(dict.fromkeys(paths))
+    found = [False] * len(paths)
+    done = [threading.Event() for _ in paths]
+
+    def check(i):
+        try:
+            found[i] = paths[i].is_dir()
+        except OSError:
+            pass
+        done[i].set()
+
+    for i in range(len(paths)):
+        threading.Thread(target=check, args=(i,), name=f'check {paths[i]}', daemon=True).start()
+    deadline = time.monotonic() + timeout
+    for i, path in enumerate(paths):
+        if done[i].wait(max(deadline - time.monotonic(), 0)) and found[i]:
+            return path
+    return None
+
+
+def halflife_candidates(steam_root: Path=None, additional_dirs=None) -> list:
+    # Where Half-Life might be, most likely first: the Steam libraries, then the usual install folders, then additional_dirs.
+    # Drive letter paths are only tried on Windows.
+    candidates = [library / HALF_LIFE_FOLDER for library in steam_libraries(steam_root)] if steam_root is not None else []
+    for dir in BASE_DIRS_TO_TRY + list(additional_dirs or []):
+        if IS_WINDOWS or not PureWindowsPath(dir).drive:
+            candidates.append(Path(dir).expanduser())
+    return candidates
+
+
+def _cache_key(steam_root: Path, additional_dirs) -> dict:
+    # The Steam library config changes whenever a library is added or removed or Half-Life is installed or moved
+    vdf = library_folders_vdf(steam_root) if steam_root is not None else None
+    try:
+        vdf_mtime = vdf.stat().st_mtime_ns if vdf is not None else None
+    except OSError:
+        vdf_mtime = None
+    return {
+        'vdf': str(vdf) if vdf is not None else None,
+        'vdf_mtime_ns': vdf_mtime,
+        'additional_dirs': [str(dir) for dir in additional_dirs or []],
+    }
+
+
+def find_halflife(additional_dirs=None, use_cache: bool=True, timeout: float=PATH_CHECK_TIMEOUT) -> Path:
+    # The Half-Life folder (the one with valve/ in it), None if it couldn't be found.
+    # The answer is remembered in DISCOVERY_CACHE until the Steam library config changes or the folder goes away.
+    steam_root = find_steam_root()
+    key = _cache_key(steam_root, additional_dirs)
+    if use_cache:
+        try:
+            with open(DISCOVERY_CACHE) as f:
+                cached = json.load(f)
+            if cached['key'] == key and first_existing_dir([Path(cached['path'])], timeout) is not None:
+                return Path(cached['path'])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    path = first_existing_dir(halflife_candidates(steam_root, additional_dirs), timeout)
+    if path is not None and use_cache:
+        try:
+            DISCOVERY_CACHE.parent.mkdir(parents=True, exist_ok=True)
+            with open(DISCOVERY_CACHE, 'w') as f:
+                json.dump({'key': key, 'path': str(path)}, f, indent=1)
+        except OSError:
+            pass
+    return path
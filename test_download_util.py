@@ -0,0 +1,141 @@
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from download_util import ChecksumError, artifact_path, fetch_artifact
+from metrics_util import BuildMetrics, BuildCancelled
+
+
+DATA = bytes(range(256)) * 2048
+DATA_SHA256 = hashlib.sha256(DATA).hexdigest()
+
+
+class ArtifactHandler(BaseHTTPRequestHandler):
+    # Serves DATA, honouring Range unless the server says not to, and cutting the first reply short if asked
+    def do_GET(self):
+        server = self.server
+        server.ranges.append(self.headers.get('Range'))
+        start = 0
+        if self.headers.get('Range') and not server.ignore_range:
+            start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+            if start >= len(DATA):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(DATA)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(DATA) - 1}/{len(DATA)}')
+        else:
+            self.send_response(200)
+        body = DATA[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if server.drop_after is not None:
+            body = body[:server.drop_after]
+            server.drop_after = None
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ArtifactHandler)
+    server.ranges = []
+    server.ignore_range = False
+    server.drop_after = None
+    server.url = f'http://127.0.0.1:{server.server_address[1]}/files/artifact.apk'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def fetch(server, cache_dir, sha256=DATA_SHA256):
+    return fetch_artifact(server.url, sha256, cache_dir=cache_dir, print_fcn=lambda text: None, use_tqdm=False)
+
+
+def write_part(server, cache_dir, data: bytes):
+    path = artifact_path(server.url, DATA_SHA256, cache_dir)
+    path.parent.mkdir(parents=True)
+    part_path = path.with_name(path.name + '.part')
+    part_path.write_bytes(data)
+    return part_path
+
+
+def test_resumes_a_truncated_part(server, tmp_path):
+    part_path = write_part(server, tmp_path, DATA[:10000])
+    path = fetch(server, tmp_path)
+    assert path.read_bytes() == DATA
+    assert server.ranges == ['bytes=10000-']
+    assert not part_path.exists()
+
+
+def test_resumes_a_dropped_connection(server, tmp_path, monkeypatch):
+    monkeypatch.setattr('download_util.time.sleep', lambda seconds: None)
+    # Whatever was read in whole chunks before the drop is kept and resumed from
+    server.drop_after = 200000
+    assert fetch(server, tmp_path).read_bytes() == DATA
+    assert len(server.ranges) == 2 and server.ranges[0] is None
+    assert 0 < int(server.ranges[1].split('=')[1].rstrip('-')) <= 200000
+
+
+def test_server_ignoring_range_starts_over(server, tmp_path):
+    server.ignore_range = True
+    write_part(server, tmp_path, b'\xff' * 10000)
+    assert fetch(server, tmp_path).read_bytes() == DATA
+    assert server.ranges == ['bytes=10000-']
+
+
+def test_part_longer_than_the_file_starts_over(server, tmp_path):
+    write_part(server, tmp_path, DATA + b'extra')
+    assert fetch(server, tmp_path).read_bytes() == DATA
+    assert server.ranges == [f'bytes={len(DATA) + 5}-', None]
+
+
+def test_complete_part_is_not_downloaded_again(server, tmp_path):
+    write_part(server, tmp_path, DATA)
+    assert fetch(server, tmp_path).read_bytes() == DATA
+    assert server.ranges == [f'bytes={len(DATA)}-']
+
+
+def test_hash_mismatch(server, tmp_path):
+    with pytest.raises(ChecksumError):
+        fetch(server, tmp_path, sha256='0' * 64)
+    path = artifact_path(server.url, '0' * 64, tmp_path)
+    assert not path.exists()
+    assert not path.with_name(path.name + '.part').exists()
+
+
+def test_cache_hit_skips_the_network(server, tmp_path):
+    path = fetch(server, tmp_path)
+    assert fetch(server, tmp_path) == path
+    assert len(server.ranges) == 1
+
+    # Without an expected hash, the one recorded on the first download is checked instead
+    path = fetch(server, tmp_path, sha256=None)
+    path.write_bytes(b'corrupted')
+    assert fetch(server, tmp_path, sha256=None).read_bytes() == DATA
+    assert len(server.ranges) == 3
+
+
+def test_cancel_keeps_the_part(server, tmp_path):
+    cancel_event = threading.Event()
+
+    def on_progress(phase):
+        # Cancel as soon as the first chunk is in
+        if phase.bytes:
+            cancel_event.set()
+
+    metrics = BuildMetrics(on_progress=on_progress, cancel_event=cancel_event, progress_interval=0)
+    with pytest.raises(BuildCancelled):
+        fetch_artifact(server.url, DATA_SHA256, cache_dir=tmp_path, print_fcn=lambda text: None, use_tqdm=False, metrics=metrics)
+    path = artifact_path(server.url, DATA_SHA256, tmp_path)
+    assert 0 < path.with_name(path.name + '.part').stat().st_size < len(DATA)
+    assert fetch(server, tmp_path).read_bytes() == DATA
+    assert server.ranges[1].startswith('bytes=')
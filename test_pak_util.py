@@ -0,0 +1,346 @@
+import io
+import json
+import struct
+import zipfile
+from pathlib import Path
+
+import pytest
+
+from pak_util import make_hl_pak, manifest_path_for, open_pak_set, resolve_pak_set, PakWriter, PakArchive, PAK_HEADER, PAK_ENTRY, MAX_PAK_OFFSET, plan_chunks, pak_size, update_pak, compact_pak
+from path_util import TreeIndexCache
+from prune_util import BSP_HEADER, MIPTEX, WAD_HEADER, WAD_LUMP, Resolver, sentence_sounds
+
+
+def build(game: Path, out: Path, **kwargs):
+    make_hl_pak(game, out, max_chunk_size=4, use_tqdm=False, print_fcn=lambda text: None, patch=True, **kwargs)
+
+
+def pak_names(out: Path) -> list:
+    return sorted(path.name for path in out.glob('pak*.pak'))
+
+
+def packed_files(out: Path) -> dict:
+    archives = open_pak_set(out)
+    try:
+        return {name: bytes(archive.read(name)) for name, archive in resolve_pak_set(archives).items()}
+    finally:
+        for archive in archives:
+            archive.close()
+
+
+def make_game(root: Path, count: int=12) -> Path:
+    game = root / 'valve'
+    for i in range(count):
+        path = game / 'models' / f'm{i}.mdl'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(bytes([i]) * 1000)
+    (game / 'liblist.gam').write_text('game "Half-Life"\n')
+    return game
+
+
+def test_patch_holds_only_changed_files(tmp_path):
+    game = make_game(tmp_path)
+    out = tmp_path / 'xash' / 'valve'
+    build(game, out)
+    assert pak_names(out) == ['pak0.pak', 'pak1.pak', 'pak2.pak']
+
+    (game / 'models' / 'm1.mdl').write_bytes(b'new')
+    build(game, out, patch_rollup=1.0)
+    assert pak_names(out) == ['pak0.pak', 'pak1.pak', 'pak2.pak', 'pak3.pak']
+    assert packed_files(out)['models/m1.mdl'] == b'new'
+
+
+def test_deleted_file_is_removed_from_its_pak(tmp_path):
+    game = make_game(tmp_path)
+    out = tmp_path / 'xash' / 'valve'
+    build(game, out)
+
+    (game / 'models' / 'm5.mdl').unlink()
+    build(game, out)
+    files = packed_files(out)
+    assert 'models/m5.mdl' not in files
+    assert len(files) == 11
+    manifest = json.loads(manifest_path_for(out).read_text())
+    assert manifest['patches'] == []
+
+
+def test_deleted_patched_file_rolls_up_the_patches(tmp_path):
+    game = make_game(tmp_path)
+    out = tmp_path / 'xash' / 'valve'
+    build(game, out)
+
+    (game / 'models' / 'extra.mdl').write_bytes(b'extra')
+    build(game, out, patch_rollup=1.0)
+    assert 'pak3.pak' in pak_names(out)
+
+    (game / 'models' / 'extra.mdl').unlink()
+    build(game, out, patch_rollup=1.0)
+    assert pak_names(out) == ['pak0.pak', 'pak1.pak', 'pak2.pak']
+    assert 'models/extra.mdl' not in packed_files(out)
+
+
+def test_rollup_with_nothing_changed(tmp_path):
+    game = make_game(tmp_path)
+    out = tmp_path / 'xash' / 'valve'
+    build(game, out)
+    (game / 'models' / 'm1.mdl').write_bytes(b'new')
+    build(game, out, patch_rollup=1.0)
+    assert 'pak3.pak' in pak_names(out)
+
+    # Nothing changed, but the patches are already over a lower threshold
+    build(game, out, patch_rollup=0.0)
+    assert pak_names(out) == ['pak0.pak', 'pak1.pak', 'pak2.pak']
+    assert packed_files(out)['models/m1.mdl'] == b'new'
+    manifest = json.loads(manifest_path_for(out).read_text())
+    assert manifest['patches'] == []
+    assert not any('patch' in record for record in manifest['files'].values())
+
+
+def test_jobs_build_the_same_paks(tmp_path):
+    game = make_game(tmp_path, count=40)
+    paks = {}
+    for jobs in (1, 4):
+        out = tmp_path / f'jobs{jobs}' / 'valve'
+        make_hl_pak(game, out, max_chunk_size=6, use_tqdm=False, print_fcn=lambda text: None, incremental=False, jobs=jobs)
+        paks[jobs] = {path.name: path.read_bytes() for path in out.glob('pak*.pak')}
+    assert len(paks[1]) == 7
+    assert paks[4] == paks[1]
+
+
+def test_pak_round_trip(tmp_path):
+    source = tmp_path / 'source.wav'
+    source.write_bytes(b'RIFF' + bytes(range(256)) * 8)
+    pak_path = tmp_path / 'pak0.pak'
+    with PakWriter(pak_path) as writer:
+        writer.add_file('sound/a.wav', source)
+        writer.add_data('gfx/b.tga', b'tga')
+        writer.add_fileobj('models/c.mdl', io.BytesIO(b'IDST'))
+        writer.add_data('empty.txt', b'')
+
+    raw = pak_path.read_bytes()
+    magic, dir_offset, dir_length = PAK_HEADER.unpack_from(raw)
+    assert magic == b'PACK'
+    assert dir_offset + dir_length == len(raw)
+    assert dir_length == 4 * PAK_ENTRY.size
+    name, offset, length = PAK_ENTRY.unpack_from(raw, dir_offset)
+    assert name == b'sound/a.wav'.ljust(56, b'\0')
+    assert (offset, length) == (PAK_HEADER.size, source.stat().st_size)
+
+    with PakArchive(pak_path) as archive:
+        assert list(archive) == ['sound/a.wav', 'gfx/b.tga', 'models/c.mdl', 'empty.txt']
+        with archive.read('sound/a.wav') as data:
+            assert bytes(data) == source.read_bytes()
+        with archive.read('models/c.mdl') as data:
+            assert bytes(data) == b'IDST'
+        assert archive.verify() == []
+        assert archive.dead_bytes() == 0
+
+
+def test_pak_limits(tmp_path):
+    with PakWriter(tmp_path / 'pak0.pak') as writer:
+        with pytest.raises(ValueError):
+            writer.add_data('models/' + 'x' * 50 + '.mdl', b'long name')
+        writer.add_data('models/' + 'x' * 45 + '.mdl', b'just fits')
+        # Offsets are signed 32-bit, nothing may end past 2 GiB - 1
+        writer.offset = MAX_PAK_OFFSET - 4
+        with pytest.raises(ValueError):
+            writer.add_data('models/big.mdl', b'12345')
+        # Put it back so the directory isn't written 2 GiB in
+        writer.offset = PAK_HEADER.size + len(b'just fits')
+
+
+def test_extract_refuses_to_leave_dest(tmp_path):
+    pak_path = tmp_path / 'pak0.pak'
+    with PakWriter(pak_path) as writer:
+        writer.add_data('models/ok.mdl', b'ok')
+        writer.add_data('../evil.cfg', b'evil')
+    with PakArchive(pak_path) as archive:
+        assert archive.extract(tmp_path / 'out', ['models/ok.mdl']) == [tmp_path / 'out' / 'models' / 'ok.mdl']
+        with pytest.raises(ValueError):
+            archive.extract(tmp_path / 'out')
+    assert not (tmp_path / 'evil.cfg').exists()
+
+
+def test_plan_chunks_caps():
+    sizes = {f'models/m{i:02}.mdl': 100 + i for i in range(25)}
+    chunks = plan_chunks(sizes, max_chunk_size=10)
+    assert len(chunks) == 3
+    assert all(len(chunk) <= 10 for chunk in chunks)
+    assert sorted(name for chunk in chunks for name in chunk) == sorted(sizes)
+
+    max_bytes = pak_size(5, 5 * 124)
+    chunks = plan_chunks(sizes, max_chunk_size=10, max_chunk_bytes=max_bytes)
+    assert len(chunks) >= 5
+    assert all(pak_size(len(chunk), sum(sizes[name] for name in chunk)) <= max_bytes for chunk in chunks)
+    assert sorted(name for chunk in chunks for name in chunk) == sorted(sizes)
+
+
+def test_plan_chunks_keeps_files_where_they_were():
+    sizes = {f'models/m{i:02}.mdl': 100 for i in range(20)}
+    chunks = plan_chunks(sizes, max_chunk_size=10)
+    previous = {name: pak_num for pak_num, chunk in enumerate(chunks) for name in chunk}
+
+    sizes['models/new.mdl'] = 100
+    del sizes['models/m03.mdl']
+    new_chunks = plan_chunks(sizes, max_chunk_size=10, previous=previous)
+    for pak_num, chunk in enumerate(new_chunks):
+        assert all(previous[name] == pak_num for name in chunk if name != 'models/new.mdl')
+    assert 'models/new.mdl' in new_chunks[previous['models/m03.mdl']]
+
+
+def test_dedup_entries_share_data(tmp_path):
+    game = tmp_path / 'valve'
+    (game / 'sound').mkdir(parents=True)
+    for name in ('a.wav', 'b.wav', 'c.wav'):
+        (game / 'sound' / name).write_bytes(b'same' * 500)
+    (game / 'sound' / 'd.wav').write_bytes(b'diff' * 500)
+
+    pak_path = tmp_path / 'pak0.pak'
+    with PakWriter(pak_path, dedup=True) as writer:
+        for name in ('a.wav', 'b.wav', 'c.wav', 'd.wav'):
+            writer.add_file(f'sound/{name}', game / 'sound' / name)
+        assert writer.duplicates == 2
+        assert writer.bytes_saved == 4000
+    assert pak_path.stat().st_size == pak_size(4, 4000)
+    with PakArchive(pak_path) as archive:
+        assert archive.entries['sound/a.wav'] == archive.entries['sound/b.wav'] == archive.entries['sound/c.wav']
+        assert archive.entries['sound/d.wav'][0] != archive.entries['sound/a.wav'][0]
+        with archive.read('sound/c.wav') as data:
+            assert bytes(data) == b'same' * 500
+        assert archive.dead_bytes() == 0
+
+    out = tmp_path / 'xash' / 'valve'
+    make_hl_pak(game, out, use_tqdm=False, print_fcn=lambda text: None, dedup=True)
+    assert (out / 'pak0.pak').stat().st_size == pak_size(4, 4000)
+
+
+def test_build_from_zip(tmp_path):
+    source_zip = tmp_path / 'hl_gold.zip'
+    with zipfile.ZipFile(source_zip, 'w') as zip_file:
+        zip_file.writestr('hl gold/HL_Gold_HD/liblist.gam', 'game "Half-Life"\n')
+        zip_file.writestr('hl gold/HL_Gold_HD/models/barney.mdl', b'IDST' * 100)
+        zip_file.writestr('hl gold/HL_Gold_HD/sound/hello.wav', b'RIFF' * 100)
+        zip_file.writestr('hl gold/HL_Gold_HD/readme.txt', 'skipped')
+        zip_file.writestr('hl gold/other/models/other.mdl', b'not this folder')
+    out = tmp_path / 'xash' / 'valve'
+    make_hl_pak('HL_Gold_HD', out, use_tqdm=False, print_fcn=lambda text: None, source_zip=source_zip, zip_prefix='hl gold/', ignore_suffixes=('.txt',))
+
+    assert packed_files(out) == {'models/barney.mdl': b'IDST' * 100, 'sound/hello.wav': b'RIFF' * 100}
+    assert (out / 'liblist.gam').read_text() == 'game "Half-Life"\n'
+    assert not (out / 'readme.txt').exists()
+
+    # Nothing changed in the zip, so the second build has nothing to write
+    pak_mtime = (out / 'pak0.pak').stat().st_mtime_ns
+    make_hl_pak('HL_Gold_HD', out, use_tqdm=False, print_fcn=lambda text: None, source_zip=source_zip, zip_prefix='hl gold/', ignore_suffixes=('.txt',))
+    assert (out / 'pak0.pak').stat().st_mtime_ns == pak_mtime
+
+
+def test_update_and_compact_pak(tmp_path):
+    pak_path = tmp_path / 'pak0.pak'
+    with PakWriter(pak_path) as writer:
+        for i in range(4):
+            writer.add_data(f'models/m{i}.mdl', bytes([i]) * 1000)
+    new_file = tmp_path / 'm1.mdl'
+    new_file.write_bytes(b'new')
+    added_file = tmp_path / 'extra.mdl'
+    added_file.write_bytes(b'extra' * 10)
+
+    stats = update_pak(pak_path, {'models/m1.mdl': new_file, 'models/extra.mdl': added_file}, remove=['models/m2.mdl', 'models/gone.mdl'])
+    assert (stats['added'], stats['replaced'], stats['removed'], stats['bytes']) == (1, 1, 1, 53)
+    # The replaced and removed data, plus the old directory that the new data was written after
+    assert stats['dead_bytes'] == 2000 + 4 * PAK_ENTRY.size
+    assert stats['size'] == pak_path.stat().st_size
+    contents = {'models/m0.mdl': bytes([0]) * 1000, 'models/m1.mdl': b'new', 'models/m3.mdl': bytes([3]) * 1000, 'models/extra.mdl': b'extra' * 10}
+    assert packed_files(tmp_path) == contents
+
+    assert compact_pak(pak_path) == stats['dead_bytes']
+    assert pak_path.stat().st_size == pak_size(4, 2053)
+    assert packed_files(tmp_path) == contents
+    with PakArchive(pak_path) as archive:
+        assert archive.dead_bytes() == 0
+    assert compact_pak(pak_path) == 0
+
+
+def make_bsp(entities: bytes, wad_textures: list) -> bytes:
+    # A version 30 map with just an entities lump and a textures lump of textures that live in wads
+    textures = struct.pack(f'<i{len(wad_textures)}i', len(wad_textures), *(4 + 4 * len(wad_textures) + i * MIPTEX.size for i in range(len(wad_textures))))
+    textures += b''.join(MIPTEX.pack(name.encode(), 16, 16, 0, 0, 0, 0) for name in wad_textures)
+    lumps = [0] * 30
+    lumps[0:2] = [BSP_HEADER.size, len(entities)]
+    lumps[4:6] = [BSP_HEADER.size + len(entities), len(textures)]
+    return BSP_HEADER.pack(30, *lumps) + entities + textures
+
+
+def make_wad(textures: list) -> bytes:
+    directory = b''.join(WAD_LUMP.pack(0, 0, 0, 0x43, 0, name.encode()) for name in textures)
+    return WAD_HEADER.pack(b'WAD3', len(textures), WAD_HEADER.size) + directory
+
+
+def test_prune_follows_references(tmp_path):
+    game = tmp_path / 'valve'
+    files = {
+        'maps/c1a0.bsp': make_bsp(b'{ "classname" "worldspawn" "skyname" "city" "wad" "\\sierra\\valve\\halflife.wad;decals.wad" }\n'
+                                  b'{ "classname" "monster_barney" "model" "models/barney.mdl" }\n'
+                                  b'{ "classname" "ambient_generic" "message" "ambience/wind.wav" }\n', ['crate']),
+        'halflife.wad': make_wad(['crate']),
+        'unused.wad': make_wad(['other']),
+        'models/barney.mdl': b'IDST',
+        'models/unused.mdl': b'IDST',
+        'models/by_code.mdl': b'IDST',
+        'sound/ambience/wind.wav': b'RIFF',
+        'sound/ambience/unused.wav': b'RIFF',
+        'sound/barney/ba_hello.wav': b'RIFF',
+        'sound/weapons/step1.wav': b'RIFF',
+        'sound/weapons/step2.wav': b'RIFF',
+        'sound/sentences.txt': b'BA_HELLO barney/ba_hello(p110)\n',
+        'gfx/env/cityup.tga': b'tga',
+        'gfx/env/cityft.bmp': b'bmp',
+        'gfx/env/spaceup.tga': b'tga',
+        'dlls/hl.so': b'\0models/by_code.mdl\0weapons/step%d.wav\0',
+        'liblist.gam': b'game "Half-Life"\n',
+    }
+    for relpath, data in files.items():
+        (game / relpath).parent.mkdir(parents=True, exist_ok=True)
+        (game / relpath).write_bytes(data)
+    out = tmp_path / 'xash' / 'valve'
+    make_hl_pak(game, out, use_tqdm=False, print_fcn=lambda text: None, prune=True, prune_keep=['sound/ambience/unused.wav'])
+
+    packed = set(packed_files(out))
+    pruned = {'unused.wad', 'models/unused.mdl', 'gfx/env/spaceup.tga'}
+    # Files in the root (the wads and liblist.gam) are left loose
+    assert packed == {relpath for relpath in files if '/' in relpath} - pruned
+    assert (out / 'halflife.wad').exists() and not (out / 'unused.wad').exists()
+    report = json.loads((tmp_path / 'xash' / 'valve.prune.json').read_text())
+    assert set(report['pruned']) == pruned
+    assert set(report['missing']) == {'decals.wad'} | {f'gfx/env/city{side}.tga' for side in ('dn', 'lf', 'rt', 'bk')}
+
+    # Without any game code there's no telling what it loads, so nothing is left out
+    (game / 'dlls' / 'hl.so').unlink()
+    make_hl_pak(game, out, use_tqdm=False, print_fcn=lambda text: None, incremental=False, prune=True)
+    assert 'models/unused.mdl' in packed_files(out)
+
+
+def test_prune_reference_parsing():
+    assert sentence_sounds(b'// comment\nHG_GREN0 hgrunt/clik(p120) grenade! clik,\nBA_OK barney/ok.\n') == [
+        'sound/hgrunt/clik.wav', 'sound/hgrunt/grenade!.wav', 'sound/hgrunt/clik.wav', 'sound/barney/ok.wav']
+    resolver = Resolver(['sound/Weapons/Step1.wav', 'sound/weapons/step2.wav', 'gfx/env/skyup.bmp', 'wads/halflife.wad', 'models/gun.mdl'])
+    assert resolver.resolve('*weapons\\step1.wav') == ['sound/Weapons/Step1.wav']
+    assert resolver.resolve('weapons/step%d.wav') == ['sound/Weapons/Step1.wav', 'sound/weapons/step2.wav']
+    assert resolver.resolve('gfx/env/skyup.tga') == ['gfx/env/skyup.bmp']
+    assert resolver.resolve('c:/sierra/valve/halflife.wad') == ['wads/halflife.wad']
+    assert resolver.resolve('./models//gun.mdl') == ['models/gun.mdl']
+    assert resolver.resolve('!BA_HELLO') == []
+
+
+def test_builds_share_scans(tmp_path):
+    game = make_game(tmp_path)
+    (tmp_path / 'valve_hd' / 'models').mkdir(parents=True)
+    (tmp_path / 'valve_hd' / 'models' / 'm1.mdl').write_bytes(b'hd')
+    index_cache = TreeIndexCache()
+    printed = []
+    make_hl_pak(game, tmp_path / 'vanilla' / 'valve', use_tqdm=False, print_fcn=printed.append, index_cache=index_cache)
+    make_hl_pak(game, tmp_path / 'hd' / 'valve', also_include_overwrites=[tmp_path / 'valve_hd'], use_tqdm=False, print_fcn=printed.append, index_cache=index_cache)
+    assert printed.count(f'Scanning files in {game}...') == 1
+    assert index_cache.get(game) is index_cache.get(tmp_path / 'valve' / '.')
+    assert packed_files(tmp_path / 'vanilla' / 'valve')['models/m1.mdl'] == bytes([1]) * 1000
+    assert packed_files(tmp_path / 'hd' / 'valve')['models/m1.mdl'] == b'hd'
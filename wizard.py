@@ -1,61 +1,129 @@
+import queue
 from pathlib import Path
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from ppadb.device import Device
-from pak_util import make_hl_pak
-
-from presets import presets, search_for_halflife, APK_CONFIGS, TQDM_AVAILABLE
-from adb_util import find_quest_devices, install_apk, make_folder, push_folder, check_if_app_installed, install_hl_gold_hd, copy_all_files, rewrite_path_for_os
-
-
-def install_lambda_and_launcher(quest_devices: list[Device], force_install: bool = False):
-    # Install the APKs for the launcher and the game
-    for apk_data in APK_CONFIGS['quest'].values():
-        apk_url = apk_data['apk_url']
-        app_name = apk_data['name']
-
-        for device in quest_devices:
-            device_name = device.get_properties()['ro.product.model']
-            # Check if the app is already installed
-            if check_if_app_installed(device, app_name) and not force_install:
-                print(f'{app_name} is already installed on {device_name}, skipping.')
+from pak_util import make_hl_pak, format_size
+from metrics_util import BuildMetrics
+from download_util import fetch_artifact, fetch_artifacts, artifact_path, is_cached
+
+from presets import presets, search_for_halflife, APK_CONFIGS, HL_GOLD_HD_URL, HL_GOLD_HD_SHA256, HL_GOLD_HD_ZIP_PREFIX
+from adb_util import find_quest_devices, install_apk, make_folder, sync_folder, run_on_devices, DEFAULT_DEVICE_JOBS, TRANSFER_MODES, check_if_app_installed
+
+
+def install_lambda_and_launcher(quest_devices: list[Device], force_install: bool = False, max_devices: int = DEFAULT_DEVICE_JOBS, metrics=None) -> dict:
+    # Install the APKs for the launcher and the game on all of the devices at once.
+    # Each APK is downloaded once (into the download cache) and the same file is installed on every headset.
+    apks = list(APK_CONFIGS['quest'].values())
+
+    # Work out what each device is missing first so nothing gets downloaded that no headset needs
+    missing = {}
+    def check_device(device: Device):
+        device_name = device.get_properties()['ro.product.model']
+        missing[device.serial] = []
+        for apk_data in apks:
+            if check_if_app_installed(device, apk_data['name']) and not force_install:
+                print(f'[{device.serial}] {apk_data["name"]} is already installed on {device_name}, skipping.')
             else:
-                print(f'Installing {apk_url} to {device_name}...')
-                install_apk(apk_url, device)
-
-def make_xash_folder(quest_devices: list[Device]):
+                missing[device.serial].append(apk_data)
+
+    results = run_on_devices(quest_devices, check_device, 'Check installed apps', max_workers=max_devices)
+    devices_to_install = [device for device in quest_devices if results[device.serial] is None and missing[device.serial]]
+    needed = [(apk_data['apk_url'], apk_data.get('sha256')) for apk_data in apks if any(apk_data in missing[device.serial] for device in devices_to_install)]
+
+    # Fetch stage: once per APK, in parallel
+    apk_paths, downloaded_bytes = fetch_artifacts(needed)
+
+    # Install stage: reuse the local files on every device
+    installed = []
+    def install_on_device(device: Device):
+        for apk_data in missing[device.serial]:
+            apk_path = apk_paths[apk_data['apk_url']]
+            if isinstance(apk_path, Exception):
+                raise apk_path
+            install_apk(apk_path, device, metrics=metrics)
+            installed.append(apk_path.stat().st_size)
+
+    results.update(run_on_devices(devices_to_install, install_on_device, 'Install Lambda1VR and launcher', max_workers=max_devices))
+    print(f'Downloaded {format_size(downloaded_bytes)} for {len(needed)} APK(s), installed {format_size(sum(installed))} ({len(installed)} install(s) on {len(devices_to_install)} device(s)).')
+    return results
+
+def make_xash_folder(quest_devices: list[Device], max_devices: int = DEFAULT_DEVICE_JOBS) -> dict:
     # Make the /xash/ folder on the device(s) if it doesn't exist
     print('Making /sdcard/xash/ folder on device(s)...')
-    for device in quest_devices:
-        make_folder(device, Path('/sdcard/xash/'))
-
-def download_and_install_hl_gold(base_path: Path, zip_path: Path = None, force_install: bool = False):
-    # Install the HL_Gold_HD pack if it's not already installed
-    # Check if the folder exists locally
-    hl_gold_hd_folder = base_path / 'HL_Gold_HD'
-    if not hl_gold_hd_folder.exists() or force_install:
-        print('Installing HL_Gold_HD...')
-        install_hl_gold_hd(base_path, zip_path)
-        # Ensure that the folder exists now
-        if not hl_gold_hd_folder.exists():
-            print(f'Error: HL_Gold_HD folder {hl_gold_hd_folder} does not exist.')
+    return run_on_devices(quest_devices, lambda device: make_folder(device, Path('/sdcard/xash/')), 'Make /sdcard/xash/', max_workers=max_devices)
+
+def find_hl_gold_zip(zip_path: Path = None) -> Path:
+    # Use the zip that was passed in, then the download cache, then the Downloads folder
+    if zip_path is not None:
+        return zip_path if zip_path.exists() else None
+    if is_cached(HL_GOLD_HD_URL, HL_GOLD_HD_SHA256):
+        return artifact_path(HL_GOLD_HD_URL, HL_GOLD_HD_SHA256)
+    return look_for_hl_gold_zip_in_downloads()
+
+def download_hl_gold(zip_path: Path = None, metrics=None) -> Path:
+    # The HL_Gold_HD paks are built straight from the zip, so all this has to do is make sure there is a zip to build from
+    if zip_path is not None:
+        if not zip_path.exists():
+            print(f'Error: Zip path {zip_path} does not exist.')
             exit(1)
-    else:
-        print(f'HL_Gold_HD folder {hl_gold_hd_folder} already exists, skipping.')
-
-def pack_and_copy_hl_gold(quest_devices: list[Device], base_path: Path):
-    hl_gold_hd_folder = base_path / 'HL_Gold_HD'
-    # Pack the HL_Gold_HD folder and push it to the device(s)
+        print(f'Using existing zip at {zip_path}.')
+        return zip_path
+    return fetch_artifact(HL_GOLD_HD_URL, HL_GOLD_HD_SHA256, metrics=metrics)
+
+def build_and_sync(quest_devices: list[Device], out_path: Path, remote_folder: Path, build: callable, max_devices: int = DEFAULT_DEVICE_JOBS, metrics=None, transfer: str = 'tar') -> dict:
+    # Run build(on_file_ready) and push its output to every device at the same time.
+    # Each pak (and loose file) goes out as soon as it's written, so the whole thing takes about as long as the slower
+    # of building and pushing instead of both added up. Once the build is done, whatever it didn't have to rewrite is
+    # synced the usual way. If the build fails, the pushes stop and the build's error is raised.
+    queues = {device.serial: queue.Queue() for device in quest_devices}
+
+    def on_file_ready(relpath: str):
+        for ready in queues.values():
+            ready.put(relpath)
+
+    def run_build():
+        try:
+            build(on_file_ready)
+        except BaseException as e:
+            for ready in queues.values():
+                ready.put(e)
+            raise
+        for ready in queues.values():
+            ready.put(None)
+
+    print(f'Building {out_path} and syncing it to device(s) at {remote_folder}')
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='build') as executor:
+        build_future = executor.submit(run_build)
+        # Only push what changed since the last time this was copied to each device
+        results = run_on_devices(quest_devices, lambda device: sync_folder(device, out_path, remote_folder, metrics=metrics, ready=queues[device.serial], transfer=transfer),
+                                 f'Copy {out_path}', max_workers=max_devices)
+        build_future.result()
+    return results
+
+def pack_and_copy_hl_gold(quest_devices: list[Device], base_path: Path, zip_path: Path = None, max_devices: int = DEFAULT_DEVICE_JOBS, metrics=None, transfer: str = 'tar') -> dict:
+    # Pack HL_Gold_HD and push it to the device(s)
     out_path = base_path / 'xash' / 'HL_Gold_HD'
-    make_hl_pak(hl_gold_hd_folder, out_path, use_tqdm=TQDM_AVAILABLE)
+    hl_gold_hd_folder = base_path / 'HL_Gold_HD'
+    zip_path = find_hl_gold_zip(zip_path)
+    if zip_path is not None:
+        # Stream the files out of the zip into the paks, only the loose root files get written to disk
+        build = lambda on_file_ready: make_hl_pak('HL_Gold_HD', out_path, source_zip=zip_path, zip_prefix=HL_GOLD_HD_ZIP_PREFIX, ignore_suffixes=('.txt',), metrics=metrics, on_file_ready=on_file_ready)
+    elif hl_gold_hd_folder.exists():
+        # Extracted by an older version
+        build = lambda on_file_ready: make_hl_pak(hl_gold_hd_folder, out_path, metrics=metrics, on_file_ready=on_file_ready)
+    else:
+        raise FileNotFoundError(f'Could not find the HL Gold HD zip or an {hl_gold_hd_folder} folder.')
     remote_folder = Path('/sdcard/xash') / 'HL_Gold_HD'
-    print(f'Pushing {out_path} to device(s) at {remote_folder}')
-    for device in quest_devices:
-        push_folder(device, out_path, remote_folder)
-        # copy_all_files(device, out_path, remote_folder)
+    return build_and_sync(quest_devices, out_path, remote_folder, build, max_devices=max_devices, metrics=metrics, transfer=transfer)
 
-def pack_and_copy_preset(quest_devices: list[Device], base_path: Path, preset: str = 'hl_hd'):
+def pack_and_copy_preset(quest_devices: list[Device], base_path: Path, preset: str = 'hl_hd', max_devices: int = DEFAULT_DEVICE_JOBS, metrics=None, transfer: str = 'tar') -> dict:
     # Do the preset, then copy the output to the device(s)
     preset = presets[preset]
-    base_path = base_path or Path(search_for_halflife())
+    base_path = base_path or search_for_halflife()
+    if base_path is None:
+        raise FileNotFoundError('Unable to find the Half-Life directory.')
+    base_path = Path(base_path)
     game_path = base_path / preset['base_folder']
     if not game_path.exists():
         print(f'Error: Game path {game_path} does not exist.')
@@ -63,22 +131,13 @@ def pack_and_copy_preset(quest_devices: list[Device], base_path: Path, preset: s
         also_include = [base_path / new_folder for new_folder in preset['also_include_overwrites']] if preset['also_include_overwrites'] else []
         out_path = base_path / 'xash' / preset['base_folder']
         ignore_files = [v for v in preset.get('ignore_files', None)] if preset.get('ignore_files', None) else None
-        
-        make_hl_pak(game_path, out_path, also_include_overwrites=also_include, ignore_files=ignore_files, use_tqdm=TQDM_AVAILABLE)
 
-        # Check if the output folder exists
-        if not out_path.exists():
-            print(f'Error: Output folder {out_path} does not exist.')
-            exit(1)
-        
-        # Push the output folder to the device(s)
         # Make sure xash folder exists
-        make_xash_folder(quest_devices)
+        make_xash_folder(quest_devices, max_devices=max_devices)
         remote_folder = Path('/sdcard/xash') / preset['base_folder']
-        print(f'Pushing {out_path} to device(s) at {remote_folder}')
-        for device in quest_devices:
-            push_folder(device, out_path, remote_folder)
-            # copy_all_files(device, out_path, remote_folder)
+        # Build the paks and push each one to the device(s) as soon as it's done
+        build = lambda on_file_ready: make_hl_pak(game_path, out_path, also_include_overwrites=also_include, ignore_files=ignore_files, metrics=metrics, on_file_ready=on_file_ready)
+        return build_and_sync(quest_devices, out_path, remote_folder, build, max_devices=max_devices, metrics=metrics, transfer=transfer)
 
 
 def look_for_hl_gold_zip_in_downloads():
@@ -89,6 +148,13 @@ def look_for_hl_gold_zip_in_downloads():
 
 
 if __name__ == '__main__':
+    parser = ArgumentParser(description='Install Lambda1VR and copy Half-Life, HL Gold HD, Blue Shift and Opposing Force to every connected Quest.')
+    parser.add_argument('--metrics', help='Save the time, files and bytes of every build, push and install step to this JSON file.')
+    parser.add_argument('--trace', help='Save the same steps as a Chrome trace (open it in chrome://tracing or ui.perfetto.dev).')
+    parser.add_argument('--transfer', default='tar', choices=TRANSFER_MODES, help='Send the files as one (compressed if it helps) tar stream, or one adb push per file.')
+    args = parser.parse_args()
+    metrics = BuildMetrics() if args.metrics or args.trace else None
+
     # Look for quest devices
     quest_devices = find_quest_devices()
     print(quest_devices)
@@ -97,19 +163,28 @@ if __name__ == '__main__':
         exit(1)
     
     # Install the APKs for the launcher and the game
-    install_lambda_and_launcher(quest_devices)
+    install_lambda_and_launcher(quest_devices, metrics=metrics)
 
-    base_path = Path(search_for_halflife())
-    pack_and_copy_preset(quest_devices, base_path=base_path, preset='hl_hd')
+    base_path = search_for_halflife()
+    if base_path is None:
+        print('Unable to find the Half-Life directory.')
+        exit(1)
+    pack_and_copy_preset(quest_devices, base_path=base_path, preset='hl_hd', metrics=metrics, transfer=args.transfer)
 
-    zip_file = look_for_hl_gold_zip_in_downloads()
-    download_and_install_hl_gold(base_path, zip_file)
-    pack_and_copy_hl_gold(quest_devices, base_path=base_path)
+    zip_file = download_hl_gold(look_for_hl_gold_zip_in_downloads(), metrics=metrics)
+    pack_and_copy_hl_gold(quest_devices, base_path=base_path, zip_path=zip_file, metrics=metrics, transfer=args.transfer)
 
     if base_path / 'bshift':
         # Copy Blueshift
-        pack_and_copy_preset(quest_devices, base_path=base_path, preset='blueshift_hd')
+        pack_and_copy_preset(quest_devices, base_path=base_path, preset='blueshift_hd', metrics=metrics, transfer=args.transfer)
     
     if base_path / 'gearbox':
         # Copy opposing force
-        pack_and_copy_preset(quest_devices, base_path=base_path, preset='opfor_hd')
+        pack_and_copy_preset(quest_devices, base_path=base_path, preset='opfor_hd', metrics=metrics, transfer=args.transfer)
+
+    if metrics is not None:
+        metrics.print_summary()
+        if args.metrics:
+            metrics.save(args.metrics)
+        if args.trace:
+            metrics.save(args.trace, chrome_trace=True)
@@ -1,34 +1,61 @@
+import os
 import PySimpleGUI as sg
-from pathlib import Path
 
 from presets import search_for_halflife, presets
-from adb_util import find_quest_devices, rewrite_path_for_os
-from wizard import install_lambda_and_launcher, pack_and_copy_hl_gold, pack_and_copy_preset, download_and_install_hl_gold, look_for_hl_gold_zip_in_downloads
+from gui_util import BackgroundTask, describe_progress, progress_fraction, was_cancelled, PRINT_EVENT, PROGRESS_EVENT, DONE_EVENT
+from adb_util import find_quest_devices
+from path_util import rewrite_path_for_os
+from wizard import install_lambda_and_launcher, pack_and_copy_hl_gold, pack_and_copy_preset, download_hl_gold, find_hl_gold_zip, look_for_hl_gold_zip_in_downloads
+
+
+def show_device_results(results: dict, success_message: str):
+    # Tell the user which headsets failed, if any
+    failed = {serial: error for serial, error in (results or {}).items() if error is not None}
+    if failed:
+        failures = '\n'.join(f'{serial}: {error}' for serial, error in failed.items())
+        sg.popup(f'Failed on {len(failed)} of {len(results)} device(s):\n{failures}')
+    else:
+        sg.popup(success_message)
 
 
-def do_a_preset(preset_name: str):
+def do_a_preset(preset_name: str, task: BackgroundTask) -> bool:
+    # Check the preset can be built, then pack and copy it in the background. Returns whether it started.
     # Look for quest devices
     quest_devices = find_quest_devices()
 
     if not quest_devices:
         sg.popup('Please find Quest devices first.')
-    else:
-        base_path = Path(search_for_halflife())
-        preset = presets[preset_name]
-        game_path = base_path / preset['base_folder']
-        if not rewrite_path_for_os(game_path).exists():
-            sg.popup(f'Error: Game path {game_path} does not exist.')
-            return
-        
-        if preset['also_include_overwrites']:
-            for new_folder in preset['also_include_overwrites']:
-                if not rewrite_path_for_os(base_path / new_folder).exists():
-                    sg.popup(f'Error: {base_path / new_folder} does not exist.')
-                    return
-        
-        # Pack and copy the preset
-        pack_and_copy_preset(quest_devices, base_path=base_path, preset=preset_name)
-        sg.popup(f'{preset_name} copied successfully.')
+        return False
+    base_path = search_for_halflife()
+    if base_path is None:
+        sg.popup('Unable to find the Half-Life directory.')
+        return False
+    preset = presets[preset_name]
+    game_path = base_path / preset['base_folder']
+    if not rewrite_path_for_os(game_path).exists():
+        sg.popup(f'Error: Game path {game_path} does not exist.')
+        return False
+    
+    if preset['also_include_overwrites']:
+        for new_folder in preset['also_include_overwrites']:
+            if not rewrite_path_for_os(base_path / new_folder).exists():
+                sg.popup(f'Error: {base_path / new_folder} does not exist.')
+                return False
+    
+    # Pack and copy the preset
+    return task.start(f'{preset_name} copied successfully.', pack_and_copy_preset, quest_devices, base_path=base_path, preset=preset_name)
+
+
+# Each button and the preset it packs and copies
+PRESET_BUTTONS = {
+    'Pack and Copy Base Half-Life': 'hl_hd',
+    'Pack and Copy Blueshift': 'blueshift_hd',
+    'Pack and Copy Opposing Force': 'opfor_hd',
+    'Pack and Copy HL AI Upscale': 'hl_ai_upscale',
+    'Pack and Copy Blueshift AI Upscale': 'blueshift_ai_upscale',
+    'Pack and Copy Opposing Force AI Upscale': 'opfor_ai_upscale',
+}
+ACTION_BUTTONS = ['Find Quest Devices', 'Install Lambda and Launcher', 'Download and Install HL Gold HD', 'Pack and Copy HL Gold HD'] + list(PRESET_BUTTONS)
 
 
 def main():
@@ -44,22 +71,67 @@ def main():
         [sg.Button('Pack and Copy HL AI Upscale')],
         [sg.Button('Pack and Copy Blueshift AI Upscale')],
         [sg.Button('Pack and Copy Opposing Force AI Upscale')],
-        [sg.Button('Exit')]
+        [sg.ProgressBar(1000, orientation='h', size=(30, 15), key='progress')],
+        [sg.Text('', key='status', size=(60, 1))],
+        [sg.Button('Cancel', disabled=True), sg.Button('Exit')]
     ]
 
     # Create the GUI window
-    window = sg.Window('HL Packer Wizard', layout)
+    window = sg.Window('HL Packer Wizard', layout, finalize=True)
+    # The long steps run here so the window keeps responding, with progress and the result coming back as events
+    task = BackgroundTask(window)
+
+    def set_running(running: bool):
+        for key in ACTION_BUTTONS:
+            window[key].update(disabled=running)
+        window['Cancel'].update(disabled=not running)
+
+    def start(started: bool):
+        if started:
+            set_running(True)
 
     # Look for quest devices
     quest_devices = find_quest_devices()
 
+    # Set HL_PAKER_TRACE to a file name to get a Chrome trace of everything this run did
+    trace_path = os.environ.get('HL_PAKER_TRACE')
+
     # Run the GUI loop
     while True:
         event, values = window.read()
 
         if event == sg.WIN_CLOSED or event == 'Exit':
+            task.cancel()
             break
 
+        if event == PRINT_EVENT:
+            print(values[event])
+
+        if event == PROGRESS_EVENT:
+            progress = values[event]
+            window['status'].update(describe_progress(progress))
+            fraction = progress_fraction(progress)
+            if fraction is not None:
+                window['progress'].update(int(fraction * 1000))
+
+        if event == DONE_EVENT:
+            success_message, results, error = values[event]
+            set_running(False)
+            window['progress'].update(0)
+            window['status'].update('')
+            if was_cancelled(error) or was_cancelled(results):
+                sg.popup('Cancelled. Anything that was finished is kept.')
+            elif error is not None:
+                sg.popup(f'Error: {error}')
+            elif isinstance(results, dict):
+                show_device_results(results, success_message)
+            else:
+                sg.popup(success_message)
+
+        if event == 'Cancel':
+            window['status'].update('Cancelling, waiting for the current file to finish...')
+            task.cancel()
+
         if event == 'Find Quest Devices':
             quest_devices = find_quest_devices()
             if not quest_devices:
@@ -74,51 +146,36 @@ def main():
                 if not sg.popup_yes_no('Are you sure you want to install Lambda and Launcher? This will overwrite any existing installations.'):
                     continue
 
-                install_lambda_and_launcher(quest_devices, force_install=True)
-                sg.popup('Lambda and Launcher installed successfully.')
+                start(task.start('Lambda and Launcher installed successfully.', install_lambda_and_launcher, quest_devices, force_install=True))
 
-        if event == 'Pack and Copy Base Half-Life':
-            do_a_preset('hl_hd')
+        if event in PRESET_BUTTONS:
+            start(do_a_preset(PRESET_BUTTONS[event], task))
 
         if event == 'Download and Install HL Gold HD':
             if not quest_devices:
                 sg.popup('Please find Quest devices first.')
             else:
-                base_path = Path(search_for_halflife())
                 zip_file = look_for_hl_gold_zip_in_downloads()
-                
-                download_and_install_hl_gold(base_path, zip_file, force_install=True)
-                sg.popup('HL Gold downloaded and installed successfully.')
+                start(task.start('HL Gold downloaded and installed successfully.', download_hl_gold, zip_file))
 
         if event == 'Pack and Copy HL Gold HD':
             if not quest_devices:
                 sg.popup('Please find Quest devices first.')
             else:
-                base_path = Path(search_for_halflife())
-                if not base_path / 'HL_Gold_HD':
+                base_path = search_for_halflife()
+                if base_path is None:
+                    sg.popup('Unable to find the Half-Life directory.')
+                elif find_hl_gold_zip() is None and not (base_path / 'HL_Gold_HD').exists():
                     sg.popup('HL Gold HD not found.')
                 else:
-                    pack_and_copy_hl_gold(quest_devices, base_path=base_path)
-                    sg.popup('HL Gold packed and copied successfully.')
-
-        if event == 'Pack and Copy Blueshift':
-            do_a_preset('blueshift_hd')
-
-        if event == 'Pack and Copy Opposing Force':
-            do_a_preset('opfor_hd')
-        
-        if event == 'Pack and Copy HL AI Upscale':
-            do_a_preset('hl_ai_upscale')
-        
-        if event == 'Pack and Copy Blueshift AI Upscale':
-            do_a_preset('blueshift_ai_upscale')
-
-        if event == 'Pack and Copy Opposing Force AI Upscale':
-            do_a_preset('opfor_ai_upscale')
+                    start(task.start('HL Gold packed and copied successfully.', pack_and_copy_hl_gold, quest_devices, base_path=base_path))
 
 
     # Close the GUI window
     window.close()
+    if trace_path:
+        task.metrics.print_summary()
+        task.metrics.save(trace_path, chrome_trace=True)
 
 
 if __name__ == '__main__':